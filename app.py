@@ -1,49 +1,49 @@
-import geopandas as gpd
-from shiny import App, ui, render, reactive
-import pandas as pd 
-from pathlib import Path
-import sys 
+import asyncio
+import functools
 import json
-from shapely.geometry import mapping
-from shapely import wkt
-from shapely.geometry import mapping, box, Point
-from pyproj import Transformer
-import math
-from shapely.affinity import rotate
-from shapely.geometry import box
+import logging
+import os
+
 import numpy as np
-from math import sin, cos, pi
-from shapely.ops import unary_union
-from shapely.geometry import Point, MultiPolygon
-from shapely.affinity import rotate
-from shapely.geometry import box
-from math import sin, cos, pi
-
-WGS = 'EPSG:4326'
-PROJ = 'EPSG:2263'
-
-# Constants remain the same
-DATA_DIR = Path("data")
-deployments = { 
-    'Elmhurst, Queens': {
-        'coords': (40.738536, -73.887267),
-        'video': 'elmhurst_deployment.mp4'
-    },
-    'Sutton Place, Manhattan': {
-        'coords': (40.758890, -73.958457),
-        'video': 'sutton_place_deployment.mp4'
-    },
-    'Herald Square, Manhattan': {
-        'coords': (40.748422, -73.988275),
-        'video': 'herald_square_deployment.mp4'
-    },
-    'Jackson Heights, Queens': {
-        'coords': (40.747379, -73.889690),
-        'video': 'jackson_heights_deployment.mp4'
-    }
-}
+import shiny
+from shiny import App, ui, render, reactive, req
+from starlette.applications import Starlette
+from starlette.routing import Mount
+
+from classify import NUM_CLASSES
+from dataset import (
+    CHOROPLETH_ZOOM, LOD_LAYERS, SHARED_DIR, deployments, get_dataset, lod_level, preload_dataset, watch_sources,
+)
+from metrics import active_sessions, message_bytes, timed, timed_async
+from outbox import Outbox
+from payloads import (
+    DIFF_TRANSPORTS, TRANSPORTS, diff_messages, json_object, layer_message, layer_messages, rows_payload,
+)
+from routes import routes
+from shared import published_version
+from tiles import TILE_LAYERS, tile_version
+from viewport import VIEWPORT_LAYERS, parse_viewport, viewport_rows
+
+logger = logging.getLogger(__name__)
 
-# Define the 11 colors from red to green
+# 'tiles' streams sidewalks and census blocks as vector tiles, 'binary' fetches them as
+# typed-array blobs, 'viewport' sends the features in view as the map moves,
+# 'quantized' inlines every layer as delta-encoded integer coordinates and
+# 'geojson' inlines whole layers in the websocket message
+LAYER_TRANSPORT = os.environ.get("ROBOTABILITY_TRANSPORT", "tiles")
+if LAYER_TRANSPORT not in TRANSPORTS:
+    raise ValueError(f"ROBOTABILITY_TRANSPORT must be one of {TRANSPORTS}, got {LAYER_TRANSPORT!r}")
+
+# Zoom the map opens at (viewState in the page script), used until the browser reports one
+INITIAL_ZOOM = 12
+# Seconds between a session's checks for a newly published dataset version
+VERSION_POLL_SECONDS = 5
+# Shiny releases whose session._conn.send was checked to be exactly what send_custom_message
+# ends in (one text frame per message, no queue in between); others take the public path.
+# requirements.txt pins shiny to these, so an upgrade is a deliberate change to both
+RAW_SEND_SHINY_VERSIONS = ('1.8.',)
+
+# Define the 11 colors from red to green, one per score class
 COLORS = [
     [165, 0, 38],    # Dark red
     [215, 48, 39],   # Red
@@ -57,55 +57,15 @@ COLORS = [
     [26, 152, 80],   # Green
     [0, 104, 55]     # Dark green
 ]
+if len(COLORS) != NUM_CLASSES:
+    raise ValueError(f"COLORS needs one color per score class ({NUM_CLASSES}), got {len(COLORS)}")
 
-def create_deployment_polygons():
-    """Generate deployment visualization polygons with optimized performance"""
-    transformer = Transformer.from_crs(WGS, PROJ, always_xy=True)
-    deployment_features = []
-    
-    for name, info in deployments.items():
-        lat, lon = info['coords']
-        x, y = transformer.transform(lon, lat)
-        
-        # Optimize ring generation
-        radius = 400  # Base radius in meters
-        height = 150  # Max height in meters
-        rings = 15    # Reduced number of rings for better performance
-        
-        circles = []
-        angles = np.linspace(0, np.pi, rings)
-        
-        # Vectorized calculations
-        current_radii = radius * np.cos(angles)
-        current_heights = height * np.sin(angles)
-        
-        # Generate circles more efficiently
-        for r, h in zip(current_radii, current_heights):
-            circle = Point(x, y).buffer(r, resolution=16)  # Reduced resolution
-            circles.append((circle, h))
-        
-        # Convert to WGS84 efficiently
-        circles_gdf = gpd.GeoDataFrame(
-            geometry=[circle for circle, _ in circles],
-            data={'height': [h for _, h in circles]},
-            crs=PROJ
-        ).to_crs(WGS)
-        
-        # Create features with minimal properties
-        for idx, row in circles_gdf.iterrows():
-            deployment_features.append({
-                "type": "Feature",
-                "geometry": mapping(row.geometry),
-                "properties": {
-                    "name": name,
-                    "description": f"Deployment location: {name}",
-                    "id": list(deployments.keys()).index(name),
-                    "height": row['height'],
-                    "video": info['video']
-                }
-            })
-    
-    return deployment_features
+# Layer checkbox labels and the layer ids used by the browser
+LAYER_IDS = {
+    "Sidewalk Scores": "sidewalks",
+    "Census Block Boundaries": "cbs",
+    "Deployment Locations": "deployments",
+}
 
 app_ui = ui.page_fluid(
     ui.head_content(
@@ -272,66 +232,291 @@ app_ui = ui.page_fluid(
                     transitionInterpolator: new deck.FlyToInterpolator()
                 };
 
-                function generateLayers(data, colors) {
+                const binaryLayers = {};
+
+                // Layers the server has sent this session, kept until it removes them,
+                // and the ids currently shown. Hidden layers stay loaded so that
+                // showing them again costs nothing.
+                const layerSources = {};
+                const layerRequests = {};
+                // Row ranges of each GeoJSON layer appended or replaced in place since it was last
+                // drawn, handed to deck.gl as _dataDiff so only those features are parsed again;
+                // null when the whole layer is new
+                let layerChanges = {};
+                let drawnChanges = {};
+                let visibleLayerIds = [];
+                let layerColors = [];
+                // Color of features without a class: fully transparent
+                const NO_COLOR = [0, 0, 0, 0];
+
+                function decodeBinaryLayer(buffer, colors) {
+                    // Layout written by payloads.binary_layer_bytes
+                    const header = new DataView(buffer);
+                    const numPolygons = header.getUint32(4, true);
+                    const numRings = header.getUint32(8, true);
+                    const numPositions = header.getUint32(12, true);
+                    const flags = header.getUint32(16, true);
+                    const hasScores = (flags & 1) !== 0;
+                    const hasClasses = (flags & 2) !== 0;
+                    const numTriangleIndices = header.getUint32(20, true);
+                    const origin = [header.getFloat64(24, true), header.getFloat64(32, true), 0];
+
+                    let offset = 40;
+                    const take = (ArrayType, length) => {
+                        const view = new ArrayType(buffer, offset, length);
+                        offset += length * ArrayType.BYTES_PER_ELEMENT;
+                        return view;
+                    };
+                    const positions = take(Float32Array, numPositions * 2);
+                    const polygonIndices = take(Uint32Array, numPolygons + 1);
+                    const ringIndices = take(Uint32Array, numRings + 1);
+                    const triangles = take(Uint32Array, numTriangleIndices);
+                    const scores = hasScores ? take(Float32Array, numPolygons) : null;
+                    const classes = hasClasses ? take(Uint8Array, numPolygons) : null;
+                    return binaryPolygonSource(
+                        {origin, positions, polygonIndices, ringIndices, triangles, scores, classes}, colors);
+                }
+
+                function decodeQuantizedLayer(quantized, colors) {
+                    // Layout written by payloads.quantized_layer_bytes
+                    const deltas = quantized.positions;
+                    const numPositions = deltas.length / 2;
+                    const positions = new Float32Array(numPositions * 2);
+                    let x = 0;
+                    let y = 0;
+                    for (let i = 0; i < numPositions; i++) {
+                        x += deltas[2 * i];
+                        y += deltas[2 * i + 1];
+                        positions[2 * i] = x / quantized.scale;
+                        positions[2 * i + 1] = y / quantized.scale;
+                    }
+
+                    const ringIndices = new Uint32Array(quantized.rings.length + 1);
+                    for (let i = 0; i < quantized.rings.length; i++) {
+                        ringIndices[i + 1] = ringIndices[i] + quantized.rings[i];
+                    }
+                    const numPolygons = quantized.polygons.length;
+                    const polygonIndices = new Uint32Array(numPolygons + 1);
+                    const triangles = new Uint32Array(quantized.triangles.length);
+                    let ring = 0;
+                    let triangle = 0;
+                    for (let i = 0; i < numPolygons; i++) {
+                        ring += quantized.polygons[i];
+                        polygonIndices[i + 1] = ringIndices[ring];
+                        const end = triangle + quantized.triangleCounts[i];
+                        for (; triangle < end; triangle++) {
+                            triangles[triangle] = polygonIndices[i] + quantized.triangles[triangle];
+                        }
+                    }
+
+                    const scores = quantized.scores
+                        ? Float32Array.from(quantized.scores, s => s < 0 ? NaN : s / 1000)
+                        : null;
+                    const classes = quantized.classes ? Uint8Array.from(quantized.classes) : null;
+                    return binaryPolygonSource({
+                        origin: [quantized.origin[0], quantized.origin[1], 0],
+                        positions,
+                        polygonIndices,
+                        ringIndices,
+                        triangles,
+                        scores,
+                        classes,
+                        properties: quantized.properties
+                    }, colors);
+                }
+
+                function binaryPolygonSource({origin, positions, polygonIndices, ringIndices, triangles, scores, classes, properties}, colors) {
+                    const numPositions = positions.length / 2;
+                    const numPolygons = polygonIndices.length - 1;
+
+                    // deck.gl wants ids, properties and colors per vertex; expand them
+                    // with typed-array fills instead of building feature objects
+                    const featureIds = new Uint32Array(numPositions);
+                    const vertexScores = new Float32Array(numPositions);
+                    const vertexColors = new Uint8Array(numPositions * 4);
+                    for (let i = 0; i < numPolygons; i++) {
+                        const start = polygonIndices[i];
+                        const end = polygonIndices[i + 1];
+                        featureIds.fill(i, start, end);
+                        if (scores) {
+                            vertexScores.fill(scores[i], start, end);
+                            // Unscored polygons (no class) stay fully transparent
+                            const color = classes && colors[classes[i]];
+                            if (!color) {
+                                continue;
+                            }
+                            for (let v = start; v < end; v++) {
+                                vertexColors.set(color, v * 4);
+                                vertexColors[v * 4 + 3] = 255;
+                            }
+                        }
+                    }
+
+                    const noIds = {value: new Uint32Array(0), size: 1};
+                    const colorAttribute = {value: vertexColors, size: 4, normalized: true};
+                    return {
+                        origin,
+                        binaryFeatures: {
+                            points: {
+                                type: 'Point',
+                                positions: {value: new Float32Array(0), size: 2},
+                                globalFeatureIds: noIds,
+                                featureIds: noIds,
+                                numericProps: {},
+                                properties: [],
+                                fields: []
+                            },
+                            lines: {
+                                type: 'LineString',
+                                positions: {value: new Float32Array(0), size: 2},
+                                pathIndices: {value: new Uint32Array(1), size: 1},
+                                globalFeatureIds: noIds,
+                                featureIds: noIds,
+                                numericProps: {},
+                                properties: [],
+                                fields: []
+                            },
+                            polygons: {
+                                type: 'Polygon',
+                                positions: {value: positions, size: 2},
+                                polygonIndices: {value: polygonIndices, size: 1},
+                                primitivePolygonIndices: {value: ringIndices, size: 1},
+                                triangles: triangles.length ? {value: triangles, size: 1} : undefined,
+                                globalFeatureIds: {value: featureIds, size: 1},
+                                featureIds: {value: featureIds, size: 1},
+                                numericProps: scores ? {score: {value: vertexScores, size: 1}} : {},
+                                properties: properties || [],
+                                fields: [],
+                                attributes: scores ? {
+                                    getFillColor: colorAttribute,
+                                    getLineColor: colorAttribute,
+                                    getColor: colorAttribute
+                                } : {}
+                            }
+                        }
+                    };
+                }
+
+                function loadBinaryLayer(url, colors) {
+                    if (!binaryLayers[url]) {
+                        binaryLayers[url] = fetch(url)
+                            .then(response => response.arrayBuffer())
+                            .then(buffer => decodeBinaryLayer(buffer, colors));
+                    }
+                    return binaryLayers[url];
+                }
+
+                function resolveSource(source, colors) {
+                    if (source && source.binary) {
+                        return loadBinaryLayer(source.binary, colors);
+                    }
+                    if (source && source.quantized) {
+                        return Promise.resolve(decodeQuantizedLayer(source.quantized, colors));
+                    }
+                    return Promise.resolve(source);
+                }
+
+                function sourceLayer(props, source) {
+                    if (source.tiles) {
+                        return new deck.MVTLayer({
+                            ...props,
+                            data: source.tiles,
+                            minZoom: source.minZoom,
+                            maxZoom: source.maxZoom
+                        });
+                    }
+                    if (source.binaryFeatures) {
+                        return new deck.GeoJsonLayer({
+                            ...props,
+                            data: source.binaryFeatures,
+                            coordinateSystem: deck.COORDINATE_SYSTEM.LNGLAT_OFFSETS,
+                            coordinateOrigin: source.origin
+                        });
+                    }
+                    const changes = drawnChanges[props.id];
+                    return new deck.GeoJsonLayer({...props, data: source, _dataDiff: changes ? () => changes : undefined});
+                }
+
+                function generateLayers(data, colors, visibleIds) {
                     const layers = [];
-        
+
+                    if (data.blocks && colors.length > 0) {
+                        // Zoomed-out choropleth of the mean sidewalk score of each census block
+                        const blockProps = {
+                            id: 'blocks',
+                            visible: visibleIds.includes('blocks'),
+                            pickable: true,
+                            stroked: false,
+                            filled: true,
+                            opacity: 0.7,
+                            getFillColor: d => colors[d.properties.class] || NO_COLOR,
+                            parameters: {
+                                depthTest: false
+                            },
+                            loadOptions: {
+                                fetch: {
+                                    maxRequests: 4
+                                }
+                            }
+                        };
+                        layers.push(sourceLayer(blockProps, data.blocks));
+                    }
+
                     if (data.cbs) {
-                        layers.push(
-                            new deck.GeoJsonLayer({
-                                id: 'cbs',
-                                data: data.cbs,
-                                pickable: false,
-                                stroked: true,
-                                filled: false,
-                                lineWidthScale: 2,
-                                getLineColor: [0, 0, 0, 255],
-                                parameters: {
-                                    depthTest: false
-                                },
-                                _subLayerProps: {
-                                    'geojson-layer': {
-                                        culling: true,
-                                        cullDistanceScale: 4
-                                    }
+                        const cbsProps = {
+                            id: 'cbs',
+                            visible: visibleIds.includes('cbs'),
+                            pickable: false,
+                            stroked: true,
+                            filled: false,
+                            lineWidthScale: 2,
+                            getLineColor: [0, 0, 0, 255],
+                            parameters: {
+                                depthTest: false
+                            },
+                            _subLayerProps: {
+                                'geojson-layer': {
+                                    culling: true,
+                                    cullDistanceScale: 4
                                 }
-                            })
-                        );
+                            }
+                        };
+                        layers.push(sourceLayer(cbsProps, data.cbs));
                     }
                     
                     if (data.sidewalks && colors.length > 0) {
-                        layers.push(
-                            new deck.GeoJsonLayer({
-                                id: 'sidewalks',
-                                data: data.sidewalks,
-                                pickable: true,
-                                stroked: true,
-                                filled: true,
-                                lineWidthScale: 8,
-                                getLineColor: d => colors[Math.floor(d.properties.score * (colors.length - 1))],
-                                getFillColor: d => colors[Math.floor(d.properties.score * (colors.length - 1))],
-                                parameters: {
-                                    depthTest: false
-                                },
-                                loadOptions: {
-                                    fetch: {
-                                        maxRequests: 4
-                                    }
-                                },
-                                _subLayerProps: {
-                                    'geojson-layer': {
-                                        culling: true,
-                                        cullDistanceScale: 4
-                                    }
+                        const sidewalkProps = {
+                            id: 'sidewalks',
+                            visible: visibleIds.includes('sidewalks'),
+                            pickable: true,
+                            stroked: true,
+                            filled: true,
+                            lineWidthScale: 8,
+                            getLineColor: d => colors[d.properties.class] || NO_COLOR,
+                            getFillColor: d => colors[d.properties.class] || NO_COLOR,
+                            parameters: {
+                                depthTest: false
+                            },
+                            loadOptions: {
+                                fetch: {
+                                    maxRequests: 4
                                 }
-                            })
-                        );
+                            },
+                            _subLayerProps: {
+                                'geojson-layer': {
+                                    culling: true,
+                                    cullDistanceScale: 4
+                                }
+                            }
+                        };
+                        layers.push(sourceLayer(sidewalkProps, data.sidewalks));
                     }
                         
                     if (data.deployments) {
                         layers.push(
-                            new deck.GeoJsonLayer({
+                            sourceLayer({
                                 id: 'deployments',
-                                data: data.deployments,
+                                visible: visibleIds.includes('deployments'),
                                 pickable: true,
                                 stroked: true,
                                 filled: true,
@@ -406,12 +591,10 @@ app_ui = ui.page_fluid(
                                             });
                                         }
                                         
-                                        deckgl.setProps({
-                                            layers: generateLayers(data, colors)
-                                        });
+                                        renderLayers();
                                     }
                                 }
-                            })
+                            }, data.deployments)
                         );
                     }
                     return layers;
@@ -435,6 +618,9 @@ app_ui = ui.page_fluid(
                             console.log('Style loaded');
                             initDeckGL();
                         });
+
+                        mapgl.on('load', reportViewport);
+                        mapgl.on('moveend', reportViewport);
                     }
                 }
 
@@ -445,7 +631,8 @@ app_ui = ui.page_fluid(
                             layers: [],
                             getTooltip: ({object}) => {
                                 if (!object) return null;
-                                if (object.properties.score !== undefined) {
+                                // Blocks without sidewalks have a null score
+                                if (object.properties.score != null) {
                                     return {
                                         html: `Score: ${(object.properties.score * 100).toFixed(1)}%`,
                                         style: {
@@ -461,6 +648,7 @@ app_ui = ui.page_fluid(
 
                         mapgl.addControl(deckOverlay);
                         deckgl = deckOverlay;
+                        renderLayers();
                         
                         mapgl.addControl(
                             new maplibregl.NavigationControl({
@@ -473,30 +661,118 @@ app_ui = ui.page_fluid(
                     }
                 }
 
-                function updateLayers(data, colors) {
+                function renderLayers() {
                     if (!mapgl) {
                         initMap();
                         return;
                     }
 
                     if (!mapgl.loaded()) {
-                        mapgl.once('load', () => {
-                            if (deckgl) {
-                                deckgl.setProps({
-                                    layers: generateLayers(data, colors)
-                                });
-                            }
-                        });
+                        mapgl.once('load', renderLayers);
                         return;
                     }
 
                     if (deckgl) {
+                        drawnChanges = layerChanges;
+                        layerChanges = {};
                         deckgl.setProps({
-                            layers: generateLayers(data, colors)
+                            layers: generateLayers(layerSources, layerColors, visibleLayerIds)
+                        });
+                    }
+                }
+
+                async function addLayer(id, source) {
+                    // Binary sources are fetched first; drop the result if the layer was replaced meanwhile
+                    const request = (layerRequests[id] || 0) + 1;
+                    layerRequests[id] = request;
+                    const resolved = await resolveSource(source, layerColors);
+                    if (layerRequests[id] !== request) {
+                        return;
+                    }
+                    layerSources[id] = resolved;
+                    layerChanges[id] = null;
+                    renderLayers();
+                }
+
+                let renderFrame = null;
+
+                function scheduleRender() {
+                    // Streamed chunks arrive in bursts; redraw once per animation frame, not per chunk
+                    if (renderFrame === null) {
+                        renderFrame = requestAnimationFrame(() => {
+                            renderFrame = null;
+                            renderLayers();
                         });
                     }
                 }
 
+                function markChanged(id, row) {
+                    // Consecutive rows extend the last range; once the whole layer is new, ranges add nothing
+                    const changes = layerChanges[id];
+                    if (changes === null) {
+                        return;
+                    }
+                    if (changes === undefined) {
+                        layerChanges[id] = [{startRow: row, endRow: row + 1}];
+                        return;
+                    }
+                    const last = changes[changes.length - 1];
+                    if (last.endRow === row) {
+                        last.endRow = row + 1;
+                    } else {
+                        changes.push({startRow: row, endRow: row + 1});
+                    }
+                }
+
+                function setFeatures(id, positions, collection) {
+                    // The feature array grows in place; deck.gl gets a new wrapper so it notices,
+                    // and the changed ranges so it only parses those features
+                    const current = layerSources[id];
+                    if (!current || !current.features) {
+                        return;
+                    }
+                    const features = current.features;
+                    collection.features.forEach((feature, i) => {
+                        const position = positions ? positions[i] : features.length;
+                        features[position] = feature;
+                        markChanged(id, position);
+                    });
+                    layerSources[id] = {type: 'FeatureCollection', features: features};
+                    scheduleRender();
+                }
+
+                function appendFeatures(id, collection) {
+                    setFeatures(id, null, collection);
+                }
+
+                function updateFeatures(id, positions, collection) {
+                    // Features of a new dataset version replace the ones at their positions; past the end they are new
+                    setFeatures(id, positions, collection);
+                }
+
+                let viewportTimer = null;
+
+                function reportViewport() {
+                    // Debounced so a pan or zoom gesture yields one query, not one per frame
+                    clearTimeout(viewportTimer);
+                    viewportTimer = setTimeout(() => {
+                        if (!mapgl || !window.Shiny || !Shiny.setInputValue) {
+                            return;
+                        }
+                        const bounds = mapgl.getBounds();
+                        Shiny.setInputValue('viewport', {
+                            bbox: [bounds.getWest(), bounds.getSouth(), bounds.getEast(), bounds.getNorth()],
+                            zoom: mapgl.getZoom()
+                        });
+                    }, 250);
+                }
+
+                function removeLayer(id) {
+                    layerRequests[id] = (layerRequests[id] || 0) + 1;
+                    delete layerSources[id];
+                    renderLayers();
+                }
+
                 function sequentialFlyTo(longitude, latitude) {
                     if (mapgl) {
                         const center = mapgl.getCenter();
@@ -537,8 +813,31 @@ app_ui = ui.page_fluid(
                 });
 
                 // Message handlers
-                Shiny.addCustomMessageHandler("updateLayers", function(message) {
-                    updateLayers(message.data, message.colors);
+                Shiny.addCustomMessageHandler("setColors", function(message) {
+                    layerColors = message.colors;
+                });
+
+                Shiny.addCustomMessageHandler("addLayer", function(message) {
+                    addLayer(message.id, message.data);
+                });
+
+                Shiny.addCustomMessageHandler("appendFeatures", function(message) {
+                    appendFeatures(message.id, message.data);
+                });
+
+                Shiny.addCustomMessageHandler("updateFeatures", function(message) {
+                    updateFeatures(message.id, message.positions, message.data);
+                });
+
+                $(document).on('shiny:connected', reportViewport);
+
+                Shiny.addCustomMessageHandler("removeLayer", function(message) {
+                    removeLayer(message.id);
+                });
+
+                Shiny.addCustomMessageHandler("setVisibleLayers", function(message) {
+                    visibleLayerIds = message.ids;
+                    renderLayers();
                 });
 
                 Shiny.addCustomMessageHandler("flyTo", function(message) {
@@ -566,8 +865,8 @@ app_ui = ui.page_fluid(
                 ui.input_checkbox_group(
                     "visible_layers",
                     "",
-                    choices=["Sidewalk Scores", "Census Block Boundaries", "Deployment Locations"],
-                    selected=["Sidewalk Scores", "Census Block Boundaries", "Deployment Locations"]
+                    choices=list(LAYER_IDS),
+                    selected=list(LAYER_IDS)
                 ),
                 {"style": "margin-bottom: 2rem;"}
             ),
@@ -593,88 +892,276 @@ app_ui = ui.page_fluid(
     )
 )
 
+def encode_next(messages, layer):
+    """Next (type, body) of a layer's messages, or None once they are all sent"""
+    with timed('encode_layer', layer):
+        return next(messages, None)
+
+
+def viewport_message(data, layer, bbox, exclude, level):
+    """Rows of a layer in bbox the browser lacks, and the body of the appendFeatures message adding them"""
+    with timed('viewport_rows', layer):
+        rows = viewport_rows(data, layer, bbox, exclude=exclude)
+    if len(rows) == 0:
+        return rows, None
+    with timed('encode_rows', layer):
+        return rows, json_object({"id": json.dumps(layer).encode(), "data": rows_payload(data, layer, rows, level)})
+
+
+def raw_send(session):
+    """The coroutine function send_custom_message ends in, on the Shiny releases it was checked against, else None
+
+    It takes the text of a whole message, so cached layer bytes can be
+    spliced into the envelope rather than parsed and re-serialized.
+    """
+    if not shiny.__version__.startswith(RAW_SEND_SHINY_VERSIONS):
+        return None
+    conn = getattr(getattr(session, '_root_session', session), '_conn', None)
+    return getattr(conn, 'send', None)
+
+
+@functools.lru_cache(maxsize=None)
+def log_public_send():
+    """Warn, the first time only, that messages go through send_custom_message"""
+    logger.warning("Shiny %s has no checked raw send (checked: %s); cached layer bytes are re-parsed before sending",
+                   shiny.__version__, ", ".join(RAW_SEND_SHINY_VERSIONS))
+
+
+async def send_encoded_message(session, type, body, layer=''):
+    """Send a custom message whose body is already JSON-encoded bytes
+
+    The body is decoded once into the text of the envelope; on Shiny
+    releases without a checked raw send it goes through
+    session.send_custom_message instead, which parses and re-serializes it.
+    """
+    send = raw_send(session)
+    message_bytes.observe(len(body) + len(type) + 16, type=type, layer=layer)
+    with timed('send', layer):
+        if send is None:
+            log_public_send()
+            await session.send_custom_message(type, json.loads(body))
+        else:
+            await send(''.join(('{"custom":{', json.dumps(type), ':', body.decode(), '}}')))
+
+
 def server(input, output, session):
-    data_store = reactive.Value({})
-    
+    active_sessions.inc()
+    session.on_ended(active_sessions.dec)
+    outbox = Outbox(lambda type, body, layer='': send_encoded_message(session, type, body, layer))
+    session.on_ended(outbox.close)
+
+    async def load_base_data():
+        """Fetch the process-wide dataset off the event loop, building it on first use"""
+        with timed('load_base_data'):
+            return await asyncio.to_thread(get_dataset)
+
+    # Which copy of each layer this session's browser holds or is being sent, by layer id,
+    # and the dataset of the copies it holds in full, to send the changes of the next version against
+    sent_layers = {}
+    sent_data = {}
+    # For viewport layers, the copy the rows belong to, its dataset and the position of every
+    # row among the browser's features (-1 for rows not sent)
+    sent_rows = {}
+    shown_layers = None
+
+    @reactive.poll(lambda: published_version(SHARED_DIR), VERSION_POLL_SECONDS)
+    def get_version():
+        """Dataset version published last, so sessions move to a reloaded dataset"""
+        return published_version(SHARED_DIR)
+
+    # (bbox, zoom) of the last valid viewport the browser reported, None before the first
+    viewport = reactive.value(None)
+
     @reactive.effect
-    def load_base_data():
-        """Load the base data once at startup"""
-        if not data_store.get():
-            # Load sidewalk data
-            score_by_sidewalk = pd.read_csv(DATA_DIR / "score_by_sidewalk.csv")
-            score_by_sidewalk = gpd.GeoDataFrame(
-                score_by_sidewalk, 
-                geometry=score_by_sidewalk['geometry'].apply(wkt.loads), 
-                crs=PROJ)
-            
-            # Simplify geometries for better performance
-            score_by_sidewalk['geometry'] = score_by_sidewalk['geometry'].simplify(2.0)
-            
-            # Remove unnecessary columns and normalize scores
-            score_by_sidewalk = score_by_sidewalk[['score', 'geometry']]
-            score_by_sidewalk['score'] = (score_by_sidewalk['score'] - score_by_sidewalk['score'].min()) / (score_by_sidewalk['score'].max() - score_by_sidewalk['score'].min())
-            
-            # Load census blocks with simplified geometries
-            cb_nyc = gpd.read_file(DATA_DIR / "nycb2020_24c/nycb2020.shp").to_crs(WGS)
-            boroughs_of_interest = ['Manhattan', 'Queens', 'Brooklyn', 'Bronx', 'Staten Island']
-            cbs = cb_nyc[cb_nyc.BoroName.isin(boroughs_of_interest)].to_crs(PROJ)
-            cbs['geometry'] = cbs['geometry'].simplify(5.0)
-            
-            # Store processed data
-            data_store.set({
-                'score_by_sidewalk': score_by_sidewalk,
-                'cbs': cbs,
-                'deployments': create_deployment_polygons()
-            })
+    @reactive.event(input.viewport)
+    def handle_viewport():
+        """Keep a reported viewport; a malformed one leaves the last valid viewport in place"""
+        try:
+            viewport.set(parse_viewport(input.viewport()))
+        except ValueError as e:
+            logger.debug("Ignoring viewport report: %s", e)
+
+    @reactive.calc
+    def get_zoom():
+        """Zoom the browser last reported"""
+        return INITIAL_ZOOM if viewport() is None else viewport()[1]
 
     @reactive.calc
     def get_visible_layers():
-        """Get the currently visible layers based on user selection"""
-        data = data_store.get()
-        if not data:
-            return {}
-            
-        result = {}
-        
-        if "Sidewalk Scores" in input.visible_layers():
-            sidewalks_gdf = data['score_by_sidewalk'].to_crs(WGS)
-            result["sidewalks"] = {
-                "type": "FeatureCollection",
-                "features": sidewalks_gdf.__geo_interface__["features"]
-            }
-            
-        if "Census Block Boundaries" in input.visible_layers():
-            cbs_gdf = data['cbs'].to_crs(WGS)
-            result["cbs"] = json.loads(cbs_gdf.to_json())
+        """Get the ids of the layers the user wants to see
 
-        if "Deployment Locations" in input.visible_layers():
-            result["deployments"] = data['deployments']
-            
-        return result
+        Zoomed out, sidewalk scores are shown as the census-block choropleth.
+        """
+        with timed('get_visible_layers'):
+            choropleth = get_zoom() < CHOROPLETH_ZOOM
+            return [
+                'blocks' if layer == 'sidewalks' and choropleth else layer
+                for label, layer in LAYER_IDS.items() if label in input.visible_layers()
+            ]
+
+    @reactive.calc
+    def get_lod_level():
+        """LOD level matching the zoom the browser last reported"""
+        return lod_level(get_zoom())
+
+    def layer_key(data, layer, level):
+        """Identifies the copy of a layer the browser should hold"""
+        if LAYER_TRANSPORT == 'tiles' and layer in TILE_LAYERS:
+            # The tile URLs only change with the layer's content, see tile_version
+            return (tile_version(data, layer), LAYER_TRANSPORT, None)
+        lod = level if layer in LOD_LAYERS else None
+        return (data.version, LAYER_TRANSPORT, lod)
+
+    @timed_async('send_layer')
+    async def send_layer(send, data, layer, level, old=None):
+        """Send one layer, encoding each chunk off the event loop while the previous one goes out
+
+        When the browser holds the layer of the dataset old, only the features
+        that changed are sent, if few enough did.
+        """
+        key = sent_layers[layer]
+        patch = None
+        if old is not None:
+            with timed('diff_layer', layer):
+                patch = await asyncio.to_thread(diff_messages, old, data, layer, level)
+        if patch is not None:
+            messages = iter([("updateFeatures", body) for body in patch])
+        else:
+            messages = layer_messages(data, layer, LAYER_TRANSPORT, level)
+        message = await asyncio.to_thread(encode_next, messages, layer)
+        try:
+            while message is not None:
+                upcoming = asyncio.ensure_future(asyncio.to_thread(encode_next, messages, layer))
+                try:
+                    await send(*message, layer)
+                except BaseException:
+                    upcoming.cancel()
+                    raise
+                message = await upcoming
+        except Exception:
+            # Unless a newer copy replaced it, the browser's copy is incomplete
+            if sent_layers.get(layer) == key:
+                del sent_layers[layer]
+                sent_data.pop(layer, None)
+            raise
+        # Only now does the browser hold every feature the next version's changes refer to
+        if sent_layers.get(layer) == key:
+            sent_data[layer] = data
+
+    @timed_async('update_map')
+    async def send_map(send, visible, level):
+        """Drop outdated hidden layers, show the visible ones and start sending those the browser lacks
+
+        Every layer is sent by a job of its own, so small layers such as the
+        deployments appear while the sidewalks are still on their way.
+        """
+        nonlocal shown_layers
+        data = await load_base_data()
+
+        if shown_layers is None:
+            await send("setColors", json.dumps({"colors": COLORS}).encode())
+
+        for layer, key in list(sent_layers.items()):
+            # Outdated layers that aren't shown are dropped rather than refreshed
+            if key != layer_key(data, layer, level) and layer not in visible:
+                outbox.stop(layer)
+                await send("removeLayer", json.dumps({"id": layer}).encode())
+                del sent_layers[layer]
+                sent_data.pop(layer, None)
+                sent_rows.pop(layer, None)
+
+        if visible != shown_layers:
+            await send("setVisibleLayers", json.dumps({"ids": visible}).encode())
+            shown_layers = visible
+
+        for layer in visible:
+            key = layer_key(data, layer, level)
+            held = sent_layers.get(layer)
+            if held == key:
+                continue
+            # A new version of a layer is sent as its changes if the browser holds all of it otherwise
+            # alike; while a copy is still on its way, the browser holds only part of it
+            old = sent_data.pop(layer, None) if held is not None and held[1:] == key[1:] else None
+            if outbox.running(layer):
+                old = None
+            sent_layers[layer] = key
+            if LAYER_TRANSPORT == 'viewport' and layer in VIEWPORT_LAYERS:
+                if old is not None:
+                    # The viewport job sends the changes of the features the browser holds
+                    sent_data[layer] = data
+                    continue
+                sent_rows.pop(layer, None)
+            # Deployments are either unchanged or sent again (see changed_rows), whatever the transport
+            diffable = LAYER_TRANSPORT in DIFF_TRANSPORTS or layer == 'deployments'
+            outbox.start(layer, send_layer, data, layer, level, old if diffable else None)
 
     @reactive.effect
-    async def update_map():
-        """Update the map when visible layers change"""
-        layers_data = get_visible_layers()
-        await session.send_custom_message(
-            "updateLayers",
-            {"data": layers_data, "colors": COLORS}
-        )
+    def update_map():
+        """Queue the layers the browser doesn't hold yet, then which ones to show"""
+        get_version()
+        outbox.start('map', send_map, get_visible_layers(), get_lod_level())
+
+    @timed_async('update_viewport')
+    async def send_viewport(send, bbox, visible, level):
+        """Send the features of a viewport the browser doesn't have yet
+
+        After a new dataset version, the features the browser holds are
+        brought up to date first.
+        """
+        data = await load_base_data()
+        for layer in VIEWPORT_LAYERS:
+            if layer not in visible:
+                continue
+            key = layer_key(data, layer, level)
+            held, old, positions = sent_rows.get(layer, (None, None, None))
+            if held != key:
+                # Without a copy held, addLayer has just replaced the browser's copy with an empty one
+                patch = None
+                if held is not None:
+                    with timed('diff_layer', layer):
+                        patch = await asyncio.to_thread(diff_messages, old, data, layer, level, positions)
+                    if patch is None:
+                        await send("addLayer", layer_message(data, layer, LAYER_TRANSPORT, level), layer)
+                for body in patch or ():
+                    await send("updateFeatures", body, layer)
+                count = await asyncio.to_thread(data.feature_count, layer)
+                kept = positions if patch is not None else ()
+                positions = np.full(count, -1, dtype=np.int64)
+                positions[:len(kept)] = kept
+                sent_rows[layer] = (key, data, positions)
+            rows, body = await asyncio.to_thread(viewport_message, data, layer, bbox, positions >= 0, level)
+            if len(rows) == 0:
+                continue
+            count = np.count_nonzero(positions >= 0)
+            await send("appendFeatures", body, layer)
+            positions[rows] = np.arange(count, count + len(rows))
+
+    @reactive.effect(priority=-1)
+    def update_viewport():
+        """Queue the features of the reported viewport, once the layers they go into are sent"""
+        if LAYER_TRANSPORT != 'viewport':
+            return
+        bbox, _ = req(viewport())
+        get_version()
+        outbox.start(
+            'viewport', send_viewport, bbox, get_visible_layers(), get_lod_level(), after=('map', *VIEWPORT_LAYERS))
+
+    async def send_fly_to(send, lon, lat):
+        await send("flyTo", json.dumps({"longitude": lon, "latitude": lat, "zoom": 16}).encode())
 
     @reactive.effect
-    async def handle_fly_to():
+    def handle_fly_to():
         """Handle flying to selected deployment"""
         selected = input.fly_select()
         if selected in deployments:
             coords = deployments[selected]['coords']
             lat, lon = coords
-            await session.send_custom_message(
-                "flyTo",
-                {
-                    "longitude": lon,
-                    "latitude": lat,
-                    "zoom": 16
-                }
-            )
+            outbox.start('flyTo', send_fly_to, lon, lat)
+
+preload_dataset()
+watch_sources()
+
+app_shiny = App(app_ui, server)
 
-app = App(app_ui, server)
\ No newline at end of file
+# HTTP routes for map data sit next to the Shiny app, which handles everything else
+app = Starlette(routes=[*routes, Mount("/", app=app_shiny)])
\ No newline at end of file
@@ -0,0 +1,293 @@
+import argparse
+import gc
+import json
+import math
+import platform
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from cache import CACHES
+from dataset import (
+    BOROUGHS, DATA_DIR, LOD_LEVELS, PROJ, SIDEWALK_TOLERANCE, WGS, Dataset, _deployment_polygons,
+    create_deployment_polygons, derived_frames, load_census_blocks, lod_level, normalize_scores, simplify_levels,
+)
+from lookup import MAX_LOOKUP_POINTS, nearest_sidewalks, sidewalk_tree
+from payloads import TRANSPORTS, feature_collection_bytes, layer_message
+from shared import SharedFrames
+
+BENCH_DIR = DATA_DIR / "bench"
+SIZES = (10_000, 100_000, 1_000_000, 5_000_000)
+# Synthetic features are written this many at a time to bound generator memory
+GENERATE_BATCH = 500_000
+# GeoDataFrame.to_json is only timed up to this size; beyond it takes far too long to be useful
+TO_JSON_LIMIT = 1_000_000
+# Zoom the map opens at, which picks the LOD level of the update_map messages
+BENCH_ZOOM = 12
+LAYERS = ('cbs', 'sidewalks', 'deployments')
+# Random points looked up on the synthetic sidewalks, one full batch
+LOOKUP_POINTS = MAX_LOOKUP_POINTS
+
+# Synthetic data covers roughly the five boroughs, in PROJ feet
+EXTENT = (913000.0, 120000.0, 1067000.0, 273000.0)
+SIDEWALK_VERTICES_PER_SIDE = 6
+
+
+def reset_peak_rss():
+    """Restart the kernel's peak RSS counter where supported (Linux), so peaks are per stage"""
+    try:
+        Path('/proc/self/clear_refs').write_text('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def synthetic_sidewalks(n, rng):
+    """n thin, slightly wobbly strips standing in for sidewalk polygons, in PROJ"""
+    k = SIDEWALK_VERTICES_PER_SIDE
+    centers = rng.uniform(EXTENT[:2], EXTENT[2:], (n, 2))
+    length = rng.uniform(20, 300, n)[:, None]
+    width = rng.uniform(5, 15, n)[:, None]
+    angle = rng.uniform(0, np.pi, n)[:, None]
+
+    along = np.linspace(-0.5, 0.5, k)[None, :] * length
+    wobble = rng.normal(0, 0.3, (n, 2 * k))
+    u = np.concatenate([along, along[:, ::-1]], axis=1)
+    v = np.concatenate([np.repeat(-width / 2, k, axis=1), np.repeat(width / 2, k, axis=1)], axis=1) + wobble
+    x = centers[:, :1] + u * np.cos(angle) - v * np.sin(angle)
+    y = centers[:, 1:] + u * np.sin(angle) + v * np.cos(angle)
+    ring = np.stack([x, y], axis=-1)
+    ring = np.concatenate([ring, ring[:, :1]], axis=1)
+    return shapely.polygons(ring)
+
+
+def synthetic_census(n):
+    """A square grid of about n blocks over the extent, with boroughs by vertical band"""
+    side = math.ceil(math.sqrt(n))
+    width = (EXTENT[2] - EXTENT[0]) / side
+    height = (EXTENT[3] - EXTENT[1]) / side
+    i, j = np.divmod(np.arange(n), side)
+    blocks = shapely.box(EXTENT[0] + j * width, EXTENT[1] + i * height,
+                         EXTENT[0] + (j + 1) * width, EXTENT[1] + (i + 1) * height)
+    names = np.array(BOROUGHS + ['Elsewhere'])
+    return gpd.GeoDataFrame(
+        {'BoroName': names[j * len(names) // side], 'BCTCB2020': np.char.mod('%011d', np.arange(n))},
+        geometry=blocks, crs=PROJ,
+    )
+
+
+def synthetic_inputs(n, seed=0):
+    """Paths of a synthetic sidewalk CSV and census shapefile with n features each, generated once"""
+    directory = BENCH_DIR / f"{n}-{seed}"
+    sidewalk_csv = directory / "score_by_sidewalk.csv"
+    census_shp = directory / "nycb2020.shp"
+    if not sidewalk_csv.exists():
+        directory.mkdir(parents=True, exist_ok=True)
+        rng = np.random.default_rng(seed)
+        tmp_path = sidewalk_csv.with_suffix('.tmp')
+        for start in range(0, n, GENERATE_BATCH):
+            count = min(GENERATE_BATCH, n - start)
+            pd.DataFrame({
+                'segment_id': np.arange(start, start + count),
+                'score': rng.uniform(0, 10, count),
+                'geometry': shapely.to_wkt(synthetic_sidewalks(count, rng), rounding_precision=3),
+            }).to_csv(tmp_path, mode='a' if start else 'w', header=not start, index=False)
+        tmp_path.replace(sidewalk_csv)
+    if not census_shp.exists():
+        synthetic_census(n).to_file(census_shp)
+    return sidewalk_csv, census_shp
+
+
+def measure(results, name, run, repeat=1):
+    """Time run (best of repeat) and record its peak RSS under results[name]; returns its value"""
+    best, peak = math.inf, 0
+    for _ in range(repeat):
+        # Drop the previous run's result so it doesn't count towards this one's peak
+        value = None
+        gc.collect()
+        reset_peak_rss()
+        start = time.perf_counter()
+        value = run()
+        best = min(best, time.perf_counter() - start)
+        peak = max(peak, peak_rss())
+    results[name] = {'seconds': best, 'peak_rss_bytes': peak}
+    return value
+
+
+def uncached_deployment_polygons():
+    _deployment_polygons.cache_clear()
+    return create_deployment_polygons()
+
+
+def update_map_messages(dataset, transport):
+    """addLayer bodies for every layer, as update_map sends them to a new session"""
+    for cache in CACHES.values():
+        cache.clear()
+    return [layer_message(dataset, layer, transport, lod_level(BENCH_ZOOM)) for layer in LAYERS]
+
+
+def run_scale(n, repeat=1, transport='geojson'):
+    """Time every stage of the data path on synthetic inputs of n features"""
+    sidewalk_csv, census_shp = synthetic_inputs(n)
+    results = {}
+    table = measure(results, 'csv_read', lambda: pd.read_csv(
+        sidewalk_csv, usecols=['score', 'geometry'], dtype={'score': 'float64', 'geometry': 'object'}), repeat)
+    geometries = measure(results, 'wkt_parse', lambda: shapely.from_wkt(table['geometry'].to_numpy()), repeat)
+    del table['geometry']
+    simplified = measure(results, 'simplify', lambda geometries=geometries: shapely.simplify(
+        geometries, SIDEWALK_TOLERANCE), repeat)
+    # Released so the parsed geometries don't count towards the peaks of the later stages
+    geometries = None
+    raw = table['score'].to_numpy()
+    score = measure(results, 'normalize', lambda: normalize_scores(raw, np.nanmin(raw), np.nanmax(raw)), repeat)
+    sidewalks = measure(results, 'to_crs', lambda: gpd.GeoDataFrame(
+        {'score': score}, geometry=simplified, crs=PROJ).to_crs(WGS), repeat)
+    cbs = measure(results, 'census_load', lambda: load_census_blocks(census_shp).to_crs(WGS), repeat)
+    lods = measure(results, 'lod_levels', lambda: {
+        'sidewalks': simplify_levels(sidewalks), 'cbs': simplify_levels(cbs, coverage=True)}, repeat)
+
+    payload = measure(results, 'serialize', lambda: feature_collection_bytes(
+        sidewalks.geometry.values, sidewalks['score'].to_numpy()), repeat)
+    results['serialize']['payload_bytes'] = len(payload)
+    del payload
+    if n <= TO_JSON_LIMIT:
+        payload = measure(results, 'to_json', sidewalks.to_json, repeat)
+        results['to_json']['payload_bytes'] = len(payload.encode())
+        del payload
+
+    deployments = measure(results, 'create_deployment_polygons', uncached_deployment_polygons, repeat)
+    # Packed in memory rather than in the shared store, so nothing is written to disk. Frames
+    # the stages above built are handed over; the server's builders derive the others
+    frames = {'sidewalks': sidewalks, 'sidewalks-lod': lods['sidewalks'], 'cbs': cbs, 'cbs-lod': lods['cbs']}
+    builders = {**derived_frames(), **{name: lambda _, frame=frame: frame for name, frame in frames.items()}}
+    dataset = Dataset(
+        frames=SharedFrames(builders),
+        deployments=tuple(deployments), version=f"bench-{n}", build_seconds=0.0, built_at=time.time(),
+    )
+    packed = measure(results, 'pack', lambda: [dataset.frames.get(name) for name in frames])
+    # Both sidewalk frames, as the server attaches them
+    results['pack']['shared_bytes_per_feature'] = dataset.bytes_per_feature()['shared']
+    del packed
+    measure(results, 'cbs_outlines', lambda: dataset.frames.get('cbs-outlines'))
+    # Unpack every geometry column up front so update_map times the encoding alone
+    for layer in ('sidewalks', 'cbs'):
+        for level in range(len(LOD_LEVELS)):
+            dataset.geometries(layer, level)
+    # The most a process holds privately: the geojson transport and lookups build whole columns, while
+    # tiles and viewports only keep row bounds
+    results['pack']['private_bytes_per_feature'] = dataset.bytes_per_feature()['private']
+    messages = measure(results, 'update_map', lambda: update_map_messages(dataset, transport), repeat)
+    results['update_map']['payload_bytes'] = sum(len(message) for message in messages)
+
+    # The tree is built up front so the lookup stage times the queries alone
+    sidewalk_tree(dataset)
+    bounds = sidewalks.total_bounds
+    lons, lats = np.random.default_rng(1).uniform(bounds[:2], bounds[2:], (LOOKUP_POINTS, 2)).T
+    measure(results, 'lookup', lambda: nearest_sidewalks(dataset, lons, lats), repeat)
+    results['lookup']['points_per_second'] = LOOKUP_POINTS / results['lookup']['seconds']
+    return results
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'versions': {module.__name__: module.__version__ for module in (np, pd, gpd, shapely)},
+    }
+
+
+def run(sizes, repeat=1, transport='geojson'):
+    """Benchmark every size, each in a fresh process so memory peaks don't carry over"""
+    results = {}
+    for n in sizes:
+        with ProcessPoolExecutor(1) as pool:
+            results[str(n)] = pool.submit(run_scale, n, repeat, transport).result()
+        print_scale(n, results[str(n)])
+    return {'created_at': time.time(), 'transport': transport, 'repeat': repeat,
+            'environment': environment(), 'results': results}
+
+
+def compare(current, baseline, threshold=0.1, min_seconds=0.05):
+    """Stage metrics that grew by more than threshold (a fraction) over a baseline run
+
+    Timings where both runs are under min_seconds are treated as noise.
+    Returns (size, stage, metric, baseline value, current value) tuples.
+    """
+    regressions = []
+    for size, stages in current['results'].items():
+        for stage, record in stages.items():
+            old = baseline['results'].get(size, {}).get(stage)
+            if old is None:
+                continue
+            for metric in ('seconds', 'peak_rss_bytes', 'payload_bytes'):
+                if not old.get(metric) or metric not in record:
+                    continue
+                if metric == 'seconds' and max(old[metric], record[metric]) < min_seconds:
+                    continue
+                if record[metric] > old[metric] * (1 + threshold):
+                    regressions.append((size, stage, metric, old[metric], record[metric]))
+    return regressions
+
+
+def print_scale(n, stages):
+    print(f"{n:,} features")
+    for stage, record in stages.items():
+        payload = f"{record['payload_bytes']:>15,} B" if 'payload_bytes' in record else ''
+        if 'points_per_second' in record:
+            payload = f"{record['points_per_second']:>15,.0f} points/s"
+        if 'shared_bytes_per_feature' in record:
+            payload = (f"{record['shared_bytes_per_feature']:>15,.1f} B/feature shared, "
+                       f"{record['private_bytes_per_feature']:,.1f} private")
+        print(f"  {stage:28} {record['seconds']:10.3f} s {record['peak_rss_bytes'] / 2**20:10.1f} MiB peak {payload}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the data path on synthetic inputs")
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help="feature counts to run")
+    parser.add_argument('--repeat', type=int, default=1, help="runs per stage; the fastest is kept")
+    parser.add_argument('--transport', choices=TRANSPORTS, default='geojson',
+                        help="transport of the update_map messages")
+    parser.add_argument('--output', type=Path, default=BENCH_DIR / "results.json", help="where results are written")
+    parser.add_argument('--input', type=Path, help="compare an existing results file instead of running")
+    parser.add_argument('--baseline', type=Path, help="results of an earlier run to compare against")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="relative growth counted as a regression (default: 0.1)")
+    parser.add_argument('--min-seconds', type=float, default=0.05,
+                        help="timings under this in both runs are never regressions")
+    args = parser.parse_args()
+
+    if args.input:
+        current = json.loads(args.input.read_text())
+    else:
+        current = run(args.sizes, args.repeat, args.transport)
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(json.dumps(current, indent=2))
+        print(f"Results written to {args.output}")
+
+    if args.baseline:
+        regressions = compare(current, json.loads(args.baseline.read_text()), args.threshold, args.min_seconds)
+        for size, stage, metric, old, new in regressions:
+            print(f"REGRESSION {int(size):,} {stage} {metric}: {old:,.3f} -> {new:,.3f} ({new / old - 1:+.0%})")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.threshold:.0%}")
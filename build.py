@@ -0,0 +1,391 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from dataset import (
+    BOROUGHS, CACHE_DIR, CENSUS_BBOXES, CENSUS_TOLERANCE, CHOROPLETH_ZOOM, LOD_LEVELS, OUTLINE_DECIMALS, PROJ,
+    SEGMENT_KEY, SIDEWALK_CSV, SIDEWALK_TOLERANCE, WGS, cache_path, census_sources, frame_keys, get_dataset,
+    load_census_blocks, normalize_scores, outline_levels, parse_sidewalk_geometries, read_sidewalk_chunks,
+    score_range, segment_ids, simplify_levels, source_fingerprint, store_frame, wkt_hashes, write_feather,
+)
+from classify import CLASSIFICATION, score_breaks
+from exports import EXPORT_ENCODINGS, EXPORTS, export_variants
+from payloads import BINARY_LAYERS, binary_payload
+from tiles import TILE_LAYERS, TILE_MAX_ZOOM, TILE_MIN_ZOOM, render_tile, tiles_covering
+
+# Static artifacts are written here, at the same paths the server routes use
+OUTPUT_DIR = Path("public")
+MANIFEST = CACHE_DIR / "build-manifest.json"
+# Per-chunk and per-borough intermediate frames; a source change only rebuilds the shards it touches
+SHARD_DIR = CACHE_DIR / "shards"
+# Suffix of each precompressed export, as static file servers look for them
+ENCODING_SUFFIXES = {'identity': '', 'gzip': '.gz', 'br': '.br'}
+# Tiles rendered per pool task
+TILE_BATCH = 512
+# With more changed sidewalks than this, every tile is re-rendered instead of only the ones they touch
+INCREMENTAL_TILE_ROWS = 10_000
+
+logger = logging.getLogger(__name__)
+
+
+def load_manifest():
+    try:
+        with open(MANIFEST) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(manifest):
+    MANIFEST.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = MANIFEST.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, MANIFEST)
+
+
+def reuse_frames(previous, keys, names):
+    """Whether the frames of a previous build can serve as-is, renaming them to the current keys
+
+    Frame keys follow source mtimes, so a file that was touched but not
+    changed gets new keys while its content digest stays the same.
+    """
+    for name in names:
+        current = cache_path(name, keys[name])
+        if current.exists():
+            continue
+        old = cache_path(name, previous.get('keys', {}).get(name, ''))
+        if not old.exists():
+            return False
+        os.replace(old, current)
+    return True
+
+
+def shard_path(name, key):
+    return SHARD_DIR / f"{name}-{key}.feather"
+
+
+def remove_stale_shards(name, keep):
+    for path in SHARD_DIR.glob(f"{name}-*.feather"):
+        if path.stem.rsplit('-', 1)[-1] not in keep:
+            path.unlink(missing_ok=True)
+
+
+def sidewalk_shard(path, wkt):
+    """Worker: parse, simplify, reproject and level one chunk of sidewalk WKT into a shard"""
+    frame = gpd.GeoDataFrame(geometry=parse_sidewalk_geometries(wkt), crs=PROJ).to_crs(WGS)
+    levels = simplify_levels(frame)
+    shard = gpd.GeoDataFrame(
+        {'geometry': frame.geometry, **{column: levels[column] for column in levels.columns}},
+        geometry='geometry', crs=WGS,
+    )
+    write_feather(shard, path)
+    return len(shard)
+
+
+def census_shard(path, borough):
+    """Worker: read, filter, simplify and reproject the census blocks of one borough into a shard"""
+    write_feather(load_census_blocks(boroughs=[borough]).to_crs(WGS), path)
+    return borough
+
+
+class SidewalkBuild:
+    """Sidewalk stage: one pool task per CSV chunk whose geometry has not been seen before
+
+    Chunks are identified by a hash of their WKT, so a score-only edit
+    reparses nothing and a geometry edit reparses one chunk. Scores are
+    always re-read and renormalized, which is cheap.
+    """
+    names = ('sidewalks', 'sidewalks-lod')
+
+    def __init__(self, pool, jobs, previous, keys, force):
+        self.previous = previous
+        self.keys = keys
+        self.digest = source_fingerprint([SIDEWALK_CSV], SIDEWALK_TOLERANCE, LOD_LEVELS, hash_contents=True)
+        self.skipped = not force and previous.get('digest') == self.digest and reuse_frames(previous, keys, self.names)
+        if self.skipped:
+            return
+        self.ids, self.scores, self.hashes, self.chunks = [], [], [], []
+        pending = deque()
+        for ids, scores, wkt in read_sidewalk_chunks():
+            hashes = wkt_hashes(wkt)
+            key = source_fingerprint([], hashlib.sha256(hashes).hexdigest(), SIDEWALK_TOLERANCE, LOD_LEVELS)
+            self.ids.append(ids)
+            self.scores.append(scores)
+            self.hashes.append(hashes)
+            self.chunks.append((key, len(wkt)))
+            if force or not shard_path('sidewalks', key).exists():
+                # Bound the WKT held in flight to a couple of chunks per worker
+                if len(pending) >= 2 * jobs:
+                    pending.popleft().result()
+                pending.append(pool.submit(sidewalk_shard, shard_path('sidewalks', key), wkt))
+        self.pending = pending
+
+    def finish(self):
+        """Assemble the shards into the cached frames; returns the changed bounds or None for everything"""
+        if self.skipped:
+            return np.zeros((0, 4))
+        for future in self.pending:
+            future.result()
+
+        raw = np.concatenate(self.scores) if self.scores else np.zeros(0)
+        score = normalize_scores(raw, *score_range(raw))
+        shards = pd.concat([gpd.read_feather(shard_path('sidewalks', key)) for key, _ in self.chunks],
+                           ignore_index=True)
+        sidewalks = gpd.GeoDataFrame({
+            SEGMENT_KEY: segment_ids(self.ids),
+            'score': score,
+            'wkt_hash': np.concatenate(self.hashes) if self.hashes else np.zeros(0, dtype=np.uint64),
+        }, geometry=shards['geometry'].values, crs=WGS)
+        lods = gpd.GeoDataFrame(shards.drop(columns='geometry'), geometry='lod0', crs=WGS)
+
+        changed = self.changed_bounds(sidewalks)
+        store_frame('sidewalks', self.keys['sidewalks'], sidewalks)
+        store_frame('sidewalks-lod', self.keys['sidewalks-lod'], lods)
+        remove_stale_shards('sidewalks', {key for key, _ in self.chunks})
+        return changed
+
+    def changed_bounds(self, sidewalks):
+        """Bounds of the sidewalks that differ from the previous build, old and new, or None if unknown"""
+        old_chunks = [tuple(chunk) for chunk in self.previous.get('chunks', [])]
+        old_path = cache_path('sidewalks', self.previous.get('keys', {}).get('sidewalks', ''))
+        if [rows for _, rows in old_chunks] != [rows for _, rows in self.chunks] or not old_path.exists():
+            return None
+        old_score = pd.read_feather(old_path, columns=['score'])['score'].to_numpy()
+        new_score = sidewalks['score'].to_numpy()
+        changed = (old_score != new_score) & ~(np.isnan(old_score) & np.isnan(new_score))
+
+        bounds = []
+        start = 0
+        for (old_key, rows), (key, _) in zip(old_chunks, self.chunks):
+            if old_key != key:
+                changed[start:start + rows] = True
+                old_shard = shard_path('sidewalks', old_key)
+                if not old_shard.exists():
+                    return None
+                bounds.append(shapely.bounds(gpd.read_feather(old_shard, columns=['geometry']).geometry.values))
+            start += rows
+        if changed.sum() > INCREMENTAL_TILE_ROWS:
+            return None
+        bounds.append(shapely.bounds(sidewalks.geometry.values[changed]))
+        bounds = np.concatenate(bounds)
+        return bounds[~np.isnan(bounds).any(axis=1)]
+
+    def record(self):
+        if self.skipped:
+            # The frames may have been renamed to the current keys
+            return {**self.previous, 'keys': {name: self.keys[name] for name in self.names}}
+        return {'digest': self.digest, 'keys': {name: self.keys[name] for name in self.names},
+                'chunks': [list(chunk) for chunk in self.chunks]}
+
+
+class CensusBuild:
+    """Census stage: one pool task per borough, then the coverage-preserving LOD levels
+
+    The blocks are reassembled in file order so the frame matches what the
+    server builds on its own.
+    """
+    names = ('cbs', 'cbs-lod', 'cbs-outlines')
+
+    def __init__(self, pool, previous, keys, force):
+        self.previous = previous
+        self.keys = keys
+        self.digest = source_fingerprint(
+            census_sources(), CENSUS_TOLERANCE, BOROUGHS, CENSUS_BBOXES, LOD_LEVELS, hash_contents=True)
+        self.skipped = not force and previous.get('digest') == self.digest and reuse_frames(previous, keys, self.names)
+        if self.skipped:
+            return
+        self.shards = [shard_path('cbs', source_fingerprint([], self.digest, borough)) for borough in BOROUGHS]
+        self.pending = [
+            pool.submit(census_shard, path, borough)
+            for path, borough in zip(self.shards, BOROUGHS)
+            if force or not path.exists()
+        ]
+
+    def finish(self):
+        """Assemble the borough shards into the cached frames; returns None since every bound may change"""
+        if self.skipped:
+            return np.zeros((0, 4))
+        for future in self.pending:
+            future.result()
+        cbs = pd.concat([gpd.read_feather(path) for path in self.shards]).sort_index()
+        store_frame('cbs', self.keys['cbs'], cbs)
+        levels = simplify_levels(cbs, coverage=True)
+        store_frame('cbs-lod', self.keys['cbs-lod'], levels)
+        store_frame('cbs-outlines', self.keys['cbs-outlines'], outline_levels(cbs, levels))
+        remove_stale_shards('cbs', {path.stem.rsplit('-', 1)[-1] for path in self.shards})
+        return None
+
+    def record(self):
+        if self.skipped:
+            # The frames may have been renamed to the current keys
+            return {**self.previous, 'keys': {name: self.keys[name] for name in self.names}}
+        return {'digest': self.digest, 'keys': {name: self.keys[name] for name in self.names}}
+
+
+def write_bytes(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    tmp_path.write_bytes(content)
+    os.replace(tmp_path, path)
+
+
+def write_geojson(out, name):
+    """Worker: write an Astro export and its precompressed variants"""
+    _, variants = export_variants(get_dataset(), name)
+    for encoding, body in variants.items():
+        write_bytes(out / 'data' / f"{name}{ENCODING_SUFFIXES[encoding]}", body)
+    for encoding in set(EXPORT_ENCODINGS) - set(variants):
+        (out / 'data' / f"{name}{ENCODING_SUFFIXES[encoding]}").unlink(missing_ok=True)
+    return name
+
+
+def write_binary(out, layer):
+    """Worker: write the typed-array blob of a layer at every LOD level, and at the finest one as {layer}.bin"""
+    dataset = get_dataset()
+    write_bytes(out / 'layers' / f"{layer}.bin", binary_payload(dataset, layer))
+    for level in range(len(LOD_LEVELS)):
+        write_bytes(out / 'layers' / layer / f"lod{level}.bin", binary_payload(dataset, layer, level))
+        # Written by earlier builds, which no route served
+        (out / 'layers' / f"{layer}-lod{level}.bin").unlink(missing_ok=True)
+    return layer
+
+
+def write_tiles(out, layer, z, tiles):
+    """Worker: render a batch of tiles, removing the files of tiles that came out empty"""
+    dataset = get_dataset()
+    written = 0
+    for x, y in tiles:
+        path = out / 'tiles' / layer / str(z) / str(x) / f"{y}.mvt"
+        content = render_tile(dataset, layer, z, x, y)
+        if content:
+            write_bytes(path, content)
+            written += 1
+        else:
+            path.unlink(missing_ok=True)
+    return written
+
+
+def block_bounds(dataset, bounds):
+    """Bounds of the census blocks touching any of the given bounds, None when bounds is"""
+    if bounds is None or len(bounds) == 0:
+        return bounds
+    tree = shapely.STRtree(dataset.cbs.geometry.values)
+    rows = np.unique(tree.query(shapely.box(*bounds.T), predicate='intersects')[1])
+    return shapely.bounds(tree.geometries.take(rows))
+
+
+def tile_batches(dataset, out, layer, changed):
+    """(z, tiles) batches to render: the tiles around changed bounds, or the whole layer when None
+
+    Neighbouring tiles are included since features are clipped with a buffer
+    that reaches into them. The choropleth is only rendered at the zooms it is
+    shown at.
+    """
+    max_zoom = CHOROPLETH_ZOOM - 1 if layer == 'blocks' else TILE_MAX_ZOOM
+    for z in range(TILE_MIN_ZOOM, max_zoom + 1):
+        if changed is None:
+            shutil.rmtree(out / 'tiles' / layer / str(z), ignore_errors=True)
+            tiles = tiles_covering(dataset.frame(layer).total_bounds, z, pad=1)
+        else:
+            tiles = sorted({tile for bounds in changed for tile in tiles_covering(bounds, z, pad=1)})
+        for start in range(0, len(tiles), TILE_BATCH):
+            yield z, tiles[start:start + TILE_BATCH]
+
+
+def run_artifacts(pool, out, manifest, changed, skip_tiles):
+    """Rebuild the static artifacts of every layer whose frames changed since they were last written"""
+    dataset = get_dataset()
+    files = {layer: name for name, layer in EXPORTS.items()}
+    artifacts = manifest.setdefault('artifacts', {})
+    frames = manifest['frames']
+    # Colors follow the class breaks, which may move with any score under quantile or Jenks classes
+    breaks = score_breaks(dataset)
+    style = [CLASSIFICATION, None if breaks is None else breaks.tolist()]
+    restyled = manifest.get('style') != style
+    manifest['style'] = style
+    sources = {
+        'sidewalks': source_fingerprint([], frames['sidewalks']['digest'], style),
+        # Census block GeoJSON carries outlines snapped to OUTLINE_DECIMALS
+        'cbs': source_fingerprint([], frames['cbs']['digest'], OUTLINE_DECIMALS),
+        'blocks': source_fingerprint([], frames['sidewalks']['digest'], frames['cbs']['digest'], style),
+    }
+    if restyled:
+        changed = {**changed, 'sidewalks': None}
+    # Block scores follow the sidewalks inside them, unless the blocks themselves changed
+    changed = {**changed, 'blocks': None if changed['cbs'] is None else block_bounds(dataset, changed['sidewalks'])}
+    tasks = []
+    for layer, source in sources.items():
+        wanted = {
+            'geojson': source_fingerprint([], source, EXPORT_ENCODINGS),
+            # The file layout is part of the key so blobs of earlier layouts are rewritten
+            'binary': source_fingerprint([], source, LOD_LEVELS, 'layers/{layer}/lod{level}.bin'),
+        }
+        if not skip_tiles and layer in TILE_LAYERS:
+            max_zoom = CHOROPLETH_ZOOM - 1 if layer == 'blocks' else TILE_MAX_ZOOM
+            wanted['tiles'] = source_fingerprint([], source, LOD_LEVELS, TILE_MIN_ZOOM, max_zoom)
+        for kind, key in wanted.items():
+            previous = artifacts.get(f"{kind}/{layer}")
+            if previous == key:
+                continue
+            if kind == 'geojson' and layer in files:
+                tasks.append(pool.submit(write_geojson, out, files[layer]))
+            elif kind == 'binary' and layer in BINARY_LAYERS:
+                tasks.append(pool.submit(write_binary, out, layer))
+            elif kind == 'tiles':
+                # Only patch tiles over a build that wrote the complete previous pyramid
+                bounds = changed[layer] if previous is not None else None
+                for z, batch in tile_batches(dataset, out, layer, bounds):
+                    tasks.append(pool.submit(write_tiles, out, layer, z, batch))
+            artifacts[f"{kind}/{layer}"] = key
+    for task in tasks:
+        task.result()
+    return len(tasks)
+
+
+def build(out=OUTPUT_DIR, jobs=None, force=False, skip_tiles=False):
+    """Bring every cached frame and static artifact up to date with the source files"""
+    jobs = jobs or os.cpu_count()
+    manifest = {} if force else load_manifest()
+    frames = manifest.get('frames', {})
+    keys = frame_keys()
+    SHARD_DIR.mkdir(parents=True, exist_ok=True)
+    with ProcessPoolExecutor(jobs) as pool:
+        start = time.perf_counter()
+        # Census shards are queued first so they run alongside the sidewalk chunks
+        census = CensusBuild(pool, frames.get('cbs', {}), keys, force)
+        sidewalks = SidewalkBuild(pool, jobs, frames.get('sidewalks', {}), keys, force)
+        changed = {'sidewalks': sidewalks.finish(), 'cbs': census.finish()}
+        manifest['frames'] = {'sidewalks': sidewalks.record(), 'cbs': census.record()}
+        save_manifest(manifest)
+        for name, stage in (('sidewalks', sidewalks), ('census', census)):
+            logger.info("%s frames %s", name, 'unchanged' if stage.skipped else 'rebuilt')
+        logger.info("frames ready in %.1f s", time.perf_counter() - start)
+
+        start = time.perf_counter()
+        tasks = run_artifacts(pool, Path(out), manifest, changed, skip_tiles)
+        save_manifest(manifest)
+        logger.info("%d artifact tasks in %.1f s", tasks, time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the cached frames and static map artifacts")
+    parser.add_argument('--out', type=Path, default=OUTPUT_DIR, help="directory the static artifacts go to")
+    parser.add_argument('--jobs', type=int, default=None, help="worker processes (default: one per CPU)")
+    parser.add_argument('--force', action='store_true', help="rebuild everything, ignoring the manifest")
+    parser.add_argument('--skip-tiles', action='store_true', help="don't render the vector tile pyramid")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    build(args.out, args.jobs, args.force, args.skip_tiles)
@@ -0,0 +1,72 @@
+import threading
+from collections import OrderedDict
+
+# Every cache created in the process, by name, so their statistics can be reported
+CACHES = {}
+
+
+class BoundedCache:
+    """Thread-safe LRU cache bounded by entry count and, optionally, total bytes
+
+    Values are sized with len() unless a sizeof callable is given. Builds run
+    outside the lock, so two threads missing the same key may both build it;
+    the last one wins, which is harmless for deterministic payloads.
+    """
+
+    def __init__(self, name, max_entries=64, max_bytes=None, sizeof=len):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        CACHES[name] = self
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._entries and (
+                len(self._entries) > self.max_entries
+                or (self.max_bytes is not None and self._bytes > self.max_bytes and len(self._entries) > 1)
+            ):
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+        return value
+
+    def get_or_build(self, key, build):
+        """Return the cached value for key, calling build() on a miss"""
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            value = self.put(key, build())
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
@@ -0,0 +1,127 @@
+import os
+
+import numpy as np
+
+from cache import BoundedCache
+from dataset import changed_rows
+
+# One class per color of the palette (COLORS in app.py), from lowest to highest score
+NUM_CLASSES = 11
+# Class of features without a score, drawn transparent
+NO_CLASS = 255
+
+# 'linear' splits the normalized score range evenly, 'quantile' puts as many
+# sidewalks in every class and 'jenks' uses natural breaks of the score distribution
+CLASSIFICATIONS = ('linear', 'quantile', 'jenks')
+CLASSIFICATION = os.environ.get("ROBOTABILITY_CLASSIFICATION", "linear")
+if CLASSIFICATION not in CLASSIFICATIONS:
+    raise ValueError(f"ROBOTABILITY_CLASSIFICATION must be one of {CLASSIFICATIONS}, got {CLASSIFICATION!r}")
+
+# Natural breaks are optimized over at most this many evenly spaced order statistics
+JENKS_SAMPLE = 1024
+
+# Class breaks per (dataset version, mode), and class indexes per (dataset version, layer, mode)
+breaks_cache = BoundedCache('score_breaks', max_entries=8, sizeof=lambda breaks: 0 if breaks is None else breaks.nbytes)
+class_cache = BoundedCache('score_classes', max_entries=16, sizeof=lambda classes: classes.nbytes)
+
+
+def quantile_breaks(scores, num_classes=NUM_CLASSES):
+    """Scores splitting the scored features into num_classes equally populated classes"""
+    return np.nanquantile(scores, np.linspace(0, 1, num_classes + 1)[1:-1])
+
+
+def jenks_breaks(scores, num_classes=NUM_CLASSES, sample=JENKS_SAMPLE):
+    """Fisher-Jenks natural breaks: the class boundaries minimizing the within-class variance
+
+    The exact optimum is quadratic in the number of values, so it is computed
+    over a sample of the sorted scores, which keeps their distribution.
+    """
+    values = np.sort(np.asarray(scores, dtype=np.float64)[~np.isnan(scores)])
+    if len(values) > sample:
+        values = values[np.linspace(0, len(values) - 1, sample).round().astype(np.int64)]
+    unique = np.unique(values)
+    if len(unique) <= num_classes:
+        return unique[1:]
+
+    m = len(values)
+    # cost[i, j]: squared deviation of values[i:j] from their mean, for i < j
+    sums = np.concatenate([[0.0], np.cumsum(values)])
+    squares = np.concatenate([[0.0], np.cumsum(values ** 2)])
+    i, j = np.arange(m + 1)[:, None], np.arange(m + 1)[None, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cost = squares[j] - squares[i] - (sums[j] - sums[i]) ** 2 / (j - i)
+    cost[i >= j] = np.inf
+
+    # best[k][j]: least cost of splitting values[:j] into k + 1 classes
+    best = cost[0]
+    starts = []
+    for _ in range(num_classes - 1):
+        totals = best[:, None] + cost
+        starts.append(totals.argmin(axis=0))
+        best = totals.min(axis=0)
+
+    # Walk back from the full range to the first value of every class but the first
+    breaks = []
+    end = m
+    for start in reversed(starts):
+        end = start[end]
+        breaks.append(values[end])
+    return np.array(breaks[::-1])
+
+
+def score_breaks(dataset, mode=CLASSIFICATION):
+    """Interior class breaks of a mode, from the sidewalk scores; None for the linear scheme
+
+    Every layer is classified with the sidewalks' breaks so colors mean the
+    same thing on the sidewalks and on the block choropleth.
+    """
+    if mode not in CLASSIFICATIONS:
+        raise ValueError(f"Unknown classification: {mode}")
+    if mode == 'linear':
+        return None
+
+    def build():
+        scores = dataset.scores('sidewalks')
+        if np.isnan(scores).all():
+            return np.zeros(0)
+        return quantile_breaks(scores) if mode == 'quantile' else jenks_breaks(scores)
+    return breaks_cache.get_or_build((dataset.version, mode), build)
+
+
+def class_index(scores, breaks=None, num_classes=NUM_CLASSES):
+    """uint8 class of every score, NO_CLASS where it is missing
+
+    Without breaks, normalized scores are split evenly the way the palette
+    always has been: class floor(score * (num_classes - 1)).
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    if breaks is None:
+        classes = np.floor(scores * (num_classes - 1))
+    else:
+        classes = np.searchsorted(breaks, scores, side='right').astype(np.float64)
+    classes = np.clip(classes, 0, num_classes - 1)
+    return np.where(np.isnan(scores), NO_CLASS, classes).astype(np.uint8)
+
+
+def score_classes(dataset, layer, mode=CLASSIFICATION):
+    """Class index of every feature of a layer, computed once per dataset version; None without scores"""
+    scores = dataset.scores(layer)
+    if scores is None:
+        return None
+    return class_cache.get_or_build(
+        (dataset.version, layer, mode), lambda: class_index(scores, score_breaks(dataset, mode)))
+
+
+def updated_rows(old, new, layer):
+    """Sorted rows of a layer drawn differently in two dataset versions, or None if rows don't line up
+
+    These are the rows whose geometry or score changed (see changed_rows)
+    and those whose color class moved with the class breaks.
+    """
+    rows = changed_rows(old, new, layer)
+    if rows is None:
+        return None
+    old_classes, new_classes = score_classes(old, layer), score_classes(new, layer)
+    if old_classes is not None:
+        rows = np.union1d(rows, np.flatnonzero(old_classes != new_classes[:len(old_classes)]))
+    return rows
@@ -0,0 +1,1041 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from functools import lru_cache
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from pyproj import Transformer
+
+from metrics import dataset_build_seconds, dataset_memory_bytes, sidewalk_bytes_per_feature
+from shared import SharedFrames, publish_version, published_version, store_lock
+
+WGS = 'EPSG:4326'
+PROJ = 'EPSG:2263'
+
+DATA_DIR = Path("data")
+SIDEWALK_CSV = DATA_DIR / "score_by_sidewalk.csv"
+CENSUS_SHP = DATA_DIR / "nycb2020_24c/nycb2020.shp"
+DEPLOYMENTS_CSV = DATA_DIR / "deployments.csv"
+
+# Rows of score_by_sidewalk.csv parsed at a time
+CSV_CHUNK_ROWS = 200_000
+# Column of score_by_sidewalk.csv identifying a segment across edits of the file;
+# files without it are keyed on row number
+SEGMENT_KEY = 'segment_id'
+
+# Simplification tolerances in PROJ units (feet)
+SIDEWALK_TOLERANCE = 2.0
+CENSUS_TOLERANCE = 5.0
+
+
+
+def parse_bboxes(text):
+    """Boxes from "minx,miny,maxx,maxy" groups separated by ';'"""
+    bboxes = []
+    for group in filter(None, (group.strip() for group in text.split(';'))):
+        bbox = tuple(float(value) for value in group.split(','))
+        if len(bbox) != 4:
+            raise ValueError(f"A bounding box needs four comma-separated numbers, got {group!r}")
+        bboxes.append(bbox)
+    return tuple(bboxes)
+
+
+# Census blocks are only loaded for these boroughs (comma-separated names)...
+BOROUGHS = [
+    name.strip()
+    for name in os.environ.get("ROBOTABILITY_BOROUGHS", "Manhattan,Queens,Brooklyn,Bronx,Staten Island").split(',')
+    if name.strip()
+]
+# ...and, when set, only within these lon/lat boxes ("minx,miny,maxx,maxy;...")
+CENSUS_BBOXES = parse_bboxes(os.environ.get("ROBOTABILITY_CENSUS_BBOXES", ""))
+
+# Census block outlines are snapped to this many decimals of a degree (about 10 cm)
+# before the edges neighbouring blocks share are matched
+OUTLINE_DECIMALS = 6
+
+# Level-of-detail pyramid: (lowest zoom served, simplification tolerance in feet).
+# Tolerances are about half a screen pixel at the band's lowest zoom; None is the
+# preprocessed geometry itself.
+LOD_LEVELS = ((10, 150.0), (12, 40.0), (14, 10.0), (16, None))
+# 'blocks' is the census blocks again, filled with the scores of their sidewalks
+LOD_LAYERS = ('sidewalks', 'cbs', 'blocks')
+# Below this zoom the sidewalk scores are drawn as the 'blocks' choropleth; 0 never does
+CHOROPLETH_ZOOM = int(os.environ.get("ROBOTABILITY_CHOROPLETH_ZOOM", "14"))
+
+# Deployment domes: ring radius and dome height in PROJ units, rings per dome
+# and vertices per ring (a resolution-16 point buffer, closed)
+DEPLOYMENT_RADIUS = 400
+DEPLOYMENT_HEIGHT = 150
+DEPLOYMENT_RINGS = 15
+DEPLOYMENT_RING_POINTS = 65
+
+# Preprocessed WGS84 frames are cached here, keyed on their inputs
+CACHE_DIR = DATA_DIR / "cache"
+# Bump whenever the preprocessing pipeline changes its output
+CACHE_FORMAT_VERSION = 3
+# Frames packed into flat arrays that every worker process memory-maps, one directory per version
+SHARED_DIR = CACHE_DIR / "shared"
+# Seconds between checks of the source files for changes to reload; 0 never reloads
+WATCH_INTERVAL = float(os.environ.get("ROBOTABILITY_WATCH_INTERVAL", "10"))
+
+logger = logging.getLogger(__name__)
+
+def load_deployments(path=None):
+    """Robot deployments by name: {'coords': (lat, lon), 'video': filename}"""
+    table = pd.read_csv(path or DEPLOYMENTS_CSV, dtype={'name': str, 'video': str})
+    return {
+        name: {'coords': (lat, lon), 'video': video}
+        for name, lat, lon, video in zip(table['name'], table['lat'], table['lon'], table['video'])
+    }
+
+
+deployments = load_deployments()
+
+
+def deployment_rings(lats, lons):
+    """Dome rings around every deployment, as projected coordinates and heights
+
+    Returns an array of shape (deployments, rings, points, 2) of closed circles
+    in PROJ and the height of each ring. Rings that collapse to a point at the
+    top of the dome or to nothing beyond it are left out.
+    """
+    x, y = Transformer.from_crs(WGS, PROJ, always_xy=True).transform(np.asarray(lons), np.asarray(lats))
+    angles = np.linspace(0, np.pi, DEPLOYMENT_RINGS)
+    radii = DEPLOYMENT_RADIUS * np.cos(angles)
+    heights = DEPLOYMENT_HEIGHT * np.sin(angles)
+    keep = radii > DEPLOYMENT_RADIUS * 1e-6
+    radii, heights = radii[keep], heights[keep]
+
+    theta = np.linspace(0, 2 * np.pi, DEPLOYMENT_RING_POINTS)
+    circle = np.stack([np.cos(theta), np.sin(theta)], axis=-1)
+    centers = np.stack([x, y], axis=-1)
+    coords = centers[:, None, None, :] + radii[None, :, None, None] * circle[None, None, :, :]
+    return coords, heights
+
+
+@lru_cache(maxsize=4)
+def _deployment_polygons(key, path):
+    # key only identifies the file contents for the cache
+    table = load_deployments(path)
+    names = list(table)
+    lats = [table[name]['coords'][0] for name in names]
+    lons = [table[name]['coords'][1] for name in names]
+    coords, heights = deployment_rings(lats, lons)
+
+    # One reprojection for every vertex of every ring
+    shape = coords.shape
+    lon, lat = Transformer.from_crs(PROJ, WGS, always_xy=True).transform(
+        coords[..., 0].ravel(), coords[..., 1].ravel())
+    rings = np.stack([lon, lat], axis=-1).reshape(shape).tolist()
+    heights = heights.tolist()
+
+    return tuple(
+        {
+            "type": "Feature",
+            "geometry": {"type": "Polygon", "coordinates": [ring]},
+            "properties": {
+                "name": name,
+                "description": f"Deployment location: {name}",
+                "id": i,
+                "height": height,
+                "video": table[name]['video']
+            }
+        }
+        for i, name in enumerate(names)
+        for ring, height in zip(rings[i], heights)
+    )
+
+
+def create_deployment_polygons(path=None):
+    """Generate deployment visualization polygons, memoized on the deployments file"""
+    return deployment_source(path)[1]
+
+
+def deployment_source(path=None):
+    """(fingerprint of the deployments file, its deployment polygons), taken together so they agree"""
+    key = source_fingerprint([path or DEPLOYMENTS_CSV])
+    return key, _deployment_polygons(key, path)
+
+
+def read_sidewalk_chunks(path=None, chunksize=None):
+    """Yield (segment ids, raw scores, WKT) for successive chunks of the sidewalk CSV
+
+    Only the key, score and geometry columns are read, so peak memory is
+    bounded by one chunk of WKT text rather than the whole file.
+    """
+    path = path or SIDEWALK_CSV
+    keyed = SEGMENT_KEY in pd.read_csv(path, nrows=0).columns
+    chunks = pd.read_csv(
+        path,
+        usecols=[SEGMENT_KEY, 'score', 'geometry'] if keyed else ['score', 'geometry'],
+        dtype={'score': 'float64', 'geometry': 'object'},
+        chunksize=chunksize or CSV_CHUNK_ROWS,
+    )
+    start = 0
+    for chunk in chunks:
+        ids = chunk[SEGMENT_KEY].to_numpy() if keyed else np.arange(start, start + len(chunk))
+        start += len(chunk)
+        yield ids, chunk['score'].to_numpy(), chunk['geometry'].to_numpy()
+
+
+def segment_ids(parts):
+    """One array of the segment ids read chunk by chunk; ids that aren't all integers become strings"""
+    ids = np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+    return ids.astype(str) if ids.dtype == object else ids
+
+
+def wkt_hashes(wkt):
+    """Hash of every WKT string, telling which geometries changed between two files"""
+    return pd.util.hash_array(wkt)
+
+
+def parse_sidewalk_geometries(wkt):
+    """Simplified PROJ geometries from an array of sidewalk WKT strings"""
+    return shapely.simplify(shapely.from_wkt(wkt), SIDEWALK_TOLERANCE)
+
+
+def normalize_scores(score, low, high):
+    """Min-max normalize raw scores into float32"""
+    return ((score - low) / (high - low)).astype(np.float32)
+
+
+def score_range(score):
+    """(min, max) of the raw scores, NaN when none is set"""
+    if not len(score) or np.isnan(score).all():
+        return np.nan, np.nan
+    return np.nanmin(score), np.nanmax(score)
+
+
+def load_sidewalks(path=None):
+    """Read, simplify and normalize the scored sidewalk network
+
+    Scores are min-max normalized once and kept as float32. Every segment
+    keeps its id and the hash of its WKT, so a later edit of the file can be
+    applied incrementally, see update_sidewalks.
+    """
+    ids, scores, hashes, geometries = [], [], [], []
+    for chunk_ids, chunk_scores, wkt in read_sidewalk_chunks(path):
+        ids.append(chunk_ids)
+        scores.append(chunk_scores)
+        hashes.append(wkt_hashes(wkt))
+        geometries.append(parse_sidewalk_geometries(wkt))
+
+    score = np.concatenate(scores) if scores else np.zeros(0)
+    return gpd.GeoDataFrame({
+        SEGMENT_KEY: segment_ids(ids),
+        'score': normalize_scores(score, *score_range(score)),
+        'wkt_hash': np.concatenate(hashes) if hashes else np.zeros(0, dtype=np.uint64),
+    }, geometry=np.concatenate(geometries) if geometries else np.array([], dtype=object), crs=PROJ)
+
+
+def update_sidewalks(previous, path=None):
+    """Sidewalks ready to serve, parsing only the segments whose WKT differs from previous
+
+    previous is the sidewalks frame of the version being replaced. Segments
+    keep their row, new ones are appended and removed ones are left as rows
+    without geometry or score, so the rows of both versions line up and
+    clients can be sent just the rows that changed. Scores are renormalized
+    over the whole file. Without unique segment ids everything is reparsed.
+    """
+    if SEGMENT_KEY not in previous or 'wkt_hash' not in previous:
+        return preprocess_sidewalks(path)
+    old_ids = previous[SEGMENT_KEY].to_numpy()
+    index = pd.Index(old_ids)
+    if not index.is_unique:
+        return preprocess_sidewalks(path)
+    old_hashes = previous['wkt_hash'].to_numpy()
+    old_geometries = previous.geometry.to_numpy()
+
+    ids, scores, hashes, geometries = [], [], [], []
+    parsed = 0
+    for chunk_ids, chunk_scores, wkt in read_sidewalk_chunks(path):
+        chunk_hashes = wkt_hashes(wkt)
+        rows = index.get_indexer(chunk_ids)
+        same = rows >= 0
+        same[same] = old_hashes[rows[same]] == chunk_hashes[same]
+        chunk_geometries = np.full(len(wkt), None, dtype=object)
+        chunk_geometries[same] = old_geometries[rows[same]]
+        if not same.all():
+            chunk_geometries[~same] = gpd.GeoSeries(
+                parse_sidewalk_geometries(wkt[~same]), crs=PROJ).to_crs(WGS).to_numpy()
+            parsed += int((~same).sum())
+        ids.append(chunk_ids)
+        scores.append(chunk_scores)
+        hashes.append(chunk_hashes)
+        geometries.append(chunk_geometries)
+
+    ids = segment_ids(ids)
+    if not pd.Index(ids).is_unique:
+        logger.warning("Segment ids in %s repeat; reparsing every sidewalk", path or SIDEWALK_CSV)
+        return preprocess_sidewalks(path)
+    rows = index.get_indexer(ids)
+    added = rows < 0
+    rows[added] = len(old_ids) + np.arange(added.sum())
+    length = len(old_ids) + int(added.sum())
+    raw = np.concatenate(scores) if scores else np.zeros(0)
+    score = np.full(length, np.nan)
+    score[rows] = raw
+    wkt_hash = np.zeros(length, dtype=np.uint64)
+    wkt_hash[rows] = np.concatenate(hashes) if hashes else []
+    geometry = np.full(length, None, dtype=object)
+    geometry[rows] = np.concatenate(geometries) if geometries else []
+    logger.info("Updated %d sidewalks: %d parsed, %d added", len(ids), parsed, added.sum())
+    return gpd.GeoDataFrame({
+        SEGMENT_KEY: np.concatenate([old_ids, ids[added]]),
+        'score': normalize_scores(score, *score_range(raw)),
+        'wkt_hash': wkt_hash,
+    }, geometry=geometry, crs=WGS)
+
+
+def borough_filter(boroughs):
+    """OGR SQL WHERE clause selecting the blocks of the given boroughs"""
+    names = ', '.join("'" + name.replace("'", "''") + "'" for name in boroughs)
+    return f"BoroName IN ({names})"
+
+
+def bbox_mask(bboxes, crs):
+    """Union of lon/lat boxes as a polygon in crs"""
+    transformer = Transformer.from_crs(WGS, crs, always_xy=True)
+    return shapely.union_all([shapely.box(*transformer.transform_bounds(*bbox)) for bbox in bboxes])
+
+
+def load_census_blocks(path=None, boroughs=None, bboxes=None):
+    """Read the census blocks of the boroughs and boxes of interest with simplified geometries
+
+    The borough and box filters are pushed down into the reader so blocks
+    elsewhere are never decoded. Rows keep their feature ids as the index.
+    Without pyogrio the whole file is read and filtered in memory.
+    """
+    path = path or CENSUS_SHP
+    boroughs = boroughs or BOROUGHS
+    bboxes = CENSUS_BBOXES if bboxes is None else bboxes
+    try:
+        import pyogrio
+    except ImportError:
+        logger.warning("pyogrio is not installed; reading all of %s to filter it", path)
+        cbs = gpd.read_file(path)
+        cbs = cbs[cbs.BoroName.isin(boroughs)]
+        if bboxes:
+            cbs = cbs[cbs.intersects(bbox_mask(bboxes, cbs.crs))]
+    else:
+        mask = bbox_mask(bboxes, pyogrio.read_info(path)['crs']) if bboxes else None
+        cbs = gpd.read_file(path, engine='pyogrio', where=borough_filter(boroughs), mask=mask, fid_as_index=True)
+    cbs = cbs.to_crs(PROJ)
+    cbs['geometry'] = cbs['geometry'].simplify(CENSUS_TOLERANCE)
+    return cbs
+
+
+def census_sources():
+    """The shapefile and whichever of its sidecar files exist"""
+    return sorted(CENSUS_SHP.parent.glob(CENSUS_SHP.stem + ".*"))
+
+
+def file_digest(path):
+    """SHA-256 hex digest of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def source_fingerprint(paths, *params, hash_contents=False):
+    """Short key identifying a set of source files and processing parameters
+
+    By default files are identified by size and mtime, which is cheap enough to
+    check on every start. With hash_contents the bytes themselves are hashed.
+    """
+    digest = hashlib.sha256(f"v{CACHE_FORMAT_VERSION}".encode())
+    for path in paths:
+        path = Path(path)
+        if hash_contents:
+            digest.update(f"{path.name}:{file_digest(path)}".encode())
+        else:
+            stat = path.stat()
+            digest.update(f"{path.name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    for param in params:
+        digest.update(repr(param).encode())
+    return digest.hexdigest()[:16]
+
+
+def preprocess_sidewalks(path=None):
+    """Sidewalks ready to serve: simplified, normalized and in WGS84"""
+    return load_sidewalks(path).to_crs(WGS)
+
+
+def preprocess_census_blocks():
+    """Census blocks ready to serve: filtered, simplified and in WGS84"""
+    return load_census_blocks().to_crs(WGS)
+
+
+def lod_level(zoom):
+    """Index of the LOD_LEVELS entry serving a map zoom"""
+    level = 0
+    for i, (min_zoom, _) in enumerate(LOD_LEVELS):
+        if zoom >= min_zoom:
+            level = i
+    return level
+
+
+def simplify_levels(gdf, coverage=False):
+    """One simplified copy of gdf's geometry per coarse LOD level, in WGS84
+
+    Returned as a GeoDataFrame with a geometry column per level ('lod0', ...)
+    whose rows line up with gdf. Polygon coverages such as census blocks are
+    simplified with shapely's coverage_simplify where available so neighbours
+    keep sharing their edges; everything else keeps per-feature topology.
+    """
+    projected = gdf.geometry.to_crs(PROJ)
+    levels = {}
+    for i, (_, tolerance) in enumerate(LOD_LEVELS):
+        if tolerance is None:
+            continue
+        simplified = None
+        if coverage and hasattr(shapely, 'coverage_simplify'):
+            try:
+                simplified = shapely.coverage_simplify(projected.values, tolerance)
+            except shapely.errors.GEOSException:
+                logger.warning("Census blocks are not a clean coverage; simplifying them one by one")
+        if simplified is None:
+            simplified = shapely.simplify(projected.values, tolerance, preserve_topology=True)
+        levels[f'lod{i}'] = gpd.GeoSeries(simplified, index=gdf.index, crs=PROJ).to_crs(WGS)
+    return gpd.GeoDataFrame(levels, geometry=next(iter(levels)), crs=WGS)
+
+
+def update_levels(previous_levels, previous, sidewalks):
+    """simplify_levels of the sidewalks, reusing previous_levels for the rows whose geometry previous shares"""
+    if list(previous_levels.columns) != [f'lod{i}' for i, (_, tolerance) in enumerate(LOD_LEVELS) if tolerance]:
+        return simplify_levels(sidewalks)
+    shared = min(len(previous), len(sidewalks))
+    kept = np.zeros(len(sidewalks), dtype=bool)
+    kept[:shared] = (
+        (sidewalks[SEGMENT_KEY].to_numpy()[:shared] == previous[SEGMENT_KEY].to_numpy()[:shared])
+        & (sidewalks['wkt_hash'].to_numpy()[:shared] == previous['wkt_hash'].to_numpy()[:shared])
+    )
+    changed = np.flatnonzero(~kept)
+    levels = simplify_levels(sidewalks.iloc[changed]) if len(changed) else None
+    columns = {}
+    for name in previous_levels.columns:
+        values = np.full(len(sidewalks), None, dtype=object)
+        values[:shared][kept[:shared]] = previous_levels[name].to_numpy()[:shared][kept[:shared]]
+        if levels is not None:
+            values[changed] = levels[name].to_numpy()
+        columns[name] = gpd.GeoSeries(values, crs=WGS)
+    return gpd.GeoDataFrame(columns, geometry=previous_levels.geometry.name, crs=WGS)
+
+
+def block_outlines(polygons, decimals=OUTLINE_DECIMALS):
+    """Outline of every census block, leaving out the edges it shares with an earlier block
+
+    As TopoJSON does with arcs, boundaries are snapped to a grid, split into
+    segments and every segment is kept only for the first block it bounds;
+    the segments a block keeps are joined back into lines. Every shared edge
+    is thus drawn once. Rows line up with polygons; a block all of whose
+    edges belong to earlier blocks has no outline (None).
+    """
+    scale = 10 ** decimals
+    parts, part_rows = shapely.get_parts(polygons, return_index=True)
+    rings, ring_parts = shapely.get_rings(parts, return_index=True)
+    coords, vertex_rings = shapely.get_coordinates(rings, return_index=True)
+    grid = np.round(coords * scale).astype(np.int64)
+    # Segment i runs from vertex starts[i] to the next vertex of the same ring
+    starts = np.flatnonzero(vertex_rings[:-1] == vertex_rings[1:])
+    a, b = grid[starts], grid[starts + 1]
+    forward = (a[:, 0] < b[:, 0]) | ((a[:, 0] == b[:, 0]) & (a[:, 1] <= b[:, 1]))
+    ends = np.where(forward[:, None], np.hstack([a, b]), np.hstack([b, a]))
+    # Rings come in row order, so the first copy of a segment is that of the earliest block
+    kept = np.sort(np.unique(ends, axis=0, return_index=True)[1])
+
+    # Runs of kept segments that follow each other along a ring become one line
+    breaks = np.ones(len(kept), dtype=bool)
+    breaks[1:] = starts[kept[1:]] != starts[kept[:-1]] + 1
+    paths = np.cumsum(breaks) - 1
+    # A path ends where the next one breaks off
+    last = np.roll(breaks, -1)
+    vertices = np.concatenate([starts[kept], starts[kept[last]] + 1])
+    vertex_paths = np.concatenate([paths, paths[last]])
+    order = np.lexsort((vertices, vertex_paths))
+    lines = shapely.linestrings(grid[vertices[order]] / scale, indices=vertex_paths[order])
+
+    outlines = np.full(len(polygons), None, dtype=object)
+    shapely.multilinestrings(lines, indices=part_rows[ring_parts[vertex_rings[starts[kept[breaks]]]]], out=outlines)
+    # Lines broken where a ring closes are joined again
+    return shapely.line_merge(outlines)
+
+
+def outline_levels(cbs, levels):
+    """block_outlines of the census blocks at every LOD level, one geometry column per level ('lod0', ...)"""
+    columns = {
+        f'lod{i}': gpd.GeoSeries(block_outlines(
+            cbs.geometry.values if tolerance is None else levels[f'lod{i}'].values), crs=WGS)
+        for i, (_, tolerance) in enumerate(LOD_LEVELS)
+    }
+    return gpd.GeoDataFrame(columns, geometry='lod0', crs=WGS)
+
+
+def cache_path(name, key):
+    return CACHE_DIR / f"{name}-{key}.feather"
+
+
+def write_feather(gdf, path):
+    """Write gdf to path atomically, uncompressed so it can be memory-mapped on read"""
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    gdf.to_feather(tmp_path, compression='uncompressed')
+    os.replace(tmp_path, path)
+
+
+def store_frame(name, key, gdf):
+    """Put a frame in the Feather cache and remove the stale entries for the same name"""
+    path = cache_path(name, key)
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    write_feather(gdf, path)
+    for stale in CACHE_DIR.glob(f"{name}-*.feather"):
+        if stale != path and stale.stem.rsplit('-', 1)[0] == name:
+            stale.unlink(missing_ok=True)
+    return path
+
+
+def cached_frame(name, key, build, geo=True):
+    """Load a preprocessed GeoDataFrame from the Feather cache, building it on a miss
+
+    Files are written uncompressed so they can be memory-mapped on read. Stale
+    entries for the same name are removed once the new one is in place. Plain
+    DataFrames are cached the same way with geo=False.
+    """
+    path = cache_path(name, key)
+    try:
+        if path.exists():
+            return gpd.read_feather(path, memory_map=True) if geo else pd.read_feather(path)
+    except ImportError:
+        logger.warning("pyarrow is not installed; preprocessing %s without a cache", name)
+        return build()
+    except Exception:
+        logger.exception("Ignoring unreadable cache file %s", path)
+
+    gdf = build()
+    try:
+        store_frame(name, key, gdf)
+    except ImportError:
+        logger.warning("pyarrow is not installed; %s will be rebuilt on every start", name)
+    except OSError:
+        logger.exception("Could not write cache file %s", path)
+    return gdf
+
+
+def aggregate_block_scores(sidewalks, cbs):
+    """Score statistics of the sidewalks inside every census block, rows aligned with cbs
+
+    Each sidewalk is assigned to the block containing a point on its surface.
+    The mean is weighted by area, or by length for linear geometries. Blocks
+    without scored sidewalks get NaN statistics and a zero count.
+    """
+    geometries = sidewalks.geometry.values
+    points = shapely.point_on_surface(geometries)
+    sidewalk_rows, block_rows = shapely.STRtree(cbs.geometry.values).query(points, predicate='intersects')
+    # A point on an edge shared by two blocks counts for the first one only
+    first = np.unique(sidewalk_rows, return_index=True)[1]
+    sidewalk_rows, block_rows = sidewalk_rows[first], block_rows[first]
+
+    weight = shapely.area(geometries)
+    weight = np.where(weight > 0, weight, shapely.length(geometries))[sidewalk_rows]
+    score = sidewalks['score'].to_numpy(dtype=np.float64)[sidewalk_rows]
+    scored = ~np.isnan(score)
+    table = pd.DataFrame({
+        'block': block_rows[scored],
+        'score': score[scored],
+        'weighted': score[scored] * weight[scored],
+        'weight': weight[scored],
+    })
+    stats = table.groupby('block').agg(
+        score_min=('score', 'min'), score_max=('score', 'max'), score_unweighted=('score', 'mean'),
+        sidewalk_count=('score', 'size'), weighted=('weighted', 'sum'), weight=('weight', 'sum'),
+    ).reindex(np.arange(len(cbs)))
+    # Blocks whose sidewalks are all degenerate have no weight to speak of
+    mean = (stats['weighted'] / stats['weight'].where(stats['weight'] > 0)).fillna(stats['score_unweighted'])
+    return pd.DataFrame({
+        'score_mean': mean.to_numpy(dtype=np.float32),
+        'score_min': stats['score_min'].to_numpy(dtype=np.float32),
+        'score_max': stats['score_max'].to_numpy(dtype=np.float32),
+        'sidewalk_count': stats['sidewalk_count'].fillna(0).to_numpy(dtype=np.int32),
+    })
+
+
+@dataclass(frozen=True)
+class Dataset:
+    """Immutable processed data shared read-only by every session
+
+    Frames are in WGS84 with normalized scores, packed into flat arrays that
+    worker processes memory-map from the shared store. Each frame is attached
+    the first time it is needed, and its geometry only becomes shapely objects
+    column by column as it is used. Consumers must not modify the frames or
+    arrays in place; copy them first.
+    """
+    # 'sidewalks', 'cbs', their coarse LOD geometries ('sidewalks-lod',
+    # 'cbs-lod'), the census block outlines at every level ('cbs-outlines')
+    # and the sidewalk score statistics per census block ('block-scores');
+    # LODs, outlines and statistics have rows aligned with their layer
+    frames: SharedFrames
+    deployments: tuple
+    version: str
+    build_seconds: float
+    built_at: float
+    # Frame keys of the version, when built from the source files
+    keys: dict = field(default=None, compare=False)
+    # Fingerprint of the deployments file the deployments were made from
+    deployments_key: str = field(default=None, compare=False)
+
+    @property
+    def score_by_sidewalk(self):
+        return self.frames.frame('sidewalks')
+
+    @property
+    def cbs(self):
+        return self.frames.frame('cbs')
+
+    @property
+    def block_scores(self):
+        return self.frames.frame('block-scores')
+
+    def frame(self, layer):
+        if layer == 'sidewalks':
+            return self.score_by_sidewalk
+        if layer in ('cbs', 'blocks'):
+            return self.cbs
+        raise KeyError(f"Unknown layer: {layer}")
+
+    def geometry_column(self, layer, level=None, outlines=False):
+        """(packed frame, geometry column name) holding a layer at an LOD level (the finest when None)
+
+        With outlines, census blocks are their outlines, see block_outlines.
+        """
+        if layer not in LOD_LAYERS:
+            raise KeyError(f"Unknown layer: {layer}")
+        if outlines and layer == 'cbs':
+            return self.frames.get('cbs-outlines'), f'lod{len(LOD_LEVELS) - 1 if level is None else level}'
+        name = 'cbs' if layer == 'blocks' else layer
+        if level is None or LOD_LEVELS[level][1] is None:
+            return self.frames.get(name), None
+        return self.frames.get(f'{name}-lod'), f'lod{level}'
+
+    def geometries(self, layer, level=None, rows=None, outlines=False):
+        """Geometry array of a layer at an LOD level (the finest when None)
+
+        Given rows (positions, a slice or a mask), only the geometries of
+        those rows are built, see PackedFrame.take. With outlines, census
+        blocks are their outlines. A whole column reuses the geometries the
+        dataset this one replaced built, for the rows that didn't change.
+        """
+        frame, name = self.geometry_column(layer, level, outlines)
+        if rows is not None:
+            return frame.take(rows, name)
+        reuse = None
+        if not frame.built(name):
+            previous, changed = carried_rows(self, layer)
+            if previous is not None and previous.geometry_column(layer, level, outlines)[0].built(name):
+                reuse = previous.geometries(layer, level, outlines=outlines), changed
+        return frame.geometry(name, reuse)
+
+    def feature_count(self, layer):
+        """Number of features of a layer, without building it"""
+        if layer == 'deployments':
+            return len(self.deployments)
+        return len(self.geometry_column(layer)[0])
+
+    def coordinate_counts(self, layer, level=None, outlines=False):
+        """Number of coordinates of every feature of a layer at an LOD level, read off the packed arrays"""
+        frame, name = self.geometry_column(layer, level, outlines)
+        return frame.num_coordinates(name)
+
+    def row_bounds(self, layer, level=None):
+        """WGS84 bounds (n, 4) of every feature of a layer at an LOD level, NaN for rows without geometry
+
+        Read off the packed arrays, see PackedFrame.bounds. Simplified levels
+        lie within the bounds of the finest one, which the default level is.
+        """
+        frame, name = self.geometry_column(layer, level)
+        return frame.bounds(name)
+
+    def scores(self, layer):
+        """Normalized score of every feature of a layer, or None for layers without scores"""
+        if layer == 'sidewalks':
+            return self.frames.get('sidewalks').column('score')
+        if layer == 'blocks':
+            return self.frames.get('block-scores').column('score_mean')
+        return None
+
+    def memory_bytes(self):
+        """Approximate memory held by the attached frames
+
+        Per frame, the memory-mapped arrays, whose pages every worker shares,
+        and the shapely geometries built from them, which are private to this
+        process.
+        """
+        memory = {}
+        for name, frame in self.frames.items():
+            memory[f"{name.replace('-', '_')}_shared"] = frame.mapped_bytes
+            memory[f"{name.replace('-', '_')}_private"] = frame.private_bytes
+        return memory
+
+    def bytes_per_feature(self):
+        """Memory per sidewalk of the sidewalk frames attached, shared and private, in total and per frame
+
+        The server always attaches the sidewalks and their LOD levels (see
+        warm_dataset), so both count. Private memory is that of the geometry
+        columns and row bounds built so far, see PackedFrame.private_bytes:
+        tiles and viewports only need the bounds, lookups and the geojson
+        transport whole columns.
+        """
+        count = max(len(self.frames.get('sidewalks')), 1)
+        frames = {name: frame for name, frame in self.frames.items() if name in ('sidewalks', 'sidewalks-lod')}
+        sizes = {'shared': 0.0, 'private': 0.0}
+        for name, frame in frames.items():
+            sizes[f"{name.replace('-', '_')}_shared"] = frame.mapped_bytes / count
+            sizes[f"{name.replace('-', '_')}_private"] = frame.private_bytes / count
+            sizes['shared'] += frame.mapped_bytes / count
+            sizes['private'] += frame.private_bytes / count
+        return sizes
+
+    def stats(self):
+        """Build time and memory footprint for logging and monitoring"""
+        memory = self.memory_bytes()
+        return {
+            'version': self.version,
+            'build_seconds': self.build_seconds,
+            'built_at': self.built_at,
+            'sidewalk_features': len(self.frames.get('sidewalks')),
+            'census_features': len(self.frames.get('cbs')) if self.frames.attached('cbs') else None,
+            'memory_bytes': memory,
+            'total_memory_bytes': sum(memory.values()),
+            'sidewalk_bytes_per_feature': self.bytes_per_feature(),
+        }
+
+
+def frame_keys():
+    """Cache key of every preprocessed frame, derived from the current source files"""
+    sidewalk_key = source_fingerprint([SIDEWALK_CSV], SIDEWALK_TOLERANCE)
+    census_key = source_fingerprint(census_sources(), CENSUS_TOLERANCE, BOROUGHS, CENSUS_BBOXES)
+    return {
+        'sidewalks': sidewalk_key,
+        'cbs': census_key,
+        'sidewalks-lod': source_fingerprint([], sidewalk_key, LOD_LEVELS),
+        'cbs-lod': source_fingerprint([], census_key, LOD_LEVELS),
+        'cbs-outlines': source_fingerprint([], census_key, LOD_LEVELS, OUTLINE_DECIMALS),
+        'block-scores': source_fingerprint([], sidewalk_key, census_key),
+    }
+
+
+def derived_frames():
+    """Build function of every frame derived from the sidewalks and census blocks
+
+    Each takes the SharedFrames holding the frames it derives from.
+    """
+    return {
+        'sidewalks-lod': lambda frames: simplify_levels(frames.frame('sidewalks')),
+        'cbs-lod': lambda frames: simplify_levels(frames.frame('cbs'), coverage=True),
+        'cbs-outlines': lambda frames: outline_levels(frames.frame('cbs'), frames.frame('cbs-lod')),
+        'block-scores': lambda frames: aggregate_block_scores(frames.frame('sidewalks'), frames.frame('cbs')),
+    }
+
+
+def frame_builders(keys, previous=None):
+    """Build function of every frame for the given frame keys, reading the Feather cache where possible
+
+    Each takes the SharedFrames being filled, to get at the frames it derives
+    from. Given the dataset previous, the sidewalks and their LOD levels are
+    rebuilt from its frames, only processing the segments that changed.
+    """
+    derived = derived_frames()
+
+    def sidewalks(frames):
+        if previous is None or previous.keys is None or previous.keys['sidewalks'] == keys['sidewalks']:
+            return preprocess_sidewalks()
+        return update_sidewalks(previous.frames.frame('sidewalks'))
+
+    def sidewalk_levels(frames):
+        if previous is None or previous.keys is None or previous.keys['sidewalks'] == keys['sidewalks']:
+            return derived['sidewalks-lod'](frames)
+        return update_levels(
+            previous.frames.frame('sidewalks-lod'), previous.frames.frame('sidewalks'), frames.frame('sidewalks'))
+
+    def cached(name, build, geo=True):
+        return lambda frames: cached_frame(name, keys[name], lambda: build(frames), geo=geo)
+
+    return {
+        'sidewalks': cached('sidewalks', sidewalks),
+        'sidewalks-lod': cached('sidewalks-lod', sidewalk_levels),
+        'cbs': cached('cbs', lambda frames: preprocess_census_blocks()),
+        'cbs-lod': cached('cbs-lod', derived['cbs-lod']),
+        'cbs-outlines': cached('cbs-outlines', derived['cbs-outlines']),
+        'block-scores': cached('block-scores', derived['block-scores'], geo=False),
+    }
+
+
+def dataset_version(keys):
+    return f"{keys['sidewalks']}-{keys['cbs']}"
+
+
+def record_memory(dataset):
+    for component, size in dataset.memory_bytes().items():
+        dataset_memory_bytes.set(size, component=component)
+    for component, size in dataset.bytes_per_feature().items():
+        sidewalk_bytes_per_feature.set(size, component=component)
+
+
+def write_keys(keys):
+    """Store the frame keys of a version beside its frames, so other workers can build the missing ones"""
+    keys_path = SHARED_DIR / dataset_version(keys) / "keys.json"
+    if not keys_path.exists():
+        keys_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = keys_path.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps(keys))
+        os.replace(tmp_path, keys_path)
+
+
+def build_dataset(version=None, read_only=False):
+    """Attach to the shared frames of a dataset version and freeze the result
+
+    Without a version, the one matching the current source files is used and
+    published, which switches every other worker to it. A given version is
+    attached as it is and never published; read-only, its missing frames
+    raise FileNotFoundError instead of being built. Frames are attached on
+    first use, so the deployments are available before any layer has been read.
+    """
+    start = time.perf_counter()
+    if version is None:
+        keys = frame_keys()
+        version = dataset_version(keys)
+        write_keys(keys)
+        if published_version(SHARED_DIR) != version:
+            publish_version(SHARED_DIR, version)
+    else:
+        keys = json.loads((SHARED_DIR / version / "keys.json").read_text())
+    frames = SharedFrames(frame_builders(keys), SHARED_DIR / version, read_only=read_only)
+    deployments_key, deployment_features = deployment_source()
+    return Dataset(
+        frames=frames,
+        deployments=tuple(deployment_features),
+        version=version,
+        build_seconds=time.perf_counter() - start,
+        built_at=time.time(),
+        keys=keys,
+        deployments_key=deployments_key,
+    )
+
+
+def aligned_sidewalks(old, new):
+    """The sidewalk frames of two versions if new's rows extend old's, as update_sidewalks makes them; else None"""
+    before, after = old.frames.get('sidewalks'), new.frames.get('sidewalks')
+    if SEGMENT_KEY not in before.arrays or SEGMENT_KEY not in after.arrays or len(after) < len(before):
+        return None
+    if not np.array_equal(before.column(SEGMENT_KEY), after.column(SEGMENT_KEY)[:len(before)]):
+        return None
+    return before, after
+
+
+def changed_geometries(old, new, layer):
+    """Sorted rows of a layer whose geometry differs between two dataset versions, or None if rows don't line up
+
+    Sidewalks are compared by the hash of their WKT; rows past the end of
+    old's are new. Census blocks are the same as long as their sources are.
+    """
+    if layer == 'sidewalks':
+        frames = aligned_sidewalks(old, new)
+        if frames is None:
+            return None
+        before, after = frames
+        length = len(before)
+        changed = before.column('wkt_hash') != after.column('wkt_hash')[:length]
+        return np.concatenate([np.flatnonzero(changed), np.arange(length, len(after))])
+    if layer not in ('cbs', 'blocks') or old.keys is None or new.keys is None or old.keys['cbs'] != new.keys['cbs']:
+        return None
+    return np.zeros(0, dtype=np.int64)
+
+
+def changed_rows(old, new, layer):
+    """Sorted rows of a layer whose geometry or score differ between two dataset versions
+
+    Sidewalk rows line up across versions rebuilt by update_sidewalks; rows
+    past the end of old's are new. Census rows line up as long as the blocks
+    are unchanged, and deployments as long as their file is. Returns None
+    when the rows of the two versions don't line up, so the layer has to be
+    replaced as a whole.
+    """
+    if layer == 'deployments':
+        if old.deployments_key is None or old.deployments_key != new.deployments_key:
+            return None
+        return np.zeros(0, dtype=np.int64)
+    if layer == 'sidewalks':
+        frames = aligned_sidewalks(old, new)
+        if frames is None:
+            return None
+        before, after = frames
+        length = len(before)
+        changed = before.column('wkt_hash') != after.column('wkt_hash')[:length]
+        changed |= differ(before.column('score'), after.column('score')[:length])
+        return np.concatenate([np.flatnonzero(changed), np.arange(length, len(after))])
+    if layer not in ('cbs', 'blocks') or old.keys is None or new.keys is None or old.keys['cbs'] != new.keys['cbs']:
+        return None
+    if layer == 'cbs':
+        return np.zeros(0, dtype=np.int64)
+    return np.flatnonzero(differ(old.scores('blocks'), new.scores('blocks')))
+
+
+def differ(before, after):
+    """Where two float arrays differ, NaN being equal to NaN"""
+    return (before != after) & ~(np.isnan(before) & np.isnan(after))
+
+
+_dataset = None
+_dataset_lock = threading.Lock()
+# The dataset the process served before _dataset, so what didn't change can be carried over from it
+_previous = None
+
+
+def previous_dataset(dataset):
+    """The dataset this process served before dataset, while dataset is the one it serves; else None"""
+    return _previous if dataset is _dataset else None
+
+
+def carried_rows(dataset, layer):
+    """(previous dataset, rows of layer whose geometry changed since) or (None, None)
+
+    Per-version state of the previous dataset can be reused for every other
+    row, see previous_dataset and changed_geometries.
+    """
+    previous = previous_dataset(dataset)
+    changed = changed_geometries(previous, dataset, layer) if previous is not None else None
+    return (previous, changed) if changed is not None else (None, None)
+
+
+def carried_entry(cache, key, dataset, layer):
+    """(the previous dataset's entry of a per-version cache, rows of layer changed since) or (None, None)
+
+    key gives the cache key of a dataset. An entry made of one item per row
+    can be brought up to date with carry_rows; with no rows changed, it
+    holds as it is.
+    """
+    previous, changed = carried_rows(dataset, layer)
+    entry = cache.get(key(previous)) if previous is not None else None
+    return (entry, changed) if entry is not None else (None, None)
+
+
+def get_dataset():
+    """Return the process-wide dataset, building it on first use
+
+    Concurrent callers block on the same build instead of starting their own.
+    Once another process publishes a new version, the next call switches to it.
+    """
+    global _dataset, _previous
+    published = published_version(SHARED_DIR)
+    if _dataset is None or (published is not None and published != _dataset.version):
+        with _dataset_lock:
+            if _dataset is None:
+                _dataset = build_dataset()
+            elif published is not None and published != _dataset.version:
+                logger.info("Switching from dataset version %s to %s", _dataset.version, published)
+                _previous, _dataset = _dataset, build_dataset(published)
+            else:
+                return _dataset
+            dataset_build_seconds.set(_dataset.build_seconds)
+            record_memory(_dataset)
+    return _dataset
+
+
+def refresh_memory_metrics():
+    """Bring the dataset memory gauges up to date, if the dataset has been built"""
+    if _dataset is not None:
+        record_memory(_dataset)
+
+
+def warm_dataset():
+    """Attach the sidewalk frames every session needs, building them if no worker has yet"""
+    dataset = get_dataset()
+    dataset.frames.get('sidewalks')
+    dataset.frames.get('sidewalks-lod')
+    record_memory(dataset)
+
+
+def preload_dataset():
+    """Start building the dataset in the background so the first visitor doesn't wait"""
+    thread = threading.Thread(target=warm_dataset, name="dataset-preload", daemon=True)
+    thread.start()
+    return thread
+
+
+def reload_dataset():
+    """Switch to the version matching the current source files, building it from the served one
+
+    The served dataset's frames are rebuilt incrementally (see
+    frame_builders) and attached before the version is published, so every
+    worker switches to a complete dataset. Workers noticing the same change
+    wait for the first one to build it, then switch to its version.
+    """
+    global _dataset, _previous
+    current = get_dataset()
+    keys = frame_keys()
+    version = dataset_version(keys)
+    if version == current.version:
+        return current
+    with store_lock(SHARED_DIR, 'reload'):
+        if published_version(SHARED_DIR) == version:
+            return get_dataset()
+        start = time.perf_counter()
+        write_keys(keys)
+        frames = SharedFrames(frame_builders(keys, current), SHARED_DIR / version)
+        # The frames the served dataset uses, so sessions don't wait for them once switched
+        for name in {'sidewalks', 'sidewalks-lod', *(name for name, _ in current.frames.items())}:
+            frames.get(name)
+        deployments_key, deployment_features = deployment_source()
+        dataset = Dataset(
+            frames=frames,
+            deployments=tuple(deployment_features),
+            version=version,
+            build_seconds=time.perf_counter() - start,
+            built_at=time.time(),
+            keys=keys,
+            deployments_key=deployments_key,
+        )
+        with _dataset_lock:
+            _previous, _dataset = current, dataset
+        publish_version(SHARED_DIR, version)
+    logger.info("Reloaded dataset version %s in %.1f s", version, dataset.build_seconds)
+    dataset_build_seconds.set(dataset.build_seconds)
+    record_memory(dataset)
+    return dataset
+
+
+def watch_sources(interval=WATCH_INTERVAL):
+    """Start a thread reloading the dataset whenever its source files change; None when interval is 0
+
+    A change is only picked up once the files have stayed the same for a
+    whole interval, so a file still being written isn't read halfway.
+    """
+    if interval <= 0:
+        return None
+
+    def watch():
+        pending = None
+        while True:
+            time.sleep(interval)
+            try:
+                version = dataset_version(frame_keys())
+                if _dataset is None or version == _dataset.version:
+                    pending = None
+                elif version == pending:
+                    reload_dataset()
+                else:
+                    pending = version
+            except Exception:
+                logger.exception("Reloading the dataset failed")
+
+    thread = threading.Thread(target=watch, name="dataset-watch", daemon=True)
+    thread.start()
+    return thread
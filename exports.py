@@ -0,0 +1,62 @@
+import gzip
+import hashlib
+
+from cache import BoundedCache
+from payloads import layer_payload
+
+# Files the Astro front end fetches from /data, and the dataset layer behind each
+EXPORTS = {
+    'sidewalks.geojson': 'sidewalks',
+    'census.geojson': 'cbs',
+}
+GEOJSON_MEDIA_TYPE = 'application/geo+json'
+
+# Content codings in order of preference when a client accepts several equally
+EXPORT_ENCODINGS = ('br', 'gzip', 'identity')
+GZIP_LEVEL = 9
+# Brotli 10 and 11 take an order of magnitude longer for a few percent on GeoJSON
+BROTLI_QUALITY = 9
+
+# Precompressed representations of every export, per (dataset version, file name)
+export_cache = BoundedCache(
+    'exports', max_entries=2 * len(EXPORTS), max_bytes=1 << 30,
+    sizeof=lambda export: sum(len(body) for body in export[1].values()),
+)
+
+
+def compress(content, encoding):
+    """content in the given content coding, or None when that coding is unavailable"""
+    if encoding == 'gzip':
+        # A fixed mtime keeps the bytes, and so the ETag, identical across rebuilds
+        return gzip.compress(content, GZIP_LEVEL, mtime=0)
+    if encoding == 'br':
+        try:
+            import brotli
+        except ImportError:
+            return None
+        return brotli.compress(content, quality=BROTLI_QUALITY)
+    return content
+
+
+def build_export(dataset, name):
+    content = layer_payload(dataset, EXPORTS[name])
+    digest = hashlib.sha256(content).hexdigest()[:32]
+    variants = {}
+    for encoding in EXPORT_ENCODINGS:
+        body = compress(content, encoding)
+        # Compressing a tiny file can grow it; only keep codings that pay off
+        if body is not None and (encoding == 'identity' or len(body) < len(content)):
+            variants[encoding] = body
+    return digest, variants
+
+
+def export_variants(dataset, name):
+    """(content digest, {content coding: body}) of an export, compressed once per dataset version"""
+    return export_cache.get_or_build((dataset.version, name), lambda: build_export(dataset, name))
+
+
+def variant_etag(digest, encoding):
+    """Strong ETag of one representation; every content coding needs its own"""
+    if encoding == 'identity':
+        return f'"{digest}"'
+    return f'"{digest}-{encoding}"'
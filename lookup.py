@@ -0,0 +1,90 @@
+import os
+import time
+
+import numpy as np
+import shapely
+from pyproj import CRS, Transformer
+
+from cache import BoundedCache
+from dataset import PROJ, WGS, carried_entry
+from metrics import lookup_points, lookup_throughput, timed
+from shared import carry_rows
+
+# Most points answered by one lookup
+MAX_LOOKUP_POINTS = 1_000_000
+# Points queried at a time, bounding the shapely objects alive during a lookup
+LOOKUP_BATCH = 65536
+# Points farther than this from every sidewalk, in meters, get no score
+LOOKUP_MAX_DISTANCE = float(os.environ.get("ROBOTABILITY_LOOKUP_MAX_DISTANCE", "15"))
+# Lookup distances are measured in PROJ, whose unit (US survey feet) is this many meters
+METERS_PER_UNIT = CRS(PROJ).axis_info[0].unit_conversion_factor
+
+# STRtrees over the sidewalks projected to PROJ, per dataset version
+lookup_cache = BoundedCache('lookup_indexes', max_entries=2, sizeof=lambda _: 0)
+
+
+def sidewalk_tree(dataset):
+    """STRtree over the sidewalk geometries in PROJ, built once per dataset version
+
+    The sidewalks are kept in WGS84 for the browser; they are projected back
+    with one transformer call over all their coordinates. Only the sidewalks
+    that changed since the previous dataset are projected again.
+    """
+    transformer = Transformer.from_crs(WGS, PROJ, always_xy=True)
+
+    def project(geometries):
+        return shapely.transform(
+            geometries, lambda coords: np.column_stack(transformer.transform(coords[:, 0], coords[:, 1])))
+
+    def build():
+        tree, changed = carried_entry(lookup_cache, lambda data: data.version, dataset, 'sidewalks')
+        if tree is None:
+            return shapely.STRtree(project(dataset.geometries('sidewalks')))
+        if len(changed) == 0:
+            return tree
+        return shapely.STRtree(carry_rows(
+            tree.geometries, changed, dataset.feature_count('sidewalks'),
+            lambda rows: project(dataset.geometries('sidewalks', rows=rows))))
+    return lookup_cache.get_or_build(dataset.version, build)
+
+
+def nearest_sidewalks(dataset, lons, lats, max_distance=LOOKUP_MAX_DISTANCE):
+    """Score of, distance to and row of the nearest sidewalk of every WGS84 point
+
+    Returns three arrays aligned with the points: the normalized score and
+    the distance in meters, both NaN, and the sidewalk row, -1, where no
+    sidewalk lies within max_distance meters (or the point isn't a valid
+    coordinate). Raises ValueError on mismatched or too many points.
+    """
+    lons = np.asarray(lons, dtype=np.float64)
+    lats = np.asarray(lats, dtype=np.float64)
+    if lons.ndim != 1 or lons.shape != lats.shape:
+        raise ValueError("lons and lats must be 1-d arrays of the same length")
+    if len(lons) > MAX_LOOKUP_POINTS:
+        raise ValueError(f"At most {MAX_LOOKUP_POINTS:,} points can be looked up at once, got {len(lons):,}")
+
+    tree = sidewalk_tree(dataset)
+    sidewalk_scores = dataset.scores('sidewalks')
+    transformer = Transformer.from_crs(WGS, PROJ, always_xy=True)
+    scores = np.full(len(lons), np.nan)
+    nearest = np.full(len(lons), np.nan)
+    sidewalks = np.full(len(lons), -1, dtype=np.int64)
+    start = time.perf_counter()
+    with timed('lookup'):
+        x, y = transformer.transform(lons, lats)
+        valid = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+        # Points are queried a batch at a time so their shapely objects stay few
+        for first in range(0, len(valid), LOOKUP_BATCH):
+            batch = valid[first:first + LOOKUP_BATCH]
+            (inputs, rows), distances = tree.query_nearest(
+                shapely.points(x[batch], y[batch]), max_distance=max_distance / METERS_PER_UNIT,
+                return_distance=True, all_matches=False)
+            inputs = batch[inputs]
+            scores[inputs] = sidewalk_scores[rows]
+            nearest[inputs] = distances * METERS_PER_UNIT
+            sidewalks[inputs] = rows
+    elapsed = time.perf_counter() - start
+    lookup_points.inc(len(lons))
+    if elapsed > 0:
+        lookup_throughput.set(len(lons) / elapsed)
+    return scores, nearest, sidewalks
@@ -0,0 +1,206 @@
+import functools
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from cache import CACHES
+
+# Steps slower than this many seconds are logged; unset or empty disables the slow-path log
+SLOW_STEP_SECONDS = float(os.environ.get("ROBOTABILITY_SLOW_STEP_SECONDS") or "inf")
+
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Powers of four from 1 KiB to 1 GiB
+SIZE_BUCKETS = tuple(float(1 << shift) for shift in range(10, 31, 2))
+
+METRICS_MEDIA_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+logger = logging.getLogger(__name__)
+
+# Every metric created in the process, in creation order, so they can be rendered
+METRICS = []
+
+
+def label_text(names, values):
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+class Metric:
+    """A named family of samples keyed by label values, rendered in the Prometheus text format"""
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, self.labels, key, value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, values, value in self.samples():
+            lines.append(f"{name}{label_text(labels, values)} {value!r}")
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self._lock:
+            # Per-bucket counts (not cumulative), then the sum and count of observations
+            state = self._values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts), total, count) for key, (counts, total, count) in self._values.items()]
+        samples = []
+        bucket_labels = self.labels + ('le',)
+        for key, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append((f"{self.name}_bucket", bucket_labels, key + (repr(bound),), cumulative))
+            samples.append((f"{self.name}_bucket", bucket_labels, key + ('+Inf',), count))
+            samples.append((f"{self.name}_sum", self.labels, key, total))
+            samples.append((f"{self.name}_count", self.labels, key, count))
+        return samples
+
+
+step_seconds = Histogram(
+    'robotability_step_seconds', "Duration of server steps, such as reactive effects and encodes", ('step', 'layer'))
+slow_steps = Counter(
+    'robotability_slow_steps_total', "Steps that took longer than the slow-path threshold", ('step', 'layer'))
+message_bytes = Histogram(
+    'robotability_message_bytes', "Size of the messages sent to the browser", ('type', 'layer'), SIZE_BUCKETS)
+active_sessions = Gauge('robotability_active_sessions', "Connected map sessions")
+active_sessions.set(0)
+dataset_memory_bytes = Gauge(
+    'robotability_dataset_memory_bytes', "Approximate memory held by the shared dataset", ('component',))
+sidewalk_bytes_per_feature = Gauge(
+    'robotability_sidewalk_bytes_per_feature', "Memory per sidewalk of the sidewalk frames", ('component',))
+dataset_build_seconds = Gauge('robotability_dataset_build_seconds', "Time the shared dataset took to build")
+lookup_points = Counter('robotability_lookup_points_total', "Points looked up on the nearest sidewalk")
+lookup_throughput = Gauge(
+    'robotability_lookup_points_per_second', "Points per second of the most recent sidewalk lookup")
+
+
+@contextmanager
+def timed(step, layer=''):
+    """Record the duration of the enclosed block, logging it when it exceeds SLOW_STEP_SECONDS"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        step_seconds.observe(elapsed, step=step, layer=layer)
+        if elapsed > SLOW_STEP_SECONDS:
+            slow_steps.inc(step=step, layer=layer)
+            logger.warning("Slow step %s%s took %.3f s", step, f" ({layer})" if layer else '', elapsed)
+
+
+def timed_async(step):
+    """Decorator recording the duration of every call of a coroutine function under step"""
+    def decorate(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            with timed(step):
+                return await function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def resident_memory_bytes():
+    """Current resident set size of the process, or its peak where that can't be read"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def process_lines():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return [
+        "# HELP process_resident_memory_bytes Resident memory size in bytes.",
+        "# TYPE process_resident_memory_bytes gauge",
+        f"process_resident_memory_bytes {resident_memory_bytes()}",
+        "# HELP process_cpu_seconds_total Total user and system CPU time spent in seconds.",
+        "# TYPE process_cpu_seconds_total counter",
+        f"process_cpu_seconds_total {usage.ru_utime + usage.ru_stime!r}",
+    ]
+
+
+def cache_lines():
+    stats = {name: cache.stats() for name, cache in CACHES.items()}
+    lines = []
+    for field, kind, help in (
+        ('hits', 'counter', "Cache lookups that found an entry"),
+        ('misses', 'counter', "Cache lookups that had to build the entry"),
+        ('entries', 'gauge', "Entries held by the cache"),
+        ('bytes', 'gauge', "Approximate bytes held by the cache"),
+    ):
+        name = f"robotability_cache_{field}" + ('_total' if kind == 'counter' else '')
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+        lines += [f"{name}{label_text(('cache',), (cache,))} {values[field]}" for cache, values in stats.items()]
+    return lines
+
+
+def render_metrics():
+    """Every metric of the process in the Prometheus text exposition format"""
+    lines = process_lines() + cache_lines()
+    for metric in METRICS:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,76 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Superseded(Exception):
+    """Raised by a job's send once the job was stopped or started again"""
+
+
+class Outbox:
+    """Sends one session's messages from named background jobs
+
+    Shiny runs the effects of every session one after another, so an effect
+    awaiting a slow client's socket would hold up every other session.
+    Effects start jobs here instead and return at once. Each send waits for
+    the client to take the previous message, which only holds up the jobs of
+    this session, and sends of different jobs never interleave.
+
+    Starting a job stops the running job of the same name: its next send
+    raises Superseded, which ends it quietly. The new job only starts once
+    the old one has ended, so two jobs of a name never run side by side.
+    """
+
+    def __init__(self, send):
+        self._send = send
+        self._lock = asyncio.Lock()
+        self._jobs = {}
+
+    def running(self, name):
+        task = self._jobs.get(name)
+        return task is not None and not task.done()
+
+    def start(self, name, job, *args, after=()):
+        """Run job(send, *args) in the background, once the running jobs named in after are done
+
+        send(type, body, layer='') sends a custom message whose body is
+        JSON-encoded bytes.
+        """
+        task = None
+        replaced = self._jobs.get(name)
+
+        async def send(type, body, layer=''):
+            async with self._lock:
+                if self._jobs.get(name) is not task:
+                    raise Superseded(name)
+                await self._send(type, body, layer)
+
+        async def run():
+            try:
+                if replaced is not None and not replaced.done():
+                    await asyncio.wait([replaced])
+                # In order, so jobs started by the earlier ones are waited for too
+                for other in after:
+                    if other != name and self.running(other):
+                        await asyncio.wait([self._jobs[other]])
+                await job(send, *args)
+            except Superseded:
+                pass
+            except Exception:
+                logger.exception("Message job %s failed", name)
+            finally:
+                if self._jobs.get(name) is task:
+                    del self._jobs[name]
+
+        task = asyncio.get_running_loop().create_task(run())
+        self._jobs[name] = task
+        return task
+
+    def stop(self, name):
+        """Stop the job called name before its next send"""
+        self._jobs.pop(name, None)
+
+    def close(self):
+        """Stop every job, when the session ends"""
+        self._jobs.clear()
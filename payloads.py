@@ -0,0 +1,461 @@
+import json
+import math
+import os
+import struct
+import time
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from cache import BoundedCache
+from classify import CLASSIFICATION, score_classes, updated_rows
+from dataset import CENSUS_TOLERANCE, LOD_LEVELS, SIDEWALK_TOLERANCE
+from tiles import TILE_LAYERS, tile_source
+from viewport import VIEWPORT_LAYERS, intersecting_rows
+
+# Simplification each layer was preprocessed with
+LAYER_TOLERANCES = {
+    'sidewalks': SIDEWALK_TOLERANCE,
+    'cbs': CENSUS_TOLERANCE,
+    'blocks': CENSUS_TOLERANCE,
+    'deployments': None,
+}
+
+# How layer data reaches the browser: inline GeoJSON, vector tiles, typed-array blobs,
+# GeoJSON sent incrementally for the area in view, or inline quantized deltas
+TRANSPORTS = ('geojson', 'tiles', 'binary', 'viewport', 'quantized')
+BINARY_LAYERS = ('sidewalks', 'cbs', 'blocks')
+QUANTIZED_LAYERS = ('sidewalks', 'cbs', 'blocks', 'deployments')
+
+# Quantization grid of the quantized encoding, in degrees: about 10 cm at NYC's latitude
+QUANTIZE_GRID = 1e-6
+# Scores are quantized to integer thousandths
+SCORE_SCALE = 1000
+
+# Binary layer blob: magic, polygon/ring/position counts, section flags, triangle
+# index count, then the float64 lon/lat origin the float32 positions are offsets from
+BINARY_MAGIC = b'RBL2'
+BINARY_HEADER = struct.Struct('<4sIIIII2d')
+BINARY_HAS_SCORES = 1
+BINARY_HAS_CLASSES = 2
+
+# Inline GeoJSON layers are streamed as chunks of about this many coordinates
+# (some 60 bytes each once encoded); a chunk holds at least one feature
+STREAM_CHUNK_COORDINATES = int(os.environ.get("ROBOTABILITY_STREAM_CHUNK_COORDINATES", 25000))
+STREAMED_LAYERS = ('sidewalks', 'cbs', 'blocks')
+
+# Layers whose GeoJSON carries outlines rather than polygons: census blocks are drawn
+# unfilled, so every edge two blocks share is sent once, see dataset.block_outlines
+OUTLINED_LAYERS = ('cbs',)
+
+# Transports whose browser copy of a layer holds one GeoJSON feature per row, so a new
+# dataset version can be sent as the features that changed. Binary and quantized layers
+# are single blobs of split polygons the browser can't patch, so they are sent again;
+# tiled layers are fetched again only for the tiles in view, see tiles.carried_tile
+DIFF_TRANSPORTS = ('geojson', 'viewport')
+# Past this share of the features held, a layer is sent again rather than diffed
+DIFF_MAX_FRACTION = 0.5
+# Changed features per updateFeatures message
+DIFF_CHUNK_ROWS = 5000
+
+# Encoded WGS84 layer payloads, keyed by (dataset version, layer, simplification, filter, encoding)
+# where simplification is the tolerance of the LOD level served
+layer_cache = BoundedCache('layer_payloads', max_entries=32, max_bytes=1 << 30)
+# Row boundaries of the streamed chunks per (dataset version, layer, LOD level), and the
+# encoded chunks per (dataset version, layer, simplification, first row)
+chunk_bounds_cache = BoundedCache('chunk_bounds', max_entries=32, sizeof=lambda bounds: bounds.nbytes)
+chunk_cache = BoundedCache('layer_chunks', max_entries=4096, max_bytes=512 << 20)
+
+
+def json_number(value):
+    """JSON text for a float, mapping NaN and infinities to null"""
+    return repr(value) if math.isfinite(value) else 'null'
+
+
+def feature_collection_bytes(geometries, scores=None, classes=None):
+    """Encode geometries (and optional scores and color classes) as a GeoJSON FeatureCollection
+
+    Geometry JSON is produced by shapely's vectorized encoder; the only
+    per-feature Python work left is string concatenation.
+    """
+    geometry_json = shapely.to_geojson(geometries)
+    if scores is None:
+        features = [
+            '{"type":"Feature","geometry":%s,"properties":{}}' % (g or 'null')
+            for g in geometry_json
+        ]
+    elif classes is None:
+        features = [
+            '{"type":"Feature","geometry":%s,"properties":{"score":%s}}' % (g or 'null', json_number(s))
+            for g, s in zip(geometry_json, scores.tolist())
+        ]
+    else:
+        features = [
+            '{"type":"Feature","geometry":%s,"properties":{"score":%s,"class":%d}}' % (g or 'null', json_number(s), c)
+            for g, s, c in zip(geometry_json, scores.tolist(), classes.tolist())
+        ]
+    return ('{"type":"FeatureCollection","features":[' + ','.join(features) + ']}').encode()
+
+
+def json_object(members):
+    """Assemble a JSON object from already-encoded member values"""
+    return b'{' + b','.join(json.dumps(name).encode() + b':' + value for name, value in members.items()) + b'}'
+
+
+def simplification(layer, level=None):
+    """Tolerance the geometry of a layer was simplified with at an LOD level"""
+    if level is not None and LOD_LEVELS[level][1] is not None:
+        return LOD_LEVELS[level][1]
+    return LAYER_TOLERANCES[layer]
+
+
+def bbox_rows(dataset, layer, bbox):
+    """Sorted row positions of a layer intersecting bbox = (minx, miny, maxx, maxy)"""
+    return intersecting_rows(dataset, layer, bbox)[0]
+
+
+def layer_scores(dataset, layer):
+    return dataset.scores(layer)
+
+
+def rows_payload(dataset, layer, rows=None, level=None):
+    """GeoJSON bytes for the given row positions (all rows when None) of a layer, not cached
+
+    Only the geometries of the rows encoded are built.
+    """
+    geometries = dataset.geometries(layer, level, rows, outlines=layer in OUTLINED_LAYERS)
+    scores = layer_scores(dataset, layer)
+    classes = score_classes(dataset, layer)
+    if rows is not None:
+        scores = scores[rows] if scores is not None else None
+        classes = classes[rows] if classes is not None else None
+    return feature_collection_bytes(geometries, scores, classes)
+
+
+def build_layer_payload(dataset, layer, bbox=None, level=None):
+    if layer == 'deployments':
+        return json.dumps(list(dataset.deployments)).encode()
+    rows = bbox_rows(dataset, layer, bbox) if bbox is not None else None
+    return rows_payload(dataset, layer, rows, level)
+
+
+def layer_payload(dataset, layer, bbox=None, level=None):
+    """Pre-encoded JSON bytes for one layer of the dataset, built once and cached
+
+    Sidewalks and census blocks are served at the given LOD level, the finest
+    when None, optionally restricted to the features intersecting bbox.
+    """
+    key = (dataset.version, layer, simplification(layer, level), bbox, 'geojson')
+    return layer_cache.get_or_build(key, lambda: build_layer_payload(dataset, layer, bbox, level))
+
+
+def polygon_buffers(geometries):
+    """Flatten polygonal geometries into coordinate and offset arrays
+
+    Multi-part geometries are split into one polygon per part and
+    non-polygonal parts are dropped. Returns the polygons, their (n, 2) float64
+    coordinates, the polygon each vertex belongs to, the start vertex of every
+    polygon and every ring (each with a trailing end offset), and the index of
+    the source geometry of every polygon.
+    """
+    parts, part_source = shapely.get_parts(geometries, return_index=True)
+    keep = (shapely.get_type_id(parts) == 3) & ~shapely.is_empty(parts)
+    parts, part_source = parts[keep], part_source[keep]
+
+    rings, ring_part = shapely.get_rings(parts, return_index=True)
+    coords, coord_ring = shapely.get_coordinates(rings, return_index=True)
+
+    ring_starts = np.zeros(len(rings) + 1, dtype=np.uint32)
+    np.cumsum(np.bincount(coord_ring, minlength=len(rings)), out=ring_starts[1:])
+    part_ring_starts = np.zeros(len(parts) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(ring_part, minlength=len(parts)), out=part_ring_starts[1:])
+    polygon_starts = ring_starts[part_ring_starts]
+    return parts, coords, ring_part[coord_ring], polygon_starts, ring_starts, part_source
+
+
+def safe_triangulate(polygon):
+    try:
+        return shapely.constrained_delaunay_triangles(polygon)
+    except shapely.errors.GEOSException:
+        return shapely.GeometryCollection()
+
+
+def triangle_indices(parts, coords, vertex_part):
+    """Vertex indices of a triangulation of every polygon, holes respected
+
+    deck.gl cannot tessellate flat binary polygons with holes by itself, so the
+    triangles are computed here with GEOS and mapped back onto the vertex
+    buffer. Returns None when shapely is too old to triangulate.
+    """
+    if not hasattr(shapely, 'constrained_delaunay_triangles'):
+        return None
+    try:
+        triangulated = shapely.constrained_delaunay_triangles(parts)
+    except shapely.errors.GEOSException:
+        # One degenerate polygon fails the whole batch; retry one by one and
+        # leave the failures untriangulated
+        triangulated = np.array([safe_triangulate(part) for part in parts], dtype=object)
+    triangles, triangle_part = shapely.get_parts(triangulated, return_index=True)
+    # Triangles are closed rings of four coordinates; the last repeats the first
+    corners = shapely.get_coordinates(triangles).reshape(-1, 4, 2)[:, :3].reshape(-1, 2)
+    vertices = pd.DataFrame({
+        'part': vertex_part, 'x': coords[:, 0], 'y': coords[:, 1], 'index': np.arange(len(coords)),
+    }).drop_duplicates(['part', 'x', 'y'])
+    lookup = pd.DataFrame({
+        'part': np.repeat(triangle_part, 3), 'x': corners[:, 0], 'y': corners[:, 1],
+    }).merge(vertices, how='left', on=['part', 'x', 'y'])
+    indices = lookup['index'].to_numpy(dtype='float64').reshape(-1, 3)
+    return indices[~np.isnan(indices).any(axis=1)].astype(np.uint32).ravel()
+
+
+def binary_layer_bytes(geometries, scores=None, classes=None):
+    """Encode polygons as one little-endian typed-array blob for deck.gl binary mode
+
+    Positions are float32 offsets from a float64 origin, which keeps them well
+    under a centimeter of precision. The sections after the header are the
+    positions, the polygon and ring start indices and triangle vertex indices
+    (uint32) and, if given, one float32 score and one uint8 color class per
+    polygon.
+    """
+    parts, coords, vertex_part, polygon_starts, ring_starts, part_source = polygon_buffers(geometries)
+    triangles = triangle_indices(parts, coords, vertex_part)
+    if triangles is None:
+        triangles = np.zeros(0, dtype=np.uint32)
+    origin = coords.min(axis=0) if len(coords) else np.zeros(2)
+    positions = (coords - origin).astype('<f4')
+    sections = [
+        BINARY_HEADER.pack(
+            BINARY_MAGIC, len(polygon_starts) - 1, len(ring_starts) - 1, len(coords),
+            (BINARY_HAS_SCORES if scores is not None else 0) | (BINARY_HAS_CLASSES if classes is not None else 0),
+            len(triangles), *origin,
+        ),
+        positions.tobytes(),
+        polygon_starts.astype('<u4').tobytes(),
+        ring_starts.astype('<u4').tobytes(),
+        triangles.astype('<u4').tobytes(),
+    ]
+    if scores is not None:
+        sections.append(np.asarray(scores, dtype='<f4')[part_source].tobytes())
+    if classes is not None:
+        sections.append(np.asarray(classes, dtype=np.uint8)[part_source].tobytes())
+    return b''.join(sections)
+
+
+def build_binary_payload(dataset, layer, level=None):
+    if layer not in BINARY_LAYERS:
+        raise KeyError(f"No binary encoding for layer: {layer}")
+    return binary_layer_bytes(
+        dataset.geometries(layer, level), layer_scores(dataset, layer), score_classes(dataset, layer))
+
+
+def binary_payload(dataset, layer, level=None):
+    """Typed-array blob for one layer of the dataset at an LOD level, built once and cached"""
+    key = (dataset.version, layer, simplification(layer, level), None, 'binary')
+    return layer_cache.get_or_build(key, lambda: build_binary_payload(dataset, layer, level))
+
+
+def binary_source(dataset, layer, level=None):
+    """Descriptor pointing the client at the binary blob of a layer, at a path build.py writes it to as well"""
+    path = f"layers/{layer}.bin" if level is None else f"layers/{layer}/lod{level}.bin"
+    return {"binary": f"{path}?v={dataset.version}&classes={CLASSIFICATION}"}
+
+
+def int_list(values):
+    """Compact JSON text for an integer array"""
+    return '[' + ','.join(map(str, values.tolist())) + ']'
+
+
+def quantized_layer_bytes(geometries, scores=None, properties=None, grid=QUANTIZE_GRID, classes=None):
+    """Encode polygons as JSON with integer, delta-encoded coordinates
+
+    Coordinates are snapped to a grid of the given size in degrees and each
+    vertex is stored as the integer step from the previous one, which is a
+    few characters instead of a 17-digit float. Rings are closed and listed
+    polygon by polygon, so the deltas run along each ring. The members are:
+
+    - scale, origin: positions are origin + cumulative sum of deltas / scale
+    - positions: interleaved x/y deltas
+    - rings: vertex count of every ring
+    - polygons: ring count of every polygon
+    - triangles, triangleCounts: triangle vertex indices relative to their
+      polygon's first vertex, and how many indices each polygon has
+    - scores (optional): one score per polygon in thousandths, -1 if missing
+    - classes (optional): one color class per polygon
+    - properties (optional): one property object per polygon
+    """
+    parts, coords, vertex_part, polygon_starts, ring_starts, part_source = polygon_buffers(geometries)
+    scale = 1 / grid
+    origin = np.floor(coords.min(axis=0) * scale) / scale if len(coords) else np.zeros(2)
+    steps = np.rint((coords - origin) * scale).astype(np.int64)
+    deltas = np.diff(steps, axis=0, prepend=np.zeros((1, 2), dtype=np.int64))
+
+    triangles = triangle_indices(parts, coords, vertex_part)
+    if triangles is None:
+        triangles = np.zeros(0, dtype=np.int64)
+    triangle_part = vertex_part[triangles[::3]]
+    relative_triangles = triangles.astype(np.int64) - np.repeat(polygon_starts[triangle_part], 3)
+    triangle_counts = np.bincount(triangle_part, minlength=len(parts)) * 3
+
+    members = {
+        'scale': json.dumps(scale).encode(),
+        'origin': json.dumps(origin.tolist()).encode(),
+        'positions': int_list(deltas.ravel()).encode(),
+        'rings': int_list(np.diff(ring_starts.astype(np.int64))).encode(),
+        'polygons': int_list(np.bincount(vertex_part[ring_starts[:-1]], minlength=len(parts))).encode(),
+        'triangles': int_list(relative_triangles).encode(),
+        'triangleCounts': int_list(triangle_counts).encode(),
+    }
+    if scores is not None:
+        quantized = np.asarray(scores, dtype=np.float64)[part_source] * SCORE_SCALE
+        members['scores'] = int_list(np.where(np.isnan(quantized), -1, np.rint(quantized)).astype(np.int64)).encode()
+    if classes is not None:
+        members['classes'] = int_list(np.asarray(classes)[part_source]).encode()
+    if properties is not None:
+        members['properties'] = json.dumps([properties[i] for i in part_source]).encode()
+    return json_object({'quantized': json_object(members)})
+
+
+def deployment_geometries(dataset):
+    """Deployment features as a geometry array and a property list"""
+    features = dataset.deployments
+    geometries = shapely.from_geojson([json.dumps(f['geometry']) for f in features])
+    return geometries, [f['properties'] for f in features]
+
+
+def build_quantized_payload(dataset, layer, level=None):
+    if layer == 'deployments':
+        geometries, properties = deployment_geometries(dataset)
+        return quantized_layer_bytes(geometries, properties=properties)
+    if layer not in QUANTIZED_LAYERS:
+        raise KeyError(f"No quantized encoding for layer: {layer}")
+    return quantized_layer_bytes(
+        dataset.geometries(layer, level), layer_scores(dataset, layer), classes=score_classes(dataset, layer))
+
+
+def quantized_payload(dataset, layer, level=None):
+    """Quantized JSON bytes for one layer of the dataset at an LOD level, built once and cached"""
+    key = (dataset.version, layer, simplification(layer, level), None, 'quantized')
+    return layer_cache.get_or_build(key, lambda: build_quantized_payload(dataset, layer, level))
+
+
+def encoding_report(dataset, level=None):
+    """Payload size and encode time of the GeoJSON and quantized encodings, per layer"""
+    report = {}
+    for layer in QUANTIZED_LAYERS:
+        row = {}
+        for name, build in (('geojson', build_layer_payload), ('quantized', build_quantized_payload)):
+            start = time.perf_counter()
+            payload = build(dataset, layer, level=level)
+            row[f'{name}_seconds'] = time.perf_counter() - start
+            row[f'{name}_bytes'] = len(payload)
+        row['size_ratio'] = row['quantized_bytes'] / row['geojson_bytes']
+        report[layer] = row
+    return report
+
+
+def encoded_layer(dataset, layer, transport='geojson', level=None):
+    """JSON bytes describing one layer for the client in the given transport
+
+    Tiled and binary layers only ship a URL; the browser fetches the features
+    over HTTP, either per tile in view or as one typed-array blob. Viewport
+    layers start empty and are filled as the browser reports what it shows.
+    Inline, binary and quantized layers are served at the given LOD level.
+    """
+    if transport == 'tiles' and layer in TILE_LAYERS:
+        return json.dumps(tile_source(dataset, layer)).encode()
+    if transport == 'binary' and layer in BINARY_LAYERS:
+        return json.dumps(binary_source(dataset, layer, level)).encode()
+    if transport == 'viewport' and layer in VIEWPORT_LAYERS:
+        return feature_collection_bytes([])
+    if transport == 'quantized' and layer in QUANTIZED_LAYERS:
+        return quantized_payload(dataset, layer, level)
+    return layer_payload(dataset, layer, level=level)
+
+
+def layer_message(dataset, layer, transport='geojson', level=None):
+    """Body of the addLayer message that hands one layer to the browser"""
+    return json_object({"id": json.dumps(layer).encode(), "data": encoded_layer(dataset, layer, transport, level)})
+
+
+def chunk_bounds(dataset, layer, level=None, budget=STREAM_CHUNK_COORDINATES):
+    """Row positions splitting a layer into chunks of at most budget coordinates, or one feature"""
+    def build():
+        ends = np.cumsum(dataset.coordinate_counts(layer, level, outlines=layer in OUTLINED_LAYERS))
+        bounds = [0]
+        while bounds[-1] < len(ends):
+            start = bounds[-1]
+            limit = (ends[start - 1] if start else 0) + budget
+            bounds.append(max(int(np.searchsorted(ends, limit, side='right')), start + 1))
+        # An empty layer is still one (empty) chunk
+        return np.array(bounds if len(bounds) > 1 else [0, 0])
+    return chunk_bounds_cache.get_or_build((dataset.version, layer, level), build)
+
+
+def chunk_payload(dataset, layer, start, stop, level=None):
+    """GeoJSON bytes of rows start:stop of a layer, built once and cached"""
+    key = (dataset.version, layer, simplification(layer, level), start)
+    return chunk_cache.get_or_build(key, lambda: rows_payload(dataset, layer, slice(start, stop), level))
+
+
+def layer_messages(dataset, layer, transport='geojson', level=None):
+    """(type, body) of the messages handing one layer to the browser, encoded as they are iterated
+
+    Inline GeoJSON layers are streamed: an addLayer holding the first chunk,
+    then appendFeatures messages with the others, so the browser draws the
+    layer as it arrives and no message grows with the layer. Every other
+    layer is a single addLayer.
+    """
+    if transport != 'geojson' or layer not in STREAMED_LAYERS:
+        yield 'addLayer', layer_message(dataset, layer, transport, level)
+        return
+    name = json.dumps(layer).encode()
+    bounds = chunk_bounds(dataset, layer, level)
+    for i, (start, stop) in enumerate(zip(bounds[:-1].tolist(), bounds[1:].tolist())):
+        body = json_object({"id": name, "data": chunk_payload(dataset, layer, start, stop, level)})
+        yield ('appendFeatures' if i else 'addLayer'), body
+
+
+def diff_messages(old, new, layer, level=None, positions=None):
+    """Bodies of the updateFeatures messages bringing a browser's copy of a layer from dataset old to new
+
+    The browser holds one feature per row of old's layer, in row order, or
+    where positions maps a row to its feature (-1 for rows it lacks). Each
+    message replaces the features at the given positions, appending at the
+    end for new rows. Rows whose color class moved are included. Returns
+    None when the layer has to be sent again instead: its rows don't line
+    up across the versions or too many of them changed.
+    """
+    rows = updated_rows(old, new, layer)
+    if rows is None:
+        return None
+    if positions is None:
+        held, targets = old.feature_count(layer), rows
+    else:
+        held = int(np.count_nonzero(positions >= 0))
+        targets = np.full(len(rows), -1, dtype=np.int64)
+        inside = rows < len(positions)
+        targets[inside] = positions[rows[inside]]
+        rows, targets = rows[targets >= 0], targets[targets >= 0]
+    if len(rows) > DIFF_MAX_FRACTION * held:
+        return None
+    name = json.dumps(layer).encode()
+    return [
+        json_object({
+            "id": name,
+            "positions": json.dumps(targets[first:first + DIFF_CHUNK_ROWS].tolist()).encode(),
+            "data": rows_payload(new, layer, rows[first:first + DIFF_CHUNK_ROWS], level),
+        })
+        for first in range(0, len(rows), DIFF_CHUNK_ROWS)
+    ]
+
+
+if __name__ == "__main__":
+    from dataset import get_dataset
+
+    for layer, row in encoding_report(get_dataset()).items():
+        print(
+            f"{layer:12} geojson {row['geojson_bytes']:>12,} B {row['geojson_seconds']:8.3f} s   "
+            f"quantized {row['quantized_bytes']:>12,} B {row['quantized_seconds']:8.3f} s   "
+            f"({row['size_ratio']:.1%})"
+        )
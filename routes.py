@@ -0,0 +1,277 @@
+import json
+import time
+
+import numpy as np
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+from starlette.routing import Route
+
+from dataset import LOD_LEVELS, get_dataset, refresh_memory_metrics
+from exports import EXPORTS, GEOJSON_MEDIA_TYPE, export_variants, variant_etag
+from lookup import LOOKUP_MAX_DISTANCE, MAX_LOOKUP_POINTS, nearest_sidewalks
+from metrics import METRICS_MEDIA_TYPE, render_metrics, timed
+from payloads import BINARY_LAYERS, binary_payload
+from scoring import MAX_ROUTES, score_routes
+from tiles import TILE_LAYERS, is_valid_tile, render_tile, tile_version
+
+MVT_MEDIA_TYPE = 'application/vnd.mapbox-vector-tile'
+IMMUTABLE = 'public, max-age=31536000, immutable'
+# The exports live at fixed URLs; caches keep them a day and revalidate cheaply with the ETag
+EXPORT_CACHE_CONTROL = 'public, max-age=86400, stale-while-revalidate=604800'
+
+
+def version_cache_control(request, version, unversioned='public, max-age=60'):
+    """URLs naming the version of their content never change; others may after a reload"""
+    if request.query_params.get('v') == version:
+        return IMMUTABLE
+    return unversioned
+
+
+def accepted_encoding(header, available):
+    """Content coding from available, in preference order, that Accept-Encoding rates highest"""
+    qualities = {}
+    for item in (header or '').split(','):
+        coding, _, params = item.partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.strip().lower()] = quality
+
+    def quality(coding):
+        if coding in qualities:
+            return qualities[coding]
+        if '*' in qualities:
+            return qualities['*']
+        return 1.0 if coding == 'identity' else 0.0
+    # With nothing acceptable, identity is sent anyway rather than a 406
+    candidates = [coding for coding in available if quality(coding) > 0] or ['identity']
+    return max(candidates, key=quality)
+
+
+def etag_matches(header, etag):
+    """Whether an If-None-Match header matches etag, by weak comparison"""
+    if header is None:
+        return False
+    if header.strip() == '*':
+        return True
+    return any(tag.strip().removeprefix('W/') == etag for tag in header.split(','))
+
+
+def byte_range(header, length):
+    """(first, last) byte positions of a single-range Range header
+
+    Returns None when the header should be ignored and the whole body sent:
+    other units, malformed specs and multiple ranges. Raises ValueError when
+    the range lies past the end of the body.
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, sep, last = spec.strip().partition('-')
+    if not sep or not (first.isdigit() or first == '') or not (last.isdigit() or last == ''):
+        return None
+    if first == '':
+        if last == '':
+            return None
+        suffix = int(last)
+        if suffix == 0 or length == 0:
+            raise ValueError(f"Unsatisfiable range {header!r}")
+        return max(length - suffix, 0), length - 1
+    first = int(first)
+    if last and int(last) < first:
+        return None
+    if first >= length:
+        raise ValueError(f"Unsatisfiable range {header!r}")
+    return first, min(int(last), length - 1) if last else length - 1
+
+
+def tile_endpoint(request):
+    """Serve /tiles/{layer}/{z}/{x}/{y}.mvt from the shared dataset"""
+    layer = request.path_params['layer']
+    z, x, y = (request.path_params[k] for k in ('z', 'x', 'y'))
+    if layer not in TILE_LAYERS or not is_valid_tile(z, x, y):
+        return Response(status_code=404)
+
+    dataset = get_dataset()
+    try:
+        with timed('render_tile', layer):
+            content = render_tile(dataset, layer, z, x, y)
+    except ImportError:
+        return Response("mapbox-vector-tile is not installed", status_code=501)
+
+    return Response(content, media_type=MVT_MEDIA_TYPE,
+                    headers={'Cache-Control': version_cache_control(request, tile_version(dataset, layer))})
+
+
+def binary_layer_endpoint(request):
+    """Serve /layers/{layer}/lod{level}.bin, the typed-array blob of a whole layer at an LOD level
+
+    /layers/{layer}.bin serves the finest level, or the one of an optional
+    ?lod= parameter.
+    """
+    layer = request.path_params['layer']
+    if layer not in BINARY_LAYERS:
+        return Response(status_code=404)
+    level = request.path_params.get('level', request.query_params.get('lod'))
+    if level is not None:
+        if not str(level).isdigit() or int(level) >= len(LOD_LEVELS):
+            return Response(status_code=404)
+        level = int(level)
+    dataset = get_dataset()
+    with timed('binary_layer', layer):
+        content = binary_payload(dataset, layer, level)
+    return Response(content, media_type='application/octet-stream',
+                    headers={'Cache-Control': version_cache_control(request, dataset.version)})
+
+
+def export_endpoint(request):
+    """Serve /data/{name}, the GeoJSON exports of the Astro map, precompressed and revalidatable"""
+    name = request.path_params['name']
+    if name not in EXPORTS:
+        return Response(status_code=404)
+
+    dataset = get_dataset()
+    with timed('export', EXPORTS[name]):
+        digest, variants = export_variants(dataset, name)
+    encoding = accepted_encoding(request.headers.get('accept-encoding'), tuple(variants))
+    etag = variant_etag(digest, encoding)
+    headers = {
+        'ETag': etag,
+        'Cache-Control': version_cache_control(request, dataset.version, EXPORT_CACHE_CONTROL),
+        'Vary': 'Accept-Encoding',
+    }
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers=headers)
+
+    headers['Accept-Ranges'] = 'bytes'
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    body = variants[encoding]
+    range_header = request.headers.get('range')
+    # A range is only honoured against the representation the client already has
+    if range_header and request.headers.get('if-range', etag).strip() == etag:
+        try:
+            span = byte_range(range_header, len(body))
+        except ValueError:
+            headers['Content-Range'] = f'bytes */{len(body)}'
+            return Response(status_code=416, headers=headers)
+        if span is not None:
+            first, last = span
+            headers['Content-Range'] = f'bytes {first}-{last}/{len(body)}'
+            return Response(body[first:last + 1], status_code=206, media_type=GEOJSON_MEDIA_TYPE,
+                            headers=headers)
+    return Response(body, media_type=GEOJSON_MEDIA_TYPE, headers=headers)
+
+
+def nullable(values, missing):
+    """List of values with the missing ones (NaN when missing is None) as null"""
+    if missing is None:
+        return [None if value != value else value for value in values.tolist()]
+    return [None if value == missing else value for value in values.tolist()]
+
+
+def lookup_response(body):
+    """Response to a lookup request body, computed off the event loop"""
+    try:
+        query = json.loads(body)
+        points = np.asarray(query['points'], dtype=np.float64)
+        max_distance = float(query.get('max_distance', LOOKUP_MAX_DISTANCE))
+    except (ValueError, TypeError, KeyError, AttributeError) as error:
+        return Response(f"Invalid lookup: {error}", status_code=400)
+    if points.size == 0:
+        points = points.reshape(0, 2)
+    if points.ndim != 2 or points.shape[1] != 2:
+        return Response("Invalid lookup: points must be [lon, lat] pairs", status_code=400)
+    if not max_distance >= 0:
+        return Response("Invalid lookup: max_distance must be a non-negative number of meters", status_code=400)
+    if len(points) > MAX_LOOKUP_POINTS:
+        return Response(f"At most {MAX_LOOKUP_POINTS:,} points can be looked up at once", status_code=413)
+
+    dataset = get_dataset()
+    start = time.perf_counter()
+    scores, distances, rows = nearest_sidewalks(dataset, points[:, 0], points[:, 1], max_distance)
+    elapsed = time.perf_counter() - start
+    content = {
+        'version': dataset.version,
+        'scores': nullable(scores, None),
+        'distances': nullable(distances, None),
+        'sidewalks': nullable(rows, -1),
+        'seconds': elapsed,
+        'points_per_second': len(points) / elapsed if elapsed > 0 else None,
+    }
+    return Response(json.dumps(content), media_type='application/json')
+
+
+async def lookup_endpoint(request):
+    """Serve POST /lookup, the nearest sidewalk of up to MAX_LOOKUP_POINTS points
+
+    The body is {"points": [[lon, lat], ...], "max_distance": meters}. The
+    answer holds the score of, distance in meters to and row of the nearest
+    sidewalk of every point, in order, null where none is within
+    max_distance, and the throughput of the lookup in points per second.
+    """
+    body = await request.body()
+    return await run_in_threadpool(lookup_response, body)
+
+
+def route_scores_response(body):
+    """Response to a route scoring request body, computed off the event loop"""
+    try:
+        routes = json.loads(body)['routes']
+        if not isinstance(routes, list):
+            raise TypeError("routes must be a list")
+    except (ValueError, TypeError, KeyError) as error:
+        return Response(f"Invalid routes: {error}", status_code=400)
+    if len(routes) > MAX_ROUTES:
+        return Response(f"At most {MAX_ROUTES:,} routes can be scored at once", status_code=413)
+
+    dataset = get_dataset()
+    start = time.perf_counter()
+    try:
+        scores, uncovered, lengths = score_routes(dataset, routes)
+    except (ValueError, TypeError) as error:
+        return Response(f"Invalid routes: {error}", status_code=400)
+    elapsed = time.perf_counter() - start
+    content = {
+        'version': dataset.version,
+        'scores': nullable(scores, None),
+        'uncovered': nullable(uncovered, None),
+        'lengths': lengths.tolist(),
+        'seconds': elapsed,
+        'routes_per_second': len(routes) / elapsed if elapsed > 0 else None,
+    }
+    return Response(json.dumps(content), media_type='application/json')
+
+
+async def route_scores_endpoint(request):
+    """Serve POST /routes/score, the robotability of up to MAX_ROUTES candidate routes
+
+    The body is {"routes": [[[lon, lat], ...], ...]}. The answer holds, per
+    route and in order, the length-weighted score of the sidewalks it
+    follows (null when it follows none), the fraction of it off any
+    sidewalk and its length in meters.
+    """
+    body = await request.body()
+    return await run_in_threadpool(route_scores_response, body)
+
+
+def metrics_endpoint(request):
+    """Serve /metrics in the Prometheus text format"""
+    refresh_memory_metrics()
+    return Response(render_metrics(), media_type=METRICS_MEDIA_TYPE)
+
+
+routes = [
+    Route('/tiles/{layer}/{z:int}/{x:int}/{y:int}.mvt', tile_endpoint),
+    Route('/layers/{layer}/lod{level:int}.bin', binary_layer_endpoint),
+    Route('/layers/{layer}.bin', binary_layer_endpoint),
+    Route('/data/{name}', export_endpoint),
+    Route('/lookup', lookup_endpoint, methods=['POST']),
+    Route('/routes/score', route_scores_endpoint, methods=['POST']),
+    Route('/metrics', metrics_endpoint),
+]
@@ -0,0 +1,199 @@
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+import pandas as pd
+import shapely
+from pyproj import Transformer
+
+from cache import BoundedCache
+from dataset import PROJ, WGS, build_dataset, carried_entry
+from lookup import METERS_PER_UNIT, sidewalk_tree
+from metrics import timed
+from shared import carry_rows
+
+logger = logging.getLogger(__name__)
+
+# Most routes, and most route points overall, scored by one request
+MAX_ROUTES = 100_000
+MAX_ROUTE_POINTS = 1_000_000
+# A route follows a sidewalk where it passes within this many meters of it
+ROUTE_SNAP_DISTANCE = float(os.environ.get("ROBOTABILITY_ROUTE_SNAP_DISTANCE", "1"))
+# Routes are scored this many at a time, serially or spread over ROUTE_WORKERS processes
+ROUTE_CHUNK = 2000
+ROUTE_WORKERS = int(os.environ.get("ROBOTABILITY_ROUTE_WORKERS", min(4, os.cpu_count() or 1)))
+
+# STRtrees over the sidewalks in PROJ, widened by ROUTE_SNAP_DISTANCE, per dataset version
+route_cache = BoundedCache('route_indexes', max_entries=2, sizeof=lambda _: 0)
+
+_pool = None
+_pool_lock = threading.Lock()
+# In a pool worker, the dataset version the last chunk was scored on
+_worker_dataset = None
+
+
+def route_index(dataset):
+    """STRtree over the sidewalks widened by the snap distance, built once per dataset version
+
+    Only the sidewalks that changed since the previous dataset are widened again.
+    """
+    def widen(geometries):
+        return shapely.buffer(geometries, ROUTE_SNAP_DISTANCE / METERS_PER_UNIT)
+
+    def build():
+        tree, changed = carried_entry(route_cache, lambda data: data.version, dataset, 'sidewalks')
+        if tree is not None and len(changed) == 0:
+            return tree
+        sidewalks = sidewalk_tree(dataset).geometries
+        if tree is None:
+            return shapely.STRtree(widen(sidewalks))
+        return shapely.STRtree(carry_rows(tree.geometries, changed, len(sidewalks), lambda rows: widen(sidewalks[rows])))
+    return route_cache.get_or_build(dataset.version, build)
+
+
+def pack_routes(routes):
+    """(coords, offsets) of routes given as sequences of [lon, lat] points
+
+    Route i is coords[offsets[i]:offsets[i + 1]]. Raises ValueError unless
+    every route has at least two finite points and the batch is within
+    MAX_ROUTES and MAX_ROUTE_POINTS.
+    """
+    if len(routes) > MAX_ROUTES:
+        raise ValueError(f"At most {MAX_ROUTES:,} routes can be scored at once, got {len(routes):,}")
+    arrays = [np.asarray(route, dtype=np.float64) for route in routes]
+    if any(array.ndim != 2 or array.shape[1] != 2 or len(array) < 2 for array in arrays):
+        raise ValueError("Every route must be a list of at least two [lon, lat] points")
+    offsets = np.concatenate([[0], np.cumsum([len(array) for array in arrays], dtype=np.int64)])
+    if offsets[-1] > MAX_ROUTE_POINTS:
+        raise ValueError(f"At most {MAX_ROUTE_POINTS:,} route points can be scored at once, got {offsets[-1]:,}")
+    coords = np.concatenate(arrays) if arrays else np.zeros((0, 2))
+    if not np.isfinite(coords).all():
+        raise ValueError("Route points must be finite numbers")
+    return coords, offsets
+
+
+def covered_lengths(segments, pair_segments, pieces):
+    """Length of every segment lying in at least one of its pieces, overlaps counted once
+
+    Pieces of a straight segment are intervals along it, merged per segment
+    in sorted order.
+    """
+    parts, part_pairs = shapely.get_parts(pieces, return_index=True)
+    # Crossings that only touch a sidewalk leave points, which cover nothing
+    lines = shapely.get_type_id(parts) == 1
+    parts, part_segments = parts[lines], pair_segments[part_pairs[lines]]
+    ends = [shapely.line_locate_point(segments[part_segments], shapely.get_point(parts, i)) for i in (0, -1)]
+    low, high = np.minimum(*ends), np.maximum(*ends)
+
+    order = np.lexsort((high, low, part_segments))
+    part_segments, low, high = part_segments[order], low[order], high[order]
+    reach = pd.Series(high).groupby(part_segments).cummax().to_numpy()
+    # Farthest any earlier interval of the same segment reaches
+    before = np.concatenate([[-np.inf], reach[:-1]])
+    before[np.concatenate([[True], part_segments[1:] != part_segments[:-1]])] = -np.inf
+    return np.bincount(part_segments, np.maximum(high - np.maximum(low, before), 0), minlength=len(segments))
+
+
+def score_packed_routes(dataset, coords, offsets):
+    """(scores, uncovered fractions, lengths in meters) of packed routes, see pack_routes
+
+    A route's score is the mean normalized score of the sidewalks it follows,
+    weighted by the length it follows each one; where sidewalks overlap,
+    each counts. Its uncovered fraction is the share of its length that
+    follows no sidewalk. Routes are split into their straight segments,
+    matched to sidewalks through the index and cut by them in one overlay.
+    """
+    count = len(offsets) - 1
+    x, y = Transformer.from_crs(WGS, PROJ, always_xy=True).transform(coords[:, 0], coords[:, 1])
+    vertex_routes = np.repeat(np.arange(count), np.diff(offsets))
+    # Segment i joins a vertex to the next one of the same route
+    starts = np.flatnonzero(vertex_routes[:-1] == vertex_routes[1:])
+    segment_routes = vertex_routes[starts]
+    segments = shapely.linestrings(np.stack([
+        np.column_stack((x[starts], y[starts])), np.column_stack((x[starts + 1], y[starts + 1]))], axis=1))
+    lengths = np.bincount(segment_routes, shapely.length(segments), minlength=count)
+
+    tree = route_index(dataset)
+    pair_segments, pair_sidewalks = tree.query(segments, predicate='intersects')
+    order = np.lexsort((pair_sidewalks, pair_segments))
+    pair_segments, pair_sidewalks = pair_segments[order], pair_sidewalks[order]
+    pieces = shapely.intersection(segments[pair_segments], tree.geometries.take(pair_sidewalks))
+    followed = shapely.length(pieces)
+
+    sidewalk_scores = np.asarray(dataset.scores('sidewalks'), dtype=np.float64)[pair_sidewalks]
+    scored = ~np.isnan(sidewalk_scores)
+    pair_routes = segment_routes[pair_segments][scored]
+    weights = np.bincount(pair_routes, followed[scored], minlength=count)
+    totals = np.bincount(pair_routes, followed[scored] * sidewalk_scores[scored], minlength=count)
+    covered = np.bincount(
+        segment_routes, covered_lengths(segments, pair_segments, pieces), minlength=count)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = np.where(weights > 0, totals / weights, np.nan)
+        uncovered = np.where(lengths > 0, np.clip(1 - covered / lengths, 0, 1), np.nan)
+    return scores, uncovered, lengths * METERS_PER_UNIT
+
+
+def attach_worker(version):
+    """Attach a pool worker to the caller's dataset version, read-only
+
+    Workers never build or publish anything: a version or frame that isn't
+    on disk raises FileNotFoundError, see score_routes.
+    """
+    global _worker_dataset
+    _worker_dataset = build_dataset(version, read_only=True)
+
+
+def score_chunk(version, coords, offsets):
+    """score_packed_routes in a pool worker, on the dataset version of the caller"""
+    if _worker_dataset is None or _worker_dataset.version != version:
+        attach_worker(version)
+    return score_packed_routes(_worker_dataset, coords, offsets)
+
+
+def route_pool():
+    """Process pool scoring large batches, started on first use
+
+    Workers are spawned rather than forked from the threaded server, and
+    attach to the shared frames instead of loading the dataset again.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(ROUTE_WORKERS, mp_context=get_context('spawn'))
+        return _pool
+
+
+def score_routes(dataset, routes, parallel=ROUTE_WORKERS > 1):
+    """(scores, uncovered fractions, lengths in meters) of routes given as sequences of [lon, lat] points
+
+    Routes are scored ROUTE_CHUNK at a time; with parallel, batches of
+    several chunks are spread over the process pool. Either way every chunk is
+    scored by the same code on the same routes, so the results are
+    identical. Workers that can't attach the dataset's version fall back to
+    scoring in this process. Raises ValueError on invalid routes, see
+    pack_routes.
+    """
+    coords, offsets = pack_routes(routes)
+    bounds = list(range(0, len(offsets) - 1, ROUTE_CHUNK)) + [len(offsets) - 1]
+    chunks = [
+        (coords[offsets[first]:offsets[last]], offsets[first:last + 1] - offsets[first])
+        for first, last in zip(bounds[:-1], bounds[1:])
+    ]
+    with timed('score_routes'):
+        # Datasets packed in memory (no directory) can't be attached by other processes
+        results = None
+        if parallel and len(chunks) > 1 and dataset.frames.directory is not None:
+            futures = [route_pool().submit(score_chunk, dataset.version, *chunk) for chunk in chunks]
+            try:
+                results = [future.result() for future in futures]
+            except FileNotFoundError as e:
+                logger.warning("Scoring routes in this process: %s", e)
+        if results is None:
+            results = [score_packed_routes(dataset, *chunk) for chunk in chunks]
+    if not results:
+        return np.zeros(0), np.zeros(0), np.zeros(0)
+    return tuple(np.concatenate(parts) for parts in zip(*results))
@@ -0,0 +1,458 @@
+import json
+import logging
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+try:
+    import fcntl
+except ImportError:  # Windows: concurrent workers may then build the same frame twice
+    fcntl = None
+
+# Version directories of the store are named after dataset versions; this file names the current one
+CURRENT_FILE = "current"
+LOCK_FILE = ".lock"
+# Processes share-lock this file of every version directory they use, see hold_version
+HOLD_FILE = ".hold"
+# Rough CPython/GEOS cost of one shapely geometry object on top of its coordinates
+GEOMETRY_OVERHEAD_BYTES = 120
+
+# Multi-part geometry types and the single-part type they generalize, as shapely type ids
+SINGLE_PART_TYPES = {4: 0, 5: 1, 6: 3}
+EMPTY_WKT = {0: 'POINT EMPTY', 1: 'LINESTRING EMPTY', 3: 'POLYGON EMPTY',
+             4: 'MULTIPOINT EMPTY', 5: 'MULTILINESTRING EMPTY', 6: 'MULTIPOLYGON EMPTY'}
+
+logger = logging.getLogger(__name__)
+
+
+def pack_geometries(name, geometries, arrays):
+    """Add the flat arrays of a geometry column to arrays; returns its layout
+
+    Non-empty geometries are stored as shapely ragged arrays (coordinates and
+    offsets). Every row's type id is kept as well, so single-part geometries
+    mixed with multi-part ones come back as they were: missing rows are -1
+    and empty ones -2 - their type id.
+    """
+    types = shapely.get_type_id(geometries).astype(np.int8)
+    empty = (types >= 0) & shapely.is_empty(geometries)
+    types[empty] = -2 - types[empty]
+    arrays[f'{name}.types'] = types
+    if not (types >= 0).any():
+        return {'geometry_type': None, 'offsets': 0}
+    geometry_type, coords, offsets = shapely.to_ragged_array(geometries[types >= 0])
+    arrays[f'{name}.coords'] = coords
+    for i, offset in enumerate(offsets):
+        arrays[f'{name}.offsets{i}'] = offset
+    return {'geometry_type': int(geometry_type), 'offsets': len(offsets)}
+
+
+def gather_ranges(starts, stops):
+    """(indices, offsets): the ranges starts[i]:stops[i] one after another, and where each begins"""
+    lengths = stops - starts
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1]), offsets
+
+
+def carry_rows(previous, rows, length, build):
+    """Array of length items: those of previous, an earlier version's, except at rows and past its end
+
+    build takes the sorted positions of the items to make afresh and returns
+    them, so only rows that changed since previous are built again.
+    """
+    kept = min(len(previous), length)
+    rows = np.asarray(rows, dtype=np.int64)
+    rows = np.union1d(rows[rows < length], np.arange(kept, length))
+    items = np.empty(length, dtype=object)
+    items[:kept] = np.asarray(previous[:kept], dtype=object)
+    if len(rows):
+        items[rows] = build(rows)
+    return items
+
+
+def pack_frame(frame):
+    """(layout, {array name: array}) of a DataFrame or GeoDataFrame as flat arrays"""
+    arrays = {}
+    columns = {}
+    for name in frame.columns:
+        values = frame[name]
+        if isinstance(values.dtype, gpd.array.GeometryDtype):
+            columns[name] = pack_geometries(name, values.values, arrays)
+        else:
+            array = values.to_numpy()
+            # Object arrays can't be memory-mapped; strings become fixed width
+            arrays[name] = array.astype(str) if array.dtype == object else array
+            columns[name] = None
+    layout = {'length': len(frame), 'columns': columns, 'index': None, 'geometry': None, 'crs': None}
+    if not frame.index.equals(pd.RangeIndex(len(frame))) or frame.index.name is not None:
+        arrays['__index__'] = frame.index.to_numpy()
+        layout['index'] = frame.index.name
+    if isinstance(frame, gpd.GeoDataFrame):
+        layout['geometry'] = frame.geometry.name
+        layout['crs'] = frame.crs.to_string() if frame.crs is not None else None
+    return layout, arrays
+
+
+class PackedFrame:
+    """A frame held as flat arrays, typically read-only memory maps shared between processes
+
+    Plain columns are used as they are. Geometry columns are turned into
+    shapely arrays the first time they are needed; that copy is private to
+    the process, so only the columns actually used are ever built. Callers
+    needing a few rows can take just those, and coordinate counts and row
+    bounds come straight from the arrays, so none of these builds a whole
+    column.
+    """
+
+    def __init__(self, layout, arrays):
+        self.layout = layout
+        self.arrays = arrays
+        self._geometries = {}
+        self._bounds = {}
+        self._present = {}
+        self._frame = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_frame(cls, frame):
+        return cls(*pack_frame(frame))
+
+    @classmethod
+    def read(cls, directory):
+        """Attach to a frame written by write(), memory-mapping its arrays"""
+        directory = Path(directory)
+        layout = json.loads((directory / "layout.json").read_text())
+        arrays = {path.stem: np.load(path, mmap_mode='r') for path in directory.glob("*.npy")}
+        return cls(layout, arrays)
+
+    def write(self, directory):
+        """Write the frame to directory, which appears complete or not at all"""
+        directory = Path(directory)
+        tmp_dir = directory.with_name(f".{directory.name}.{os.getpid()}.tmp")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir(parents=True)
+        for name, array in self.arrays.items():
+            np.save(tmp_dir / f"{name}.npy", array, allow_pickle=False)
+        (tmp_dir / "layout.json").write_text(json.dumps(self.layout))
+        os.replace(tmp_dir, directory)
+
+    def __len__(self):
+        return self.layout['length']
+
+    @property
+    def mapped_bytes(self):
+        return sum(array.nbytes for array in self.arrays.values())
+
+    @property
+    def private_bytes(self):
+        """Private memory of the geometry columns and row bounds built from the arrays so far
+
+        A built column is counted as its coordinates plus GEOMETRY_OVERHEAD_BYTES
+        per row, an estimate that doesn't depend on what else the process
+        allocates meanwhile.
+        """
+        size = sum(bounds.nbytes for bounds in self._bounds.values())
+        for name in self._geometries:
+            coords = self.arrays.get(f'{name}.coords')
+            size += len(self) * GEOMETRY_OVERHEAD_BYTES + (coords.nbytes if coords is not None else 0)
+        return size
+
+    def column(self, name):
+        """A plain column as an array, without copying it"""
+        return self.arrays[name]
+
+    def present_positions(self, name):
+        """Position of every row's geometry in the ragged arrays, None when every row has one there"""
+        if name not in self._present:
+            types = np.asarray(self.arrays[f'{name}.types'])
+            self._present[name] = None if (types >= 0).all() else np.cumsum(types >= 0) - 1
+        return self._present[name]
+
+    def build_geometries(self, name, rows=None):
+        """Shapely geometries of a geometry column, or of the given row positions of it"""
+        spec = self.layout['columns'][name]
+        types = np.asarray(self.arrays[f'{name}.types'])
+        if rows is not None:
+            types = types[rows]
+        geometries = np.full(len(types), None, dtype=object)
+        for code in np.unique(types[types < -1]):
+            geometries[types == code] = shapely.from_wkt(EMPTY_WKT[-2 - code])
+        if spec['geometry_type'] is None:
+            return geometries
+        coords = self.arrays[f'{name}.coords']
+        offsets = tuple(self.arrays[f'{name}.offsets{i}'] for i in range(spec['offsets']))
+        kept = np.flatnonzero(types >= 0)
+        if rows is not None:
+            positions = self.present_positions(name)
+            items = rows[kept] if positions is None else positions[rows[kept]]
+            # Offsets run from the coordinates of a ring up to the parts of a geometry; gather top down
+            gathered = []
+            for offset in reversed(offsets):
+                items, offset = gather_ranges(offset[items], offset[items + 1])
+                gathered.append(offset)
+            coords, offsets = coords[items], tuple(reversed(gathered))
+        # from_ragged_array crashes on empty and missing geometries, which is why they aren't in it
+        present = shapely.from_ragged_array(spec['geometry_type'], coords, offsets)
+        # Single-part geometries were widened to the multi-part type when both were present
+        narrow = types[kept] == SINGLE_PART_TYPES.get(spec['geometry_type'], -1)
+        present[narrow] = shapely.get_geometry(present[narrow], 0)
+        geometries[kept] = present
+        return geometries
+
+    def take(self, rows, name=None):
+        """Shapely geometries of some rows (positions, a slice or a mask) of a geometry column
+
+        Only those geometries are built, unless the whole column already is;
+        they aren't kept.
+        """
+        name = name or self.layout['geometry']
+        if name in self._geometries:
+            return self._geometries[name][rows]
+        if isinstance(rows, slice):
+            rows = np.arange(*rows.indices(len(self)))
+        rows = np.asarray(rows)
+        return self.build_geometries(name, np.flatnonzero(rows) if rows.dtype == bool else rows)
+
+    def num_coordinates(self, name=None):
+        """Number of coordinates of every row of a geometry column, without building it"""
+        name = name or self.layout['geometry']
+        spec = self.layout['columns'][name]
+        types = np.asarray(self.arrays[f'{name}.types'])
+        counts = np.zeros(len(types), dtype=np.int64)
+        if spec['geometry_type'] is None:
+            return counts
+        bounds = np.arange(int((types >= 0).sum()) + 1)
+        for i in reversed(range(spec['offsets'])):
+            bounds = self.arrays[f'{name}.offsets{i}'][bounds]
+        counts[types >= 0] = np.diff(bounds)
+        return counts
+
+    def bounds(self, name=None):
+        """Bounds (minx, miny, maxx, maxy) of every row of a geometry column, without building it
+
+        Read off the coordinate arrays once and kept; rows without
+        coordinates (missing or empty) are NaN, so they match no box.
+        """
+        name = name or self.layout['geometry']
+        if name not in self._bounds:
+            spec = self.layout['columns'][name]
+            types = np.asarray(self.arrays[f'{name}.types'])
+            bounds = np.full((len(types), 4), np.nan)
+            if spec['geometry_type'] is not None:
+                starts = np.arange(int((types >= 0).sum()) + 1)
+                for i in reversed(range(spec['offsets'])):
+                    starts = self.arrays[f'{name}.offsets{i}'][starts]
+                rows = np.flatnonzero(types >= 0)[np.diff(starts) > 0]
+                # Coordinates of consecutive rows are contiguous, so each reduced range is one row's
+                first = starts[:-1][np.diff(starts) > 0]
+                coords = np.asarray(self.arrays[f'{name}.coords'])
+                for column, reduce in enumerate((np.minimum, np.minimum, np.maximum, np.maximum)):
+                    bounds[rows, column] = reduce.reduceat(coords[:, column % 2], first)
+            self._bounds[name] = bounds
+        return self._bounds[name]
+
+    def built(self, name=None):
+        """Whether a geometry column (the active one when None) was built already"""
+        return (name or self.layout['geometry']) in self._geometries
+
+    def geometry(self, name=None, reuse=None):
+        """Shapely array of a geometry column (the active one when None), built on first use
+
+        reuse, a pair (geometries, rows), is the same column of an earlier
+        frame whose rows line up with this one's except at rows: only those
+        and the rows past its end are built, see carry_rows.
+        """
+        name = name or self.layout['geometry']
+        if name not in self._geometries:
+            with self._lock:
+                if name not in self._geometries:
+                    if reuse is None:
+                        geometries = self.build_geometries(name)
+                    else:
+                        geometries = carry_rows(*reuse, len(self), lambda rows: self.build_geometries(name, rows))
+                    self._geometries[name] = geometries
+        return self._geometries[name]
+
+    def frame(self):
+        """The whole frame as a (Geo)DataFrame, built on first use; plain columns are not copied"""
+        if self._frame is None:
+            columns = {
+                name: self.geometry(name) if spec is not None else np.asarray(self.arrays[name])
+                for name, spec in self.layout['columns'].items()
+            }
+            index = None
+            if '__index__' in self.arrays:
+                index = pd.Index(np.asarray(self.arrays['__index__']), name=self.layout['index'])
+            if self.layout['geometry'] is None:
+                frame = pd.DataFrame(columns, index=index, copy=False)
+            else:
+                frame = gpd.GeoDataFrame(
+                    columns, index=index, geometry=self.layout['geometry'], crs=self.layout['crs'], copy=False)
+            self._frame = frame
+        return self._frame
+
+
+# Store locks the current thread holds, by lock file, so builders can attach the frames they depend on
+_held = threading.local()
+
+
+@contextmanager
+def store_lock(root, name=None):
+    """Exclusive lock on a store across processes, or on one frame of it when a name is given
+
+    Frames are locked separately so independent ones build side by side. The
+    lock is re-entrant within a thread.
+    """
+    root = Path(root)
+    path = root / (LOCK_FILE if name is None else f"{LOCK_FILE}.{name}")
+    if not hasattr(_held, 'depths'):
+        _held.depths = {}
+    held = _held.depths
+    if held.get(path):
+        held[path] += 1
+        try:
+            yield
+        finally:
+            held[path] -= 1
+        return
+    root.mkdir(parents=True, exist_ok=True)
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        held[path] = 1
+        try:
+            yield
+        finally:
+            held[path] = 0
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def hold_version(directory, create=True):
+    """Keep a version directory on disk for as long as the returned file stays open
+
+    The directory is created if needed (else FileNotFoundError is raised)
+    and its hold file share-locked under the store lock, so publish_version,
+    which only removes versions nobody holds, can't remove it in between.
+    """
+    directory = Path(directory)
+    with store_lock(directory.parent):
+        if create:
+            directory.mkdir(parents=True, exist_ok=True)
+        elif not directory.is_dir():
+            raise FileNotFoundError(f"Version {directory.name} is not in {directory.parent}")
+        hold = open(directory / HOLD_FILE, 'a')
+        if fcntl is not None:
+            fcntl.flock(hold, fcntl.LOCK_SH)
+    return hold
+
+
+def version_held(directory):
+    """Whether some process holds a version directory; call under the store lock"""
+    if fcntl is None:
+        return False
+    with open(Path(directory) / HOLD_FILE, 'a') as hold:
+        try:
+            fcntl.flock(hold, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+    return False
+
+
+class SharedFrames:
+    """The packed frames of one dataset version, attached on first use
+
+    Frames are memory-mapped from directory/<name> so every process maps the
+    same pages. The first process to need a missing frame builds it with its
+    builder while holding that frame's lock; the others wait, then attach. The
+    directory is held as long as this object lives, so frames attached late
+    are built into a version still on disk. Read-only, nothing is built:
+    a missing version or frame raises FileNotFoundError. With no directory,
+    frames are packed in memory and nothing is shared.
+    """
+
+    def __init__(self, builders, directory=None, on_attach=None, read_only=False):
+        self.builders = builders
+        self.directory = Path(directory) if directory is not None else None
+        self.on_attach = on_attach
+        self.read_only = read_only
+        self._frames = {}
+        self._lock = threading.Lock()
+        self._hold = hold_version(self.directory, not read_only) if self.directory is not None else None
+
+    def attached(self, name):
+        return name in self._frames
+
+    def items(self):
+        return list(self._frames.items())
+
+    def load(self, name):
+        if self.directory is None:
+            return PackedFrame.from_frame(self.builders[name](self))
+        path = self.directory / name
+        if not path.exists():
+            if self.read_only:
+                raise FileNotFoundError(f"Frame {name} of version {self.directory.name} is not built")
+            # Only without file locks can a version be removed while held; don't build it back
+            if not self.directory.is_dir():
+                raise FileNotFoundError(f"Version {self.directory.name} was removed from {self.directory.parent}")
+            with store_lock(self.directory, name):
+                if not path.exists():
+                    PackedFrame.from_frame(self.builders[name](self)).write(path)
+                    logger.info("Published frame %s of version %s", name, self.directory.name)
+        return PackedFrame.read(path)
+
+    def get(self, name):
+        """The packed frame called name"""
+        if name not in self._frames:
+            frame = self.load(name)
+            with self._lock:
+                frame = self._frames.setdefault(name, frame)
+            if self.on_attach is not None:
+                self.on_attach(name, frame)
+        return self._frames[name]
+
+    def frame(self, name):
+        """The frame called name as a (Geo)DataFrame"""
+        return self.get(name).frame()
+
+
+def published_version(root):
+    """The version the store's pointer names, or None before anything was published"""
+    try:
+        return (Path(root) / CURRENT_FILE).read_text().strip() or None
+    except OSError:
+        return None
+
+
+def publish_version(root, version, keep=2):
+    """Point every process at version, keeping only the keep most recently published versions
+
+    The pointer is replaced atomically, so readers see the old version or the
+    new one. Older versions are removed from disk once no process holds them
+    (see SharedFrames); a held one is left for a later call to remove.
+    """
+    root = Path(root)
+    history_path = root / "history.json"
+    with store_lock(root):
+        try:
+            history = json.loads(history_path.read_text())
+        except (OSError, ValueError):
+            history = []
+        history = [v for v in history if v != version][-(keep - 1):] + [version] if keep > 1 else [version]
+        for path in root.iterdir():
+            if path.is_dir() and not path.name.startswith('.') and path.name not in history:
+                if not version_held(path):
+                    shutil.rmtree(path, ignore_errors=True)
+        for name, content in ((history_path, json.dumps(history)), (root / CURRENT_FILE, version)):
+            tmp_path = name.with_name(f".{name.name}.{os.getpid()}.tmp")
+            tmp_path.write_text(content)
+            os.replace(tmp_path, name)
+    logger.info("Published dataset version %s", version)
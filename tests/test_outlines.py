@@ -0,0 +1,58 @@
+import numpy as np
+import shapely
+
+from dataset import OUTLINE_DECIMALS, block_outlines
+
+# Blocks are laid out on a grid of this many degrees near Manhattan
+STEP = 0.001
+ORIGIN = (-74.0, 40.7)
+
+
+def block(x0, y0, x1, y1):
+    return shapely.box(ORIGIN[0] + x0 * STEP, ORIGIN[1] + y0 * STEP, ORIGIN[0] + x1 * STEP, ORIGIN[1] + y1 * STEP)
+
+
+def segments(geometries):
+    """Every straight segment of the geometries' lines or rings, as snapped endpoint pairs in either direction"""
+    lines = shapely.get_parts(shapely.get_parts(geometries))
+    lines = np.concatenate([shapely.get_rings(lines[shapely.get_type_id(lines) == 3]),
+                            lines[shapely.get_type_id(lines) != 3]])
+    found = []
+    for line in lines:
+        coords = [tuple(point) for point in np.round(shapely.get_coordinates(line), OUTLINE_DECIMALS + 1)]
+        found.extend(tuple(sorted(pair)) for pair in zip(coords[:-1], coords[1:]))
+    return found
+
+
+def test_shared_edges_are_drawn_once():
+    blocks = np.array([block(x, y, x + 1, y + 1) for x in range(3) for y in range(2)], dtype=object)
+    outlines = block_outlines(blocks)
+
+    drawn = segments(outlines[~shapely.is_missing(outlines)])
+    assert len(drawn) == len(set(drawn))
+    assert set(drawn) == set(segments(blocks))
+    # 3 x 2 unit blocks: 3 * 3 horizontal and 4 * 2 vertical edges
+    assert len(drawn) == 17
+    # The first block keeps all its edges, the others only those no earlier block has
+    assert len(segments(outlines[:1])) == 4
+    assert len(segments(outlines[1:2])) == 3
+
+
+def test_holes_are_kept():
+    courtyard = shapely.Polygon(block(0, 0, 3, 3).exterior.coords, [block(1, 1, 2, 2).exterior.coords])
+    blocks = np.array([courtyard, block(1, 1, 2, 2), block(3, 0, 4, 3)], dtype=object)
+    outlines = block_outlines(blocks)
+
+    assert set(segments(outlines[:1])) == set(segments(blocks[:1]))
+    # The block filling the courtyard has no edge of its own
+    assert outlines[1] is None
+    assert set(segments(outlines[2:])) == set(segments(blocks[2:])) - set(segments(blocks[:1]))
+
+
+def test_rows_line_up_with_the_blocks():
+    blocks = np.array([None, block(0, 0, 1, 1), shapely.Polygon(), block(0, 0, 1, 1)], dtype=object)
+    outlines = block_outlines(blocks)
+    assert len(outlines) == 4
+    assert outlines[0] is None and outlines[2] is None and outlines[3] is None
+    assert set(segments(outlines[1:2])) == set(segments(blocks[1:2]))
+    assert len(block_outlines(np.array([], dtype=object))) == 0
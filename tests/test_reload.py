@@ -0,0 +1,232 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+
+import dataset as dataset_module
+from dataset import Dataset, changed_geometries, changed_rows, derived_frames, preprocess_sidewalks, update_sidewalks
+from lookup import sidewalk_tree
+from payloads import DIFF_MAX_FRACTION, diff_messages, rows_payload
+from scoring import route_index
+from shared import SharedFrames
+from tiles import render_tile, tiles_covering
+
+# Segment id -> (raw score, lower left corner in PROJ feet); min and max scores stay put across the edits,
+# and segments 10 to 19 are never edited
+SEGMENTS = {1: (0.0, 0), 2: (5.0, 100), 3: (10.0, 200), 4: (7.0, 300)}
+UNEDITED = {10 + i: (1.25 + 0.5 * i, 1000 + 100 * i) for i in range(10)}
+
+
+def sidewalk_wkt(x, width=50):
+    return shapely.box(1_000_000 + x, 200_000, 1_000_000 + x + width, 200_010).wkt
+
+
+def write_sidewalks(path, rows):
+    """Write (segment id, raw score, WKT) rows as a sidewalk CSV"""
+    pd.DataFrame(rows, columns=['segment_id', 'score', 'geometry']).to_csv(path, index=False)
+    return path
+
+
+def original_rows():
+    return [(segment, score, sidewalk_wkt(x)) for segment, (score, x) in {**SEGMENTS, **UNEDITED}.items()]
+
+
+def edited_rows():
+    """Segment 2 rescored, 3 reshaped, 4 removed and 5 added, in another order"""
+    unedited = [(segment, score, sidewalk_wkt(x)) for segment, (score, x) in UNEDITED.items()]
+    return [
+        (5, 3.0, sidewalk_wkt(400)),
+        (3, 10.0, sidewalk_wkt(200, width=80)),
+        *unedited[::-1],
+        (1, 0.0, sidewalk_wkt(0)),
+        (2, 6.0, sidewalk_wkt(100)),
+    ]
+
+
+def make_dataset(version, sidewalks, census_key='census', deployments_key='deployments'):
+    """Dataset packed in memory around a sidewalks frame"""
+    return Dataset(
+        frames=SharedFrames({'sidewalks': lambda _: sidewalks, 'sidewalks-lod': derived_frames()['sidewalks-lod']}),
+        deployments=(), version=version, build_seconds=0.0, built_at=0.0,
+        keys={'sidewalks': version, 'cbs': census_key}, deployments_key=deployments_key,
+    )
+
+
+def update(tmp_path, rows):
+    """(previous, updated) sidewalk frames before and after the sidewalk CSV is rewritten with rows"""
+    previous = preprocess_sidewalks(write_sidewalks(tmp_path / "before.csv", original_rows()))
+    return previous, update_sidewalks(previous, write_sidewalks(tmp_path / "after.csv", rows))
+
+
+def reload(tmp_path, rows):
+    """(old, new) datasets before and after the sidewalk CSV is rewritten with rows"""
+    previous, updated = update(tmp_path, rows)
+    return make_dataset(f"{tmp_path.name}-old", previous), make_dataset(f"{tmp_path.name}-new", updated)
+
+
+def apply_patch(features, patch):
+    """The browser's updateFeatures: replace the features at their positions, appending past the end"""
+    features = list(features)
+    for body in patch:
+        message = json.loads(body)
+        for position, feature in zip(message['positions'], message['data']['features']):
+            assert position <= len(features)
+            if position == len(features):
+                features.append(feature)
+            else:
+                features[position] = feature
+    return features
+
+
+def payload_features(dataset, rows=None):
+    return json.loads(rows_payload(dataset, 'sidewalks', rows))['features']
+
+
+def test_update_sidewalks_keeps_rows_and_only_parses_changed_segments(tmp_path):
+    before, after = update(tmp_path, edited_rows())
+
+    assert after['segment_id'].tolist() == [1, 2, 3, 4, *UNEDITED, 5]
+    # Unchanged geometries are the previous objects, not parsed again
+    reused = [row for row in range(len(before)) if after.geometry.values[row] is before.geometry.values[row]]
+    assert reused == [0, 1, *range(4, 14)]
+    # The removed segment stays as a row without geometry or score
+    assert after.geometry.values[3] is None
+    assert np.isnan(after['score'].values[3])
+
+    # Every segment matches a full rebuild of the edited file
+    rebuilt = preprocess_sidewalks(tmp_path / "after.csv").set_index('segment_id')
+    kept = after[after.geometry.notna()].set_index('segment_id')
+    assert sorted(kept.index) == sorted(rebuilt.index)
+    assert shapely.equals_exact(kept.geometry.values, rebuilt.geometry.loc[kept.index].values, 1e-9).all()
+    np.testing.assert_array_equal(kept['score'].values, rebuilt['score'].loc[kept.index].values)
+
+
+def test_update_sidewalks_reparses_everything_when_ids_repeat(tmp_path):
+    rows = original_rows() + [(1, 2.0, sidewalk_wkt(500))]
+    _, after = update(tmp_path, rows)
+    assert after['segment_id'].tolist() == [*SEGMENTS, *UNEDITED, 1]
+
+
+def test_changed_rows_of_an_edit(tmp_path):
+    old, new = reload(tmp_path, edited_rows())
+    assert changed_rows(old, new, 'sidewalks').tolist() == [1, 2, 3, 14]
+
+
+def test_changed_rows_ignores_reordering(tmp_path):
+    old, new = reload(tmp_path, original_rows()[::-1])
+    assert changed_rows(old, new, 'sidewalks').tolist() == []
+
+
+def test_changed_rows_needs_rows_that_line_up(tmp_path):
+    old, _ = reload(tmp_path, edited_rows())
+    unrelated = make_dataset(f"{tmp_path.name}-unrelated", preprocess_sidewalks(tmp_path / "after.csv"))
+    assert changed_rows(old, unrelated, 'sidewalks') is None
+
+
+def test_changed_rows_of_census_blocks_and_deployments(tmp_path):
+    old, new = reload(tmp_path, edited_rows())
+    assert changed_rows(old, new, 'cbs').tolist() == []
+    assert changed_rows(old, new, 'deployments').tolist() == []
+
+    moved = make_dataset(f"{tmp_path.name}-moved", new.frame('sidewalks'), census_key='other', deployments_key='other')
+    assert changed_rows(old, moved, 'cbs') is None
+    assert changed_rows(old, moved, 'deployments') is None
+    unknown = make_dataset(f"{tmp_path.name}-unknown", new.frame('sidewalks'), deployments_key=None)
+    assert changed_rows(unknown, unknown, 'deployments') is None
+
+
+def test_diff_messages_patch_the_browser_copy_into_the_new_one(tmp_path):
+    old, new = reload(tmp_path, edited_rows())
+    patch = diff_messages(old, new, 'sidewalks')
+    assert apply_patch(payload_features(old), patch) == payload_features(new)
+
+
+def test_diff_messages_of_a_reordered_file_send_nothing(tmp_path):
+    old, new = reload(tmp_path, original_rows()[::-1])
+    assert diff_messages(old, new, 'sidewalks') == []
+
+
+def test_diff_messages_only_patch_the_rows_a_viewport_holds(tmp_path):
+    old, new = reload(tmp_path, edited_rows())
+    # The browser holds rows 2, 0 and 5 of the old copy, in that order
+    positions = np.full(old.feature_count('sidewalks'), -1, dtype=np.int64)
+    positions[[2, 0, 5]] = [0, 1, 2]
+    held = payload_features(old, np.array([2, 0, 5]))
+    patch = diff_messages(old, new, 'sidewalks', positions=positions)
+    assert [json.loads(body)['positions'] for body in patch] == [[0]]
+    assert apply_patch(held, patch) == payload_features(new, np.array([2, 0, 5]))
+
+
+def test_diff_messages_send_the_layer_again_when_too_much_changed(tmp_path):
+    # Every score moves to the previous segment
+    rows = original_rows()
+    rows = [(segment, score, wkt) for (segment, _, wkt), (_, score, _) in zip(rows, rows[1:] + rows[:1])]
+    old, new = reload(tmp_path, rows)
+    assert len(changed_rows(old, new, 'sidewalks')) > DIFF_MAX_FRACTION * old.feature_count('sidewalks')
+    assert diff_messages(old, new, 'sidewalks') is None
+
+
+def test_diff_messages_of_unchanged_deployments_send_nothing(tmp_path):
+    old, new = reload(tmp_path, edited_rows())
+    assert diff_messages(old, new, 'deployments') == []
+    moved = make_dataset(f"{tmp_path.name}-moved", new.frame('sidewalks'), deployments_key='other')
+    assert diff_messages(old, moved, 'deployments') is None
+
+
+def serve(monkeypatch, dataset, previous=None):
+    """Make dataset the one the process serves, having replaced previous"""
+    monkeypatch.setattr(dataset_module, '_dataset', dataset)
+    monkeypatch.setattr(dataset_module, '_previous', previous)
+
+
+def test_changed_geometries(tmp_path):
+    old, new = reload(tmp_path, edited_rows())
+    # 3 reshaped, 4 removed and 5 added; 2 was only rescored
+    assert changed_geometries(old, new, 'sidewalks').tolist() == [2, 3, 14]
+    assert changed_geometries(old, new, 'cbs').tolist() == []
+    moved = make_dataset(f"{tmp_path.name}-moved", new.frame('sidewalks'), census_key='other')
+    assert changed_geometries(old, moved, 'cbs') is None
+
+
+def test_reload_carries_geometries_and_indexes_over(tmp_path, monkeypatch):
+    previous, updated = update(tmp_path, edited_rows())
+    old = make_dataset(f"{tmp_path.name}-old", previous)
+    new = make_dataset(f"{tmp_path.name}-new", updated)
+    fresh = make_dataset(f"{tmp_path.name}-fresh", updated)
+    serve(monkeypatch, old)
+    before, before_tree, before_routes = old.geometries('sidewalks'), sidewalk_tree(old), route_index(old)
+    serve(monkeypatch, new, old)
+    after, tree, routes = new.geometries('sidewalks'), sidewalk_tree(new), route_index(new)
+    serve(monkeypatch, fresh)
+    rebuilt, rebuilt_tree, rebuilt_routes = fresh.geometries('sidewalks'), sidewalk_tree(fresh), route_index(fresh)
+
+    # Rows whose geometry didn't change are the previous version's objects; all match a full build
+    unchanged = [0, 1, *range(4, 14)]
+    assert [row for row in range(len(before)) if after[row] is before[row]] == unchanged
+    assert [row for row in range(len(before)) if tree.geometries[row] is before_tree.geometries[row]] == unchanged
+    assert shapely.to_wkt(after).tolist() == shapely.to_wkt(rebuilt).tolist()
+    assert shapely.to_wkt(tree.geometries).tolist() == shapely.to_wkt(rebuilt_tree.geometries).tolist()
+    assert routes.geometries[0] is before_routes.geometries[0]
+    assert shapely.to_wkt(routes.geometries).tolist() == shapely.to_wkt(rebuilt_routes.geometries).tolist()
+
+
+def test_reload_carries_tiles_nothing_changed_on(tmp_path, monkeypatch):
+    pytest.importorskip('mapbox_vector_tile')
+    previous, updated = update(tmp_path, edited_rows())
+    old = make_dataset(f"{tmp_path.name}-old", previous)
+    new = make_dataset(f"{tmp_path.name}-new", updated)
+    fresh = make_dataset(f"{tmp_path.name}-fresh", updated)
+    tiles = [(z, x, y) for z in (13, 15, 16) for x, y in tiles_covering(old.frame('sidewalks').total_bounds, z, pad=1)]
+
+    serve(monkeypatch, old)
+    before = [render_tile(old, 'sidewalks', *tile) for tile in tiles]
+    serve(monkeypatch, new, old)
+    after = [render_tile(new, 'sidewalks', *tile) for tile in tiles]
+    serve(monkeypatch, fresh)
+    rendered = [render_tile(fresh, 'sidewalks', *tile) for tile in tiles]
+
+    assert after == rendered
+    carried = [a is b for a, b in zip(after, before)]
+    assert any(carried) and not all(carried)
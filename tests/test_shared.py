@@ -0,0 +1,60 @@
+import gc
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+
+from shared import PackedFrame, SharedFrames, publish_version, published_version
+
+
+def frames(root, version, built):
+    """SharedFrames of a version whose frame 'a' records every build in built"""
+    def build(_):
+        built.append(version)
+        return pd.DataFrame({'x': [1, 2, 3]})
+    return SharedFrames({'a': build}, root / version)
+
+
+def test_held_versions_stay_until_released(tmp_path):
+    built = []
+    old = frames(tmp_path, 'v1', built)
+    publish_version(tmp_path, 'v1')
+    for version in ('v2', 'v3'):
+        frames(tmp_path, version, built).get('a')
+        publish_version(tmp_path, version)
+    assert published_version(tmp_path) == 'v3'
+    # v1 left the history but is still held: its frames can still be attached, and are built into it
+    assert (tmp_path / 'v1').is_dir()
+    assert old.get('a').column('x').tolist() == [1, 2, 3]
+    assert built == ['v2', 'v3', 'v1']
+
+    del old
+    gc.collect()
+    publish_version(tmp_path, 'v4')
+    assert sorted(path.name for path in tmp_path.iterdir() if path.is_dir()) == ['v3']
+
+
+def test_read_only_frames_build_nothing(tmp_path):
+    built = []
+    with pytest.raises(FileNotFoundError):
+        SharedFrames({}, tmp_path / 'v1', read_only=True)
+    assert not (tmp_path / 'v1').exists()
+
+    frames(tmp_path, 'v1', built).get('a')
+    attached = SharedFrames({'a': None, 'b': None}, tmp_path / 'v1', read_only=True)
+    assert attached.get('a').column('x').tolist() == [1, 2, 3]
+    with pytest.raises(FileNotFoundError):
+        attached.get('b')
+    assert not (tmp_path / 'v1' / 'b').exists()
+
+
+def test_bounds_come_off_the_packed_arrays():
+    geometries = shapely.from_wkt([
+        'LINESTRING (0 0, 2 1)', None, 'MULTILINESTRING ((5 5, 6 7), (-1 4, 0 3))', 'LINESTRING EMPTY',
+        'LINESTRING (3 -2, 4 -1, 3.5 0)',
+    ])
+    frame = PackedFrame.from_frame(gpd.GeoDataFrame({'x': range(5)}, geometry=geometries))
+    np.testing.assert_array_equal(frame.bounds(), shapely.bounds(geometries))
+    assert not frame.built()
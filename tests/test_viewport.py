@@ -0,0 +1,49 @@
+import geopandas as gpd
+import numpy as np
+import pytest
+import shapely
+
+from dataset import Dataset
+from shared import SharedFrames
+from viewport import intersecting_rows, parse_viewport, viewport_rows
+
+
+def test_parse_viewport():
+    assert parse_viewport({'bbox': [-74, 40.5, '-73.5', 41], 'zoom': 12.5}) == ((-74.0, 40.5, -73.5, 41.0), 12.5)
+
+
+@pytest.mark.parametrize('viewport', [
+    None, 'bbox', [], {}, {'bbox': [-74, 40.5, -73.5, 41]}, {'zoom': 12},
+    {'bbox': None, 'zoom': 12}, {'bbox': [-74, 40.5], 'zoom': 12}, {'bbox': [-74, 40.5, -73.5, 41], 'zoom': 'far'},
+    {'bbox': [-73.5, 40.5, -74, 41], 'zoom': 12}, {'bbox': [-74, 40.5, -73.5, 41], 'zoom': 'nan'},
+    {'bbox': [-74, 40.5, 'inf', 41], 'zoom': 12},
+])
+def test_malformed_viewports_raise_value_error(viewport):
+    with pytest.raises(ValueError):
+        parse_viewport(viewport)
+
+
+def sidewalk_dataset(geometries):
+    sidewalks = gpd.GeoDataFrame({'score': np.linspace(0, 1, len(geometries))}, geometry=geometries, crs='EPSG:4326')
+    return Dataset(frames=SharedFrames({'sidewalks': lambda _: sidewalks}), deployments=(),
+                   version='v', build_seconds=0.0, built_at=0.0)
+
+
+def test_viewport_rows_match_an_index_query():
+    rng = np.random.default_rng(0)
+    starts = rng.uniform((-74.1, 40.6), (-73.8, 40.9), (2000, 2))
+    geometries = shapely.linestrings(np.stack([starts, starts + rng.normal(0, 0.002, (2000, 2))], axis=1))
+    geometries[::7] = None
+    dataset = sidewalk_dataset(geometries)
+    bbox = (-74.0, 40.7, -73.9, 40.8)
+    expected = np.sort(shapely.STRtree(geometries).query(shapely.box(*bbox), predicate='intersects'))
+
+    rows, found = intersecting_rows(dataset, 'sidewalks', bbox)
+    np.testing.assert_array_equal(rows, expected)
+    assert shapely.equals(found, geometries[rows]).all()
+    exclude = np.zeros(len(geometries), dtype=bool)
+    exclude[expected[::2]] = True
+    np.testing.assert_array_equal(viewport_rows(dataset, 'sidewalks', bbox, exclude), expected[1::2])
+    nearest = viewport_rows(dataset, 'sidewalks', bbox, budget=10)
+    assert len(nearest) == 10 and np.isin(nearest, expected).all()
+    assert not dataset.frames.get('sidewalks').built()
@@ -0,0 +1,206 @@
+import math
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from pyproj import Transformer
+
+from cache import BoundedCache
+from classify import CLASSIFICATION, score_classes, updated_rows
+from dataset import WGS, lod_level, previous_dataset
+from viewport import bounds_rows
+
+WEB_MERCATOR = 'EPSG:3857'
+TILE_EXTENT = 4096
+# Extra margin, in tile units, clipped around each tile so strokes don't seam
+TILE_BUFFER = 64
+TILE_MIN_ZOOM = 10
+# Deepest zoom rendered; the client overzooms these tiles beyond it
+TILE_MAX_ZOOM = 16
+TILE_LAYERS = ('sidewalks', 'cbs', 'blocks')
+
+EARTH_RADIUS = 6378137
+# Half the width of the web mercator world, in meters
+ORIGIN_SHIFT = math.pi * EARTH_RADIUS
+
+# Encoded tiles per (tile version, layer, z, x, y), see tile_version
+tile_cache = BoundedCache('tiles', max_entries=8192, max_bytes=256 << 20)
+# Mercator bounds of the features drawn differently in two dataset versions, per (old, new version, layer)
+change_cache = BoundedCache(
+    'tile_changes', max_entries=2 * len(TILE_LAYERS), sizeof=lambda bounds: 0 if bounds is None else bounds.nbytes)
+
+
+def tile_version(dataset, layer):
+    """Version of a tiled layer's content: census block outlines only change with the blocks"""
+    if layer == 'cbs' and dataset.keys is not None:
+        return dataset.keys['cbs']
+    return dataset.version
+
+
+def tile_bounds(z, x, y):
+    """Web mercator bounds (minx, miny, maxx, maxy) of an XYZ tile"""
+    span = 2 * ORIGIN_SHIFT / (1 << z)
+    minx = -ORIGIN_SHIFT + x * span
+    maxy = ORIGIN_SHIFT - y * span
+    return minx, maxy - span, minx + span, maxy
+
+
+def clip_bounds(z, x, y):
+    """Web mercator bounds of the area clipped into a tile, its buffer included"""
+    minx, miny, maxx, maxy = tile_bounds(z, x, y)
+    margin = (maxx - minx) * TILE_BUFFER / TILE_EXTENT
+    return minx - margin, miny - margin, maxx + margin, maxy + margin
+
+
+def is_valid_tile(z, x, y):
+    return 0 <= z <= 22 and 0 <= x < (1 << z) and 0 <= y < (1 << z)
+
+
+def lonlat_tile(lon, lat, z):
+    """(x, y) of the XYZ tile containing a WGS84 point"""
+    n = 1 << z
+    lat = min(max(lat, -85.0511), 85.0511)
+    x = int((lon + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tiles_covering(bounds, z, pad=0):
+    """(x, y) of every tile at zoom z intersecting WGS84 bounds, plus pad tiles around them"""
+    n = 1 << z
+    x0, y0 = lonlat_tile(bounds[0], bounds[3], z)
+    x1, y1 = lonlat_tile(bounds[2], bounds[1], z)
+    return [
+        (x, y)
+        for x in range(max(x0 - pad, 0), min(x1 + pad, n - 1) + 1)
+        for y in range(max(y0 - pad, 0), min(y1 + pad, n - 1) + 1)
+    ]
+
+
+def to_mercator(geometries):
+    return gpd.GeoSeries(geometries, crs=WGS).to_crs(WEB_MERCATOR).values
+
+
+def mercator_lonlat(x, y):
+    """WGS84 (lon, lat) of a web mercator point"""
+    return math.degrees(x / EARTH_RADIUS), math.degrees(math.atan(math.sinh(y / EARTH_RADIUS)))
+
+
+def changed_bounds(old, new, layer):
+    """Web mercator bounds (n, 4) of the features of a layer drawn differently in two versions, old and new
+
+    None when the rows of the versions don't line up, see updated_rows.
+    """
+    def build():
+        rows = updated_rows(old, new, layer)
+        if rows is None:
+            return None
+        # Simplified levels lie within the bounds of the finest one
+        geometries = np.concatenate([
+            old.geometries(layer, rows=rows[rows < old.feature_count(layer)]), new.geometries(layer, rows=rows)])
+        bounds = shapely.bounds(geometries)
+        bounds = bounds[~np.isnan(bounds).any(axis=1)]
+        # Web mercator x grows with the longitude alone and y with the latitude, so corners map to corners
+        transformer = Transformer.from_crs(WGS, WEB_MERCATOR, always_xy=True)
+        minx, miny = transformer.transform(bounds[:, 0], bounds[:, 1])
+        maxx, maxy = transformer.transform(bounds[:, 2], bounds[:, 3])
+        return np.column_stack([minx, miny, maxx, maxy])
+    return change_cache.get_or_build((old.version, new.version, layer), build)
+
+
+def carried_tile(dataset, layer, z, x, y):
+    """The previous dataset's encoding of a tile, if cached and no feature drawn differently lies on it
+
+    Returns None when the tile has to be rendered.
+    """
+    previous = previous_dataset(dataset)
+    if previous is None:
+        return None
+    content = tile_cache.get((tile_version(previous, layer), layer, z, x, y))
+    if content is None:
+        return None
+    bounds = changed_bounds(previous, dataset, layer)
+    if bounds is None:
+        return None
+    minx, miny, maxx, maxy = clip_bounds(z, x, y)
+    if ((bounds[:, 0] <= maxx) & (bounds[:, 2] >= minx) & (bounds[:, 1] <= maxy) & (bounds[:, 3] >= miny)).any():
+        return None
+    return content
+
+
+def tile_features(dataset, layer, level, z, x, y):
+    """Features of a layer at an LOD level clipped, simplified and scaled into tile coordinates
+
+    Returns the geometries and their rows. Candidates come from the row
+    bounds read off the packed arrays and only theirs are projected, so no
+    projected copy of a layer is kept per process.
+    """
+    minx, miny, maxx, maxy = tile_bounds(z, x, y)
+    span = maxx - minx
+    clip_box = clip_bounds(z, x, y)
+
+    # Web mercator x grows with the longitude alone and y with the latitude, so corners map to corners
+    lon0, lat0 = mercator_lonlat(clip_box[0], clip_box[1])
+    lon1, lat1 = mercator_lonlat(clip_box[2], clip_box[3])
+    rows = bounds_rows(dataset.row_bounds(layer), (lon0, lat0, lon1, lat1))
+    if len(rows) == 0:
+        return [], rows
+
+    # One tile unit is the finest detail the client can show at this zoom
+    geometries = shapely.clip_by_rect(to_mercator(dataset.geometries(layer, level, rows)), *clip_box)
+    geometries = shapely.simplify(geometries, span / TILE_EXTENT, preserve_topology=True)
+    keep = ~shapely.is_empty(geometries)
+    scale = TILE_EXTENT / span
+    geometries = shapely.transform(
+        geometries[keep],
+        lambda coords: np.column_stack(((coords[:, 0] - minx) * scale, (maxy - coords[:, 1]) * scale)),
+    )
+    return geometries, rows[keep]
+
+
+def render_tile(dataset, layer, z, x, y):
+    """Encode one layer of an XYZ tile as a Mapbox Vector Tile, cached per tile version
+
+    A tile none of whose features changed since the previous dataset is
+    carried over from it rather than rendered again.
+    """
+    def build():
+        import mapbox_vector_tile
+
+        carried = carried_tile(dataset, layer, z, x, y)
+        if carried is not None:
+            return carried
+
+        # Start from the LOD level of this zoom so low zooms clip far fewer vertices
+        geometries, rows = tile_features(dataset, layer, lod_level(z), z, x, y)
+        if len(geometries) == 0:
+            return b''
+        scores = dataset.scores(layer)
+        if scores is not None:
+            classes = score_classes(dataset, layer)
+            # Unscored features (NaN) go without the properties
+            features = [
+                {"geometry": geometry, "properties": {"score": score, "class": cls} if score == score else {}}
+                for geometry, score, cls in zip(geometries, scores[rows].tolist(), classes[rows].tolist())
+            ]
+        else:
+            features = [{"geometry": geometry, "properties": {}} for geometry in geometries]
+        return mapbox_vector_tile.encode(
+            [{"name": layer, "features": features}],
+            default_options={"extents": TILE_EXTENT, "y_coord_down": True},
+        )
+    return tile_cache.get_or_build((tile_version(dataset, layer), layer, z, x, y), build)
+
+
+def tile_source(dataset, layer):
+    """Small descriptor the client turns into an MVTLayer instead of inline features
+
+    The tile version and classification are part of the URL so tiles can be
+    cached indefinitely, and the browser keeps its census block tiles across
+    versions that only change the sidewalks.
+    """
+    return {
+        "tiles": f"tiles/{layer}/{{z}}/{{x}}/{{y}}.mvt?v={tile_version(dataset, layer)}&classes={CLASSIFICATION}",
+        "minZoom": TILE_MIN_ZOOM,
+        "maxZoom": TILE_MAX_ZOOM,
+    }
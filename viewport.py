@@ -0,0 +1,59 @@
+import numpy as np
+import shapely
+
+VIEWPORT_LAYERS = ('sidewalks', 'cbs', 'blocks')
+# Most features sent per layer in answer to one viewport report
+VIEWPORT_FEATURE_BUDGET = 25000
+
+
+def bounds_rows(bounds, bbox):
+    """Sorted positions of the bounds (n, 4) intersecting bbox = (minx, miny, maxx, maxy)"""
+    minx, miny, maxx, maxy = bbox
+    return np.flatnonzero(
+        (bounds[:, 0] <= maxx) & (bounds[:, 2] >= minx) & (bounds[:, 1] <= maxy) & (bounds[:, 3] >= miny))
+
+
+def intersecting_rows(dataset, layer, bbox, exclude=None):
+    """Sorted row positions of a layer intersecting bbox, and their geometries
+
+    Candidates come from the row bounds read off the packed arrays, and only
+    their geometries are built, so no whole column or spatial index is kept
+    per process. Rows flagged in the boolean exclude mask are skipped before
+    any geometry is built.
+    """
+    rows = bounds_rows(dataset.row_bounds(layer), bbox)
+    if exclude is not None:
+        rows = rows[~exclude[rows]]
+    geometries = dataset.geometries(layer, rows=rows)
+    hits = shapely.intersects(geometries, shapely.box(*bbox))
+    return rows[hits], geometries[hits]
+
+
+def parse_viewport(viewport):
+    """Validate a viewport reported by the browser into ((minx, miny, maxx, maxy), zoom)
+
+    Raises ValueError for anything else, whatever its shape.
+    """
+    try:
+        minx, miny, maxx, maxy = (float(v) for v in viewport['bbox'])
+        zoom = float(viewport['zoom'])
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid viewport: {viewport!r}") from e
+    if not (minx <= maxx and miny <= maxy and np.isfinite([minx, miny, maxx, maxy, zoom]).all()):
+        raise ValueError(f"Invalid viewport bbox: {viewport['bbox']}")
+    return (minx, miny, maxx, maxy), zoom
+
+
+def viewport_rows(dataset, layer, bbox, exclude=None, budget=VIEWPORT_FEATURE_BUDGET):
+    """Sorted row positions of the features intersecting bbox
+
+    Rows flagged in the boolean exclude mask (features the client already
+    holds) are skipped. Beyond budget rows, the ones nearest the center of the
+    bbox are kept.
+    """
+    rows, geometries = intersecting_rows(dataset, layer, bbox, exclude)
+    if len(rows) > budget:
+        center = shapely.Point((bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2)
+        distances = shapely.distance(geometries, center)
+        rows = np.sort(rows[np.argpartition(distances, budget - 1)[:budget]])
+    return rows